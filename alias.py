@@ -0,0 +1,276 @@
+import numpy as np
+from kernel import HAVE_KERNEL, fill_alias, sweep_tokens_alias
+
+'''
+    Walker alias table over K outcomes, O(K) to build and O(1) per draw
+'''
+class AliasTable:
+
+    '''
+        Builds the table with Vose's method, compiled when numba is
+        installed
+        @param in_weights   array of nonnegative weights, not all zero
+    '''
+    def __init__(self, in_weights):
+        weights = np.asarray(in_weights, dtype=float)
+        self._K = len(weights)
+        self._probs = weights / weights.sum()
+        self._draws = 0
+
+        if HAVE_KERNEL:
+            prob = np.empty(self._K)
+            alias = np.empty(self._K, dtype=np.int64)
+            fill_alias(self._probs * self._K, prob, alias, np.empty(self._K, dtype=np.int64),
+                       np.empty(self._K, dtype=np.int64))
+            # lists index faster than arrays in sample()
+            self._prob = prob.tolist()
+            self._alias = alias.tolist()
+            return
+
+        scaled = (self._probs * self._K).tolist()
+        prob = [1.0] * self._K
+        alias = list(range(self._K))
+        small = [i for i in range(self._K) if scaled[i] < 1.0]
+        large = [i for i in range(self._K) if scaled[i] >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] = (scaled[l] + scaled[s]) - 1.0
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        # whatever is left is 1 up to rounding
+        self._prob = prob
+        self._alias = alias
+
+    '''
+        @return int number of draws since the table was built
+    '''
+    def get_num_draws(self):
+        return self._draws
+
+    '''
+        @param in_k int outcome
+        @return float normalized probability the table draws in_k with
+    '''
+    def prob(self, in_k):
+        return self._probs[in_k]
+
+    '''
+        Draws an outcome from one uniform
+        @param in_u float uniform in [0, 1)
+        @return int outcome
+    '''
+    def sample(self, in_u):
+        self._draws += 1
+        scaled = in_u * self._K
+        i = int(scaled)
+        if scaled - i < self._prob[i]:
+            return i
+        return self._alias[i]
+
+
+'''
+    Metropolis-Hastings sampler for z_d_i (LightLDA, Yuan et al. 2015)
+
+    Target is the collapsed conditional of calc_z_d_i,
+        p(z = k) prop to (ndk + a) (nkw + b) / (nk* + Vb)
+    reached by alternating two cheap proposals
+        word proposal   (nkw + b) / (nk* + Vb) from an alias table per
+                        word (and per branch), built lazily and reused
+                        across sweeps until it has served K draws, so the
+                        O(K) build costs O(1) per draw and the table is
+                        stale in between
+        doc proposal    (ndk + a) drawn by picking the z of another random
+                        token of d, or a uniform topic, in O(1) without a
+                        table
+    The MH acceptance corrects for both, so each token costs O(mh_steps).
+    A stale table still depends on the assignments when it was built, the
+    same approximation LightLDA makes; it fades with corpus size.
+
+    Branch 0 uses the global counts (x_d_i = 0), branch 1 + c the counts
+    of collection c (x_d_i = 1).
+
+    sweep_compiled runs a whole sweep in kernel.sweep_tokens_alias, its
+    tables in a pool of at most CACHE_BYTES. Rows keep their tokens from
+    sweep to sweep, so the pool goes to the rows with the most tokens;
+    the tables of the rest are built for every token, O(K) like "exact".
+    The tables live only in memory, so a run resumed from a checkpoint
+    rebuilds them and continues the chain in distribution, not draw for
+    draw.
+'''
+class AliasZSampler:
+
+    # bytes of word tables the compiled sweep keeps between sweeps
+    CACHE_BYTES = 1 << 28
+
+    '''
+        Creates an alias / MH z sampler
+        @param in_sampler   CategoricalSampler providing the uniforms
+        @param in_k int number of topics
+        @param in_a float alpha
+        @param in_b float beta
+        @param in_mh_steps  int word + doc proposal pairs per token
+    '''
+    def __init__(self, in_sampler, in_k, in_a, in_b, in_mh_steps=2):
+        self._sampler = in_sampler
+        self._K = in_k
+        self._a = in_a
+        self._b = in_b
+        self._mh_steps = in_mh_steps
+
+        self._data = None
+        self._vb = 0.0
+        self._tables = {}       # (branch, w) -> AliasTable, kept across sweeps
+        self._pool = None       # table pool of sweep_compiled
+
+        self._doc_z = None
+        self._doc_len = 0
+        self._doc_mass = 0.0
+        self._doc_pos = 0       # position of the token being sampled in d
+
+    '''
+        Keeps the word tables of the Data object sampled last sweep, drops
+        them for another one
+        @param in_data  Data object being sampled
+        @param in_c     int number of collections
+    '''
+    def begin_sweep(self, in_data, in_c):
+        if in_data is not self._data:
+            self._tables = {}
+            self._pool = None
+        self._data = in_data
+        self._vb = in_data.get_V() * self._b
+
+    '''
+        One training sweep in the compiled kernel
+        @param in_data  Data object being sampled
+        @param in_l     float lambda
+        @param in_rng   numpy.random.Generator for the uniforms
+    '''
+    def sweep_compiled(self, in_data, in_l, in_rng):
+        self.begin_sweep(in_data, in_data.get_nckw_map_star().shape[0])
+        if self._pool is None:
+            self._pool = self._new_pool(in_data)
+        corpus = in_data.get_corpus()
+        uniforms = in_rng.random((5 * self._mh_steps + 1) * corpus.get_num_tokens())
+        sweep_tokens_alias(corpus.get_words(), corpus.get_offsets(), corpus.get_doc_c(), in_data.get_slots(),
+                           in_data.get_z(), in_data.get_x(), in_data._ndk_map, in_data._nckw_map,
+                           in_data._nckw_map_star, in_data._nkw_map, in_data._nkw_map_star,
+                           float(in_l), float(self._a), float(self._b), float(self._vb), uniforms,
+                           self._mh_steps, *self._pool)
+
+    '''
+        @return (row_slot, draws, thr, alias, probs) table pool of
+                sweep_tokens_alias for the rows of in_data
+    '''
+    def _new_pool(self, in_data):
+        # tokens of every row: the nkw columns, then the nckw rows
+        totals = np.concatenate([in_data.get_nkw_map().sum(axis=0), in_data.get_nckw_map().sum(axis=1)])
+        # thr, alias and probs take 4 bytes per topic each
+        size = max(AliasZSampler.CACHE_BYTES // (12 * self._K) - 1, 0)
+        rows = np.argsort(-totals, kind="stable")[:size]
+        rows = rows[totals[rows] > 0]
+        row_slot = np.full(len(totals), -1, dtype=np.int32)
+        row_slot[rows] = np.arange(len(rows), dtype=np.int32)
+        size = len(rows) + 1
+        return (row_slot, np.full(size, self._K, dtype=np.int64), np.empty((size, self._K), dtype=np.float32),
+                np.empty((size, self._K), dtype=np.int32), np.empty((size, self._K), dtype=np.float32))
+
+    '''
+        Sets up the doc proposal for doc d and prefetches its uniforms
+        @param in_c     int corpus number
+        @param in_d     int document number
+    '''
+    def begin_document(self, in_c, in_d):
+        self._doc_z = self._data.get_z_d(in_d)
+        self._doc_len = len(self._doc_z)
+        # the doc proposal picks among the other tokens
+        self._doc_mass = (self._doc_len - 1) / (self._doc_len - 1 + self._K * self._a)
+        self._doc_pos = 0
+        # 2 uniforms per proposal + 1 per acceptance, + 1 for x_d_i
+        self._sampler.prefetch(self._doc_len * (6 * self._mh_steps + 1))
+
+    '''
+        Word tables are deliberately stale, nothing to patch
+    '''
+    def exclude(self, in_c, in_d, in_w, in_z):
+        pass
+
+    '''
+        Word tables are deliberately stale, nothing to patch; moves on to
+        the next token of the document
+    '''
+    def include(self, in_c, in_d, in_w, in_z):
+        self._doc_pos += 1
+
+    '''
+        @return AliasTable word proposal for word w in the branch
+    '''
+    def _word_table(self, in_branch, in_w):
+        key = (in_branch, in_w)
+        table = self._tables.get(key)
+        if table is None or table.get_num_draws() >= self._K:
+            if in_branch == 0:
+                weights = (self._data.get_n_k_w_vec(in_w) + self._b) / (self._data.get_n_k_star_vec() + self._vb)
+            else:
+                c = in_branch - 1
+                weights = (self._data.get_n_ck_w_vec(c, in_w) + self._b) / (self._data.get_n_ck_star_vec(c) + self._vb)
+            table = AliasTable(weights)
+            self._tables[key] = table
+        return table
+
+    '''
+        Unnormalized target probability of class k for the token
+    '''
+    def _target(self, in_branch, in_c, in_d, in_w, in_k):
+        data = self._data
+        if in_branch == 0:
+            word = (data.get_n_k_w(in_k, in_w) + self._b) / (data.get_n_k_star(in_k) + self._vb)
+        else:
+            word = (data.get_n_ck_w(in_c, in_k, in_w) + self._b) / (data.get_n_ck_star(in_c, in_k) + self._vb)
+        return (data.get_n_d_k(in_d, in_k) + self._a) * word
+
+    '''
+        Draws z_d_i by MH steps starting from the token's previous class
+        @param in_c     int corpus number
+        @param in_d     int document number
+        @param in_w     int word idx
+        @param in_x_d_i int whether we use corpus or global counts
+        @param in_z     int class the token had before this draw
+        @return int class
+    '''
+    def sample(self, in_c, in_d, in_w, in_x_d_i, in_z):
+        sampler = self._sampler
+        branch = 0 if in_x_d_i == 0 else 1 + in_c
+        table = self._word_table(branch, in_w)
+        ndk = self._data.get_n_d_k_vec(in_d)
+
+        s = in_z
+        p_s = self._target(branch, in_c, in_d, in_w, s)
+        for _ in range(self._mh_steps):
+            # word proposal
+            t = table.sample(sampler.uniform())
+            if t != s:
+                p_t = self._target(branch, in_c, in_d, in_w, t)
+                accept = (p_t * table.prob(s)) / (p_s * table.prob(t))
+                if accept >= 1.0 or sampler.uniform() < accept:
+                    s, p_s = t, p_t
+
+            # doc proposal, q(k) prop to ndk + a: the z of another token
+            if sampler.uniform() < self._doc_mass:
+                j = min(int(sampler.uniform() * (self._doc_len - 1)), self._doc_len - 2)
+                if j >= self._doc_pos:
+                    j += 1
+                t = int(self._doc_z[j])
+            else:
+                t = min(int(sampler.uniform() * self._K), self._K - 1)
+            if t != s:
+                p_t = self._target(branch, in_c, in_d, in_w, t)
+                accept = (p_t * (ndk[s] + self._a)) / (p_s * (ndk[t] + self._a))
+                if accept >= 1.0 or sampler.uniform() < accept:
+                    s, p_s = t, p_t
+        return s
@@ -0,0 +1,336 @@
+import json, sys, time
+import numpy as np
+from collapsed import CollapsedSampler
+from flags import ints, read_flags, strs
+
+'''
+    Benchmarks for the collapsed sampler
+
+    python benchmark.py mixing <train file> <K> <sweeps> [max docs] [samplers]
+        runs each z sampler (default exact,sparse,alias) from the same
+        seed and reports how fast the training log-likelihood climbs per
+        second of sampling (evaluation time is not counted); the first
+        sampler runs <sweeps> sweeps, the others as many as fit in the
+        same sampling time, so cheap but less effective sweeps are
+        compared fairly
+
+    python benchmark.py ops <train file> <K> [--flag value ...]
+        times the hot path operations one by one (exclude_token /
+        include_token, calc_z_d_i, sample, calc_x_d_i, the estimators,
+        compute_log_likelihood, whole sweeps)
+
+    python benchmark.py grid [--flag value ...]
+        times whole training sweeps as tokens/second over a grid of K, V
+        and corpus sizes of synthetic corpora plus the bundled files,
+        writes the results as JSON (--out) and fails when a throughput
+        drops more than --threshold below a stored baseline (--baseline)
+
+        Baselines are machine specific and not kept in the repo: record
+        one with "make benchgrid" (bench-baseline.json), then compare
+        later runs against it with "make benchcompare".
+'''
+
+L, A, B = 0.5, 0.1, 0.01
+
+# sweeps of the later mixing samplers, at most this many times <sweeps>
+MAX_SWEEPS = 100
+
+'''
+    Reads at most max_docs documents of a train file
+    @return list of lists of [classification words]
+'''
+def read_lines(in_path, in_max_docs=None):
+    lines = []
+    with open(in_path) as f:
+        for line in f:
+            tokens = line.strip().split()
+            if tokens:
+                lines.append(tokens)
+            if in_max_docs is not None and len(lines) >= in_max_docs:
+                break
+    return lines
+
+'''
+    Runs one chain and records the log-likelihood after every sweep
+    @param in_seconds   float sampling seconds to stop after instead,
+                        in_sweeps is then an upper bound, or None
+    @return list of (sampling seconds so far, train log-likelihood)
+'''
+def trace_chain(in_lines, in_k, in_sweeps, in_sampler, in_seed=0, in_seconds=None):
+    cs = CollapsedSampler(in_lines, in_lines[:1], None, in_k, L, A, B, in_sweeps, 0,
+                          in_seed=in_seed, in_sampler=in_sampler)
+    cs.initialize_values()
+    data = cs._train_data
+    trace = []
+    elapsed = 0.0
+    for t in range(in_sweeps):
+        if in_seconds is not None and elapsed >= in_seconds:
+            break
+        start = time.time()
+        cs.sweep_train(data)
+        elapsed += time.time() - start
+        cs.estimate_theta(data)
+        cs.estimate_phi(data)
+        cs.estimate_phi_c(data)
+        trace.append((elapsed, cs.compute_log_likelihood(data)))
+    return trace
+
+'''
+    Compares mixing per second of the z samplers on the same corpus
+'''
+def mixing(in_path, in_k, in_sweeps, in_max_docs, in_samplers):
+    lines = read_lines(in_path, in_max_docs)
+    num_tokens = sum(len(line) - 1 for line in lines)
+    print("docs " + str(len(lines)) + " tokens " + str(num_tokens) + " K " + str(in_k))
+
+    traces = {}
+    budget = None
+    for sampler in in_samplers:
+        # the first sweep would pay for compiling the kernel, if any
+        trace_chain(lines[:2], in_k, 1, sampler)
+        if budget is None:
+            traces[sampler] = trace_chain(lines, in_k, in_sweeps, sampler)
+            budget = traces[sampler][-1][0]
+        else:
+            traces[sampler] = trace_chain(lines, in_k, MAX_SWEEPS * in_sweeps, sampler, in_seconds=budget)
+
+    # target: mean of the last few log-likelihoods of the first sampler
+    ref = traces[in_samplers[0]]
+    tail = ref[-max(1, len(ref) // 5):]
+    target = sum(ll for _, ll in tail) / len(tail)
+
+    for sampler in in_samplers:
+        trace = traces[sampler]
+        total = trace[-1][0]
+        gain = (trace[-1][1] - trace[0][1]) / max(total - trace[0][0], 1e-9)
+        reached = [secs for secs, ll in trace if ll >= target]
+        print(sampler)
+        print("  sweeps           %d" % len(trace))
+        print("  sec/sweep        %.4f" % (total / len(trace)))
+        print("  tokens/sec       %.0f" % (num_tokens * len(trace) / total))
+        print("  final loglik     %.2f" % trace[-1][1])
+        print("  loglik gain/sec  %.2f" % gain)
+        if reached:
+            print("  sec to target    %.4f (target %.2f)" % (reached[0], target))
+        else:
+            print("  sec to target    not reached (target %.2f)" % target)
+
+
+'''
+    Makes a synthetic corpus with Zipf distributed words
+    @return list of lists of [classification words]
+'''
+def synthetic_lines(in_num_docs, in_doc_len, in_v, in_c=2, in_seed=0):
+    rng = np.random.default_rng(in_seed)
+    weights = 1.0 / np.arange(1, in_v + 1)
+    words = rng.choice(in_v, size=(in_num_docs, in_doc_len), p=weights / weights.sum())
+    labels = rng.integers(in_c, size=in_num_docs)
+    return [[str(labels[d])] + ["w" + str(w) for w in words[d]] for d in range(in_num_docs)]
+
+'''
+    Seconds per call of a function, best of a few rounds
+'''
+def time_calls(in_fn, in_calls, in_rounds=3):
+    best = None
+    for r in range(in_rounds):
+        start = time.perf_counter()
+        in_fn()
+        secs = time.perf_counter() - start
+        best = secs if best is None else min(best, secs)
+    return best / in_calls
+
+'''
+    Times every hot path operation of one sampler
+    @param in_layout    string collection layout, see CollapsedSampler
+    @return dict of operation -> microseconds per call
+'''
+def ops(in_lines, in_k, in_calls, in_sampler="exact", in_seed=0, in_layout="auto"):
+    cs = CollapsedSampler(in_lines, in_lines[:1], None, in_k, L, A, B, 1, 0,
+                          in_seed=in_seed, in_sampler=in_sampler, in_collection_layout=in_layout)
+    cs.initialize_values()
+    data = cs.get_train_data()
+    test = cs.get_test_data()
+    cs.estimate_theta(data)
+    cs.estimate_phi(data)
+    cs.estimate_phi_c(data)
+
+    corpus = data.get_corpus()
+    rng = np.random.default_rng(in_seed)
+    tokens = rng.choice(corpus.get_num_tokens(), size=min(in_calls, corpus.get_num_tokens()), replace=False)
+    docs = corpus.get_token_docs()[tokens].tolist()
+    cols = corpus.get_token_c()[tokens].tolist()
+    words = corpus.get_words()[tokens].tolist()
+    tokens = tokens.tolist()
+    z = data.get_z()[tokens].tolist()
+    x = data.get_x()[tokens].tolist()
+    items = list(zip(cols, docs, tokens, words, z, x))
+    n = len(items)
+
+    def exclude():
+        for c, d, t, w, k, b in items:
+            data.exclude_token(c, d, t)
+
+    def include():
+        for c, d, t, w, k, b in items:
+            data.include_token(c, d, t, k, b)
+
+    def calc_z():
+        for c, d, t, w, k, b in items:
+            cs.calc_z_d_i(data, c, d, w, b)
+
+    dists = [cs.calc_z_d_i(data, c, d, w, b) for c, d, t, w, k, b in items]
+
+    def sample():
+        for dist in dists:
+            cs.sample(dist)
+
+    def calc_x():
+        for c, d, t, w, k, b in items:
+            cs.calc_x_d_i(data, c, d, w, k)
+
+    results = {}
+    # each include puts back what the exclude before it took out
+    results["exclude_token"], results["include_token"] = None, None
+    for r in range(3):
+        start = time.perf_counter()
+        exclude()
+        mid = time.perf_counter()
+        include()
+        end = time.perf_counter()
+        results["exclude_token"] = min(results["exclude_token"] or mid - start, mid - start)
+        results["include_token"] = min(results["include_token"] or end - mid, end - mid)
+    results["exclude_token"] /= n
+    results["include_token"] /= n
+    results["calc_z_d_i"] = time_calls(calc_z, n)
+    results["sample"] = time_calls(sample, n)
+    results["calc_x_d_i"] = time_calls(calc_x, n)
+    results["estimate_theta"] = time_calls(lambda: cs.estimate_theta(data), 1)
+    results["estimate_phi"] = time_calls(lambda: cs.estimate_phi(data), 1)
+    results["estimate_phi_c"] = time_calls(lambda: cs.estimate_phi_c(data), 1)
+    results["compute_log_likelihood"] = time_calls(lambda: cs.compute_log_likelihood(data), 1)
+    # best of two, the first sweep may pay for compiling the kernel
+    results["sweep_train"] = time_calls(lambda: cs.sweep_train(data), 1, 2)
+    results["sweep_test_batched"] = time_calls(lambda: cs.sweep_test_batched(test), 1, 2)
+    return dict((op, secs * 1e6) for op, secs in results.items())
+
+'''
+    Times whole training sweeps of one corpus
+    @return dict with tokens, secs per sweep and tokens/sec
+'''
+def sweep_rate(in_lines, in_k, in_sweeps, in_sampler="exact", in_seed=0):
+    cs = CollapsedSampler(in_lines, in_lines[:1], None, in_k, L, A, B, in_sweeps, 0,
+                          in_seed=in_seed, in_sampler=in_sampler)
+    cs.initialize_values()
+    data = cs.get_train_data()
+    # the first sweep pays for compiling the kernel, if any
+    cs.sweep_train(data)
+    start = time.perf_counter()
+    for t in range(in_sweeps):
+        cs.sweep_train(data)
+    secs = (time.perf_counter() - start) / in_sweeps
+    num_tokens = data.get_corpus().get_num_tokens()
+    return {"tokens": num_tokens, "sec_per_sweep": secs, "tokens_per_sec": num_tokens / secs}
+
+'''
+    Runs the sweep grid
+    @return dict of case name -> sweep_rate result
+'''
+def grid(in_options):
+    cases = []
+    for k in in_options["k"]:
+        for v in in_options["v"]:
+            for num_docs in in_options["docs"]:
+                name = "synthetic k=" + str(k) + " v=" + str(v) + " docs=" + str(num_docs)
+                cases.append((name, k, lambda v=v, num_docs=num_docs:
+                              synthetic_lines(num_docs, in_options["doc_len"], v)))
+    for path in in_options["files"]:
+        for k in in_options["k"]:
+            cases.append((path + " k=" + str(k), k, lambda path=path: read_lines(path)))
+
+    results = {}
+    for name, k, make_lines in cases:
+        for sampler in in_options["samplers"]:
+            case = name + " " + sampler
+            results[case] = sweep_rate(make_lines(), k, in_options["sweeps"], sampler)
+            print("%-50s %12.0f tokens/sec" % (case, results[case]["tokens_per_sec"]))
+    return results
+
+'''
+    Compares tokens/sec against a baseline
+    @return list of strings, one per case more than in_threshold slower
+'''
+def regressions(in_results, in_baseline, in_threshold):
+    failed = []
+    for case, result in in_results.items():
+        if case not in in_baseline:
+            continue
+        base = in_baseline[case]["tokens_per_sec"]
+        drop = 1.0 - result["tokens_per_sec"] / base
+        if drop > in_threshold:
+            failed.append("%s: %.0f tokens/sec, baseline %.0f (-%.0f%%)" % (case, result["tokens_per_sec"], base, 100 * drop))
+    return failed
+
+'''
+    flag -> (setting, type, default) of the ops and grid modes, lists are
+    comma separated
+'''
+OPTIONS = {
+    "--k": ("k", ints, [10, 50]),
+    "--v": ("v", ints, [1000, 10000]),
+    "--docs": ("docs", ints, [200, 1000]),
+    "--doc-len": ("doc_len", int, 50),
+    "--files": ("files", strs, ["small_train.txt", "input-train.txt"]),
+    "--samplers": ("samplers", strs, ["exact"]),
+    "--sweeps": ("sweeps", int, 3),
+    "--calls": ("calls", int, 2000),
+    "--layout": ("layout", str, "auto"),
+    "--out": ("out", str, None),
+    "--baseline": ("baseline", str, None),
+    "--threshold": ("threshold", float, 0.2),
+}
+
+'''
+    Writes results as JSON if --out is set
+'''
+def write_results(in_options, in_results):
+    if in_options["out"] is not None:
+        with open(in_options["out"], "w") as f:
+            json.dump(in_results, f, indent=1, sort_keys=True)
+
+
+def main():
+    mode = sys.argv[1] if len(sys.argv) > 1 else None
+    if mode == "mixing" and len(sys.argv) >= 5:
+        max_docs = int(sys.argv[5]) if len(sys.argv) > 5 else None
+        samplers = sys.argv[6].split(",") if len(sys.argv) > 6 else ["exact", "sparse", "alias"]
+        mixing(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), max_docs, samplers)
+    elif mode == "ops" and len(sys.argv) >= 4:
+        options = read_flags(sys.argv[4:], OPTIONS)
+        lines = read_lines(sys.argv[2])
+        results = {}
+        for sampler in options["samplers"]:
+            results[sampler] = ops(lines, int(sys.argv[3]), options["calls"], sampler,
+                                   in_layout=options["layout"])
+            print(sampler + " (" + options["layout"] + " layout)")
+            for op, usecs in results[sampler].items():
+                print("  %-28s %12.2f us" % (op, usecs))
+        write_results(options, results)
+    elif mode == "grid":
+        options = read_flags(sys.argv[2:], OPTIONS)
+        results = grid(options)
+        write_results(options, results)
+        if options["baseline"] is not None:
+            with open(options["baseline"]) as f:
+                failed = regressions(results, json.load(f), options["threshold"])
+            for line in failed:
+                print("REGRESSION " + line)
+            if failed:
+                sys.exit(1)
+    else:
+        raise Exception("Correct usage: python benchmark.py mixing input-train.txt 10 50 [300] [exact,sparse,alias]\n"
+                        "             python benchmark.py ops input-train.txt 10 [--calls 2000] [--layout auto]\n"
+                        "             python benchmark.py grid [--out bench.json] [--baseline base.json] [--threshold 0.2]")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from collapsed import CollapsedSampler
+from corpus import Corpus
+from shared import attach, release, share_array
+
+'''
+    Independent chains of the collapsed sampler
+
+    N chains with their own seeds run in a process pool over one encoded
+    corpus that the workers map read-only from shared memory. The
+    log likelihood traces give split-R-hat; the result is either the best
+    chain or the estimates averaged over chains after their topics are
+    matched to those of the best chain (topic labels are arbitrary per
+    chain). Topics are matched with scipy's Hungarian solver when scipy
+    is installed, greedily otherwise.
+'''
+try:
+    from scipy.optimize import linear_sum_assignment
+    HAVE_SCIPY = True
+except ImportError:
+    linear_sum_assignment = None
+    HAVE_SCIPY = False
+
+COMBINE = ["best", "mean"]
+
+'''
+    Options a chain cannot share with the others: each chain is one
+    process sweeping serially, keeps its results in memory and prints
+    nothing
+'''
+CHAIN_OPTIONS = {"in_workers": 1, "in_checkpoint": None, "in_checkpoint_every": 0,
+                 "in_metrics_jsonl": None, "in_metrics_port": 0, "in_print_ll": 0}
+
+'''
+    Runs the chains and combines them
+    @param in_train Corpus, the training set
+    @param in_test  Corpus encoded with the vocab of in_train
+    @param in_params    dict with k, l, a, b, num_iters, num_burn_in
+    @param in_options   dict of CollapsedSampler keywords of every chain
+    @param in_num_chains    int number of chains
+    @param in_seed  int seed the chain seeds are drawn from, None for
+                    fresh entropy
+    @param in_combine   string "best" or "mean"
+    @param in_processes int processes, None for one per chain
+    @return dict with theta, phi, phi_c, slot_map (of the phi_c rows),
+            rhat, best (chain idx), seeds, trainll / testll (per chain
+            arrays of [t, loglik] rows)
+'''
+def run_chains(in_train, in_test, in_params, in_options, in_num_chains, in_seed=None,
+               in_combine="best", in_processes=None):
+    if in_combine not in COMBINE:
+        raise Exception("unknown combine " + str(in_combine) + ", expected one of " + ", ".join(COMBINE))
+    options = dict(in_options)
+    options.update(CHAIN_OPTIONS)
+    # every chain gets its own seed
+    options.pop("in_seed", None)
+    seeds = [int(s) for s in np.random.SeedSequence(in_seed).generate_state(in_num_chains, np.uint64)]
+
+    shms = []
+    specs = {}
+    for name, corpus in [("train", in_train), ("test", in_test)]:
+        for part, arr in [("words", corpus.get_words()), ("offsets", corpus.get_offsets()),
+                          ("doc_c", corpus.get_doc_c())]:
+            shm, _, specs[name + "_" + part] = share_array(arr)
+            shms.append(shm)
+    try:
+        with ProcessPoolExecutor(max_workers=in_processes or in_num_chains) as pool:
+            futures = [pool.submit(_run_chain, specs, in_train.get_vocab(), in_train.get_labels(),
+                                   in_params, options, seed) for seed in seeds]
+            chains = [future.result() for future in futures]
+    finally:
+        release(shms, True)
+
+    # the series the chains are compared on
+    key = "trainll" if options.get("in_eval_train", 1) else "testll"
+    traces = [chain[key] for chain in chains]
+    finals = [trace[-1, 1] if len(trace) else -np.inf for trace in traces]
+    best = int(np.argmax(finals))
+
+    result = {"rhat": split_rhat([_post_burn_in(trace, in_params["num_burn_in"]) for trace in traces]),
+              "best": best, "seeds": seeds, "slot_map": chains[best]["slot_map"],
+              "trainll": [chain["trainll"] for chain in chains],
+              "testll": [chain["testll"] for chain in chains]}
+    if in_combine == "best":
+        result["theta"] = chains[best]["theta"]
+        result["phi"] = chains[best]["phi"]
+        result["phi_c"] = chains[best]["phi_c"]
+    else:
+        ref = chains[best]["phi"]
+        theta = np.zeros_like(chains[best]["theta"])
+        phi = np.zeros_like(ref)
+        phi_c = np.zeros_like(chains[best]["phi_c"])
+        for chain in chains:
+            perm = match_topics(ref, chain["phi"])
+            theta += chain["theta"][:, perm]
+            phi += chain["phi"][perm]
+            # every chain has the slots of the one training set
+            phi_c += chain["phi_c"][:, perm]
+        result["theta"] = theta / len(chains)
+        result["phi"] = phi / len(chains)
+        result["phi_c"] = phi_c / len(chains)
+    return result
+
+'''
+    Values of a trace after burn-in, its second half if burn-in covers
+    (nearly) all of it
+    @param in_trace float array (n x 2) of [t, loglik] rows
+    @return float array of log likelihoods
+'''
+def _post_burn_in(in_trace, in_num_burn_in):
+    values = in_trace[in_trace[:, 0] > in_num_burn_in, 1]
+    if len(values) < 4:
+        values = in_trace[len(in_trace) // 2:, 1]
+    return values
+
+'''
+    Split-R-hat (Gelman et al.) of scalar traces, every trace cut into
+    two halves that count as separate chains
+    @param in_traces    list of float arrays, one per chain
+    @return float R-hat, near 1 once the chains agree, nan if the traces
+            are too short
+'''
+def split_rhat(in_traces):
+    n = min(len(trace) for trace in in_traces) // 2
+    if n < 2:
+        return float("nan")
+    halves = []
+    for trace in in_traces:
+        trace = np.asarray(trace, dtype=float)[-2 * n:]
+        halves.append(trace[:n])
+        halves.append(trace[n:])
+    halves = np.array(halves)
+    means = halves.mean(axis=1)
+    W = halves.var(axis=1, ddof=1).mean()
+    B = n * means.var(ddof=1)
+    if W == 0:
+        return 1.0 if B == 0 else float("inf")
+    var = (n - 1.0) / n * W + B / n
+    return float(np.sqrt(var / W))
+
+'''
+    Matches the topics of a chain to those of a reference chain by the
+    overlap of their word distributions
+    @param in_ref   float array (k x w) phi of the reference chain
+    @param in_phi   float array (k x w) phi of the chain
+    @return int array (k), topic perm[j] of the chain matches topic j
+'''
+def match_topics(in_ref, in_phi):
+    # Bhattacharyya coefficient of every pair of topics
+    sim = np.sqrt(in_ref) @ np.sqrt(in_phi).T
+    K = sim.shape[0]
+    if HAVE_SCIPY:
+        rows, cols = linear_sum_assignment(-sim)
+        perm = np.empty(K, dtype=int)
+        perm[rows] = cols
+        return perm
+    perm = np.full(K, -1)
+    sim = sim.copy()
+    for i in range(K):
+        j, k = np.unravel_index(np.argmax(sim), sim.shape)
+        perm[j] = k
+        sim[j, :] = -np.inf
+        sim[:, k] = -np.inf
+    return perm
+
+'''
+    Pool task: runs one chain over the shared corpus
+    @return dict with theta, phi, phi_c, slot_map and the trainll /
+            testll traces
+'''
+def _run_chain(in_specs, in_vocab, in_labels, in_params, in_options, in_seed):
+    shms, views = attach(list(in_specs.values()))
+    arrays = dict(zip(in_specs.keys(), views))
+    for arr in views:
+        arr.flags.writeable = False
+
+    train = Corpus(arrays["train_words"], arrays["train_offsets"], arrays["train_doc_c"], in_vocab, in_labels)
+    test = Corpus(arrays["test_words"], arrays["test_offsets"], arrays["test_doc_c"], in_vocab, in_labels)
+    cs = CollapsedSampler(train, test, None, in_params["k"], in_params["l"], in_params["a"],
+                          in_params["b"], in_params["num_iters"], in_params["num_burn_in"],
+                          in_seed=in_seed, **in_options)
+    cs.algorithm()
+    data = cs.get_train_data()
+    trainll, testll = cs.get_writer().get_log_likelihoods()
+    result = {"theta": data.get_theta().copy(), "phi": data.get_phi().copy(),
+              "phi_c": data.get_phi_c().copy(), "slot_map": data.get_slot_map(),
+              "trainll": trainll, "testll": testll}
+
+    # the blocks can only be closed once nothing views them
+    del cs, data, train, test, arrays, views, arr
+    release(shms)
+    return result
@@ -0,0 +1,176 @@
+import json, os, shutil
+import numpy as np
+from corpus import Corpus
+from data import Data
+from slots import slot_map_from_arrays
+from vocab import Vocabulary
+
+'''
+    Binary checkpoints of a CollapsedSampler
+
+    A checkpoint is a directory holding one .npy file per array (encoded
+    corpora, z / x, count tables, estimates, posterior sums, unused
+    prefetched uniforms, recorded likelihoods, the slot map), the
+    vocabulary and the collection labels one token per line and state.json (params, options, iteration, generator
+    state). Resuming maps the arrays back copy-on-write, so neither the
+    input files nor initialize_values are needed and the checkpoint
+    itself is never modified by the resumed run.
+
+    The corpora, slot map, vocabulary and labels never change during a
+    run, so they are hard linked from the checkpoint the run last wrote
+    or resumed from and only the sampling state is written again; they
+    are written in full when there is no such checkpoint or the file
+    system cannot link.
+'''
+
+STATE_FILE = "state.json"
+VOCAB_FILE = "vocab.txt"
+LABELS_FILE = "labels.txt"
+
+'''
+    Writes the state of a sampler after its last completed iteration,
+    replacing an earlier checkpoint in the same directory only once the
+    new one is complete
+    @param in_cs    CollapsedSampler after initialize_values
+    @param in_path  string checkpoint directory
+'''
+def save_checkpoint(in_cs, in_path):
+    tmp_path = in_path + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    train = in_cs.get_train_data()
+    test = in_cs.get_test_data()
+    rng_state, uniforms = in_cs.get_categorical_sampler().get_state()
+    theta_sum, phi_sum, phi_c_sum = in_cs.get_posterior_sums()
+    static = {}
+    for name, data in [("train", train), ("test", test)]:
+        corpus = data.get_corpus()
+        static[name + "_words"] = corpus.get_words()
+        static[name + "_offsets"] = corpus.get_offsets()
+        static[name + "_doc_c"] = corpus.get_doc_c()
+    for name, arr in train.get_slot_map().to_arrays().items():
+        static["slots_" + name] = arr
+    source = in_cs.get_checkpoint_source()
+    for name, arr in static.items():
+        if not _link(source, tmp_path, name + ".npy"):
+            np.save(os.path.join(tmp_path, name + ".npy"), arr)
+
+    arrays = {
+        "uniforms": uniforms,
+        "phi": train.get_phi(),
+        "phi_c": train.get_phi_c(),
+        "theta_sum": theta_sum,
+        "phi_sum": phi_sum,
+        "phi_c_sum": phi_c_sum,
+    }
+    for name, data in [("train", train), ("test", test)]:
+        arrays[name + "_z"] = data.get_z()
+        arrays[name + "_x"] = data.get_x()
+        arrays[name + "_ndk"] = data.get_ndk_map()
+        arrays[name + "_theta"] = data.get_theta()
+    arrays["train_nckw"] = train.get_nckw_map()
+    arrays["train_nckw_star"] = train.get_nckw_map_star()
+    arrays["trainll"], arrays["testll"] = in_cs.get_writer().get_log_likelihoods()
+    for name, arr in arrays.items():
+        np.save(os.path.join(tmp_path, name + ".npy"), arr)
+
+    for name, tokens in [(VOCAB_FILE, train.get_vocab().get_tokens()),
+                         (LABELS_FILE, train.get_corpus().get_labels().get_tokens())]:
+        if _link(source, tmp_path, name):
+            continue
+        with open(os.path.join(tmp_path, name), "w") as f:
+            for token in tokens:
+                f.write(token + "\n")
+
+    state = {"params": in_cs.get_params(), "options": in_cs.get_options(),
+             "c": in_cs._c, "t": in_cs.get_t(), "estimated": in_cs.is_estimated(),
+             "num_samples": in_cs.get_num_samples(), "rng": rng_state,
+             "convergence": in_cs.get_convergence()}
+    with open(os.path.join(tmp_path, STATE_FILE), "w") as f:
+        json.dump(state, f)
+
+    # swap directories so a crash never leaves only a partial checkpoint
+    old_path = in_path + ".old"
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+    if os.path.exists(in_path):
+        os.rename(in_path, old_path)
+    os.rename(tmp_path, in_path)
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+    in_cs.set_checkpoint_source(in_path)
+
+'''
+    Hard links a file of an earlier checkpoint into a new one
+    @param in_source    string earlier checkpoint directory, or None
+    @param in_path  string new checkpoint directory
+    @param in_name  string file name
+    @return bool whether the file was linked
+'''
+def _link(in_source, in_path, in_name):
+    if in_source is None:
+        return False
+    try:
+        os.link(os.path.join(in_source, in_name), os.path.join(in_path, in_name))
+    except OSError:
+        return False
+    return True
+
+'''
+    Rebuilds a sampler from a checkpoint, ready to continue with
+    algorithm() after the saved iteration
+    @param in_path  string checkpoint directory
+    @param in_options   dict of constructor keywords overriding the saved
+                        options (e.g. in_workers), or None
+    @return CollapsedSampler
+'''
+def load_checkpoint(in_path, in_options=None):
+    # imported here, collapsed imports this module
+    from collapsed import CollapsedSampler
+
+    with open(os.path.join(in_path, STATE_FILE)) as f:
+        state = json.load(f)
+    with open(os.path.join(in_path, VOCAB_FILE)) as f:
+        vocab = Vocabulary(line.rstrip("\n") for line in f)
+    vocab.freeze()
+    with open(os.path.join(in_path, LABELS_FILE)) as f:
+        labels = Vocabulary(line.rstrip("\n") for line in f)
+
+    def load(in_name):
+        # plain ndarray view on a copy-on-write map, for numba
+        return np.asarray(np.load(os.path.join(in_path, in_name + ".npy"), mmap_mode="c"))
+
+    corpora = {}
+    for name in ["train", "test"]:
+        corpora[name] = Corpus(load(name + "_words"), load(name + "_offsets"),
+                               load(name + "_doc_c"), vocab, labels)
+
+    options = dict(state["options"])
+    if in_options is not None:
+        options.update(in_options)
+    params = state["params"]
+    cs = CollapsedSampler(corpora["train"], corpora["test"], params["out"], params["k"],
+                          params["l"], params["a"], params["b"], params["num_iters"],
+                          params["num_burn_in"], **options)
+    cs._c = state["c"]
+
+    phi = load("phi")
+    phi_c = load("phi_c")
+    slot_map = slot_map_from_arrays(dict((name, load("slots_" + name))
+                                         for name in ["slot_w", "indptr", "V", "dense"]))
+    train = Data(corpora["train"], load("train_x"), load("train_z"), load("train_ndk"),
+                 load("train_nckw"), load("train_nckw_star"), load("train_theta"), phi, phi_c,
+                 slot_map)
+    test = Data(corpora["test"], load("test_x"), load("test_z"), load("test_ndk"),
+                None, None, load("test_theta"), phi, phi_c, slot_map)
+    cs.restore(train, test, state["t"], state["estimated"],
+               (load("theta_sum"), load("phi_sum"), load("phi_c_sum")), state["num_samples"])
+    cs.get_categorical_sampler().set_state(state["rng"], load("uniforms"))
+    cs.set_checkpoint_source(in_path)
+    if "convergence" in state:
+        cs.set_convergence(state["convergence"])
+    if os.path.exists(os.path.join(in_path, "trainll.npy")):
+        cs.get_writer().set_log_likelihoods(load("trainll"), load("testll"))
+    return cs
@@ -1,6 +1,17 @@
 from gibbs_sampler import GibbsSampler
 from data import Data
-import random, pdb, math, sys
+from sampling import CategoricalSampler
+from sparse import SparseZSampler
+from alias import AliasZSampler
+from parallel import ParallelSweeper
+from kernel import HAVE_KERNEL, sweep_tokens
+from corpus import Corpus
+from output import OutputWriter
+from metrics import Metrics, JsonLinesSink, PrometheusSink
+from convergence import ConvergenceMonitor
+from slots import build_slot_map, LAYOUTS, DENSE_THRESHOLD
+import checkpoint
+import sys
 import numpy as np
 
 '''
@@ -8,22 +19,102 @@ import numpy as np
 '''
 class CollapsedSampler(GibbsSampler):
 
+    # tokens scored at a time by compute_log_likelihood
+    LL_BLOCK = 1 << 16
+
     '''
         Creates a Collapsed Sampler
-        @param in_train list of lists of [classification words]
-        @param in_test line of lists of [classification words]
-        @param in_out   string path for output
+        @param in_train Corpus, or list of lists of [classification words]
+        @param in_test  Corpus encoded with the vocab and collection
+                        labels of in_train, or list of lists of
+                        [classification words]
+        @param in_out   string path for output, None to write nothing
         @param in_k int number of topics
         @param in_l float lambda for c variable
         @param in_a float alpha for theta variable
         @param in_b float beta for phi variable
         @param in_num_iters int number of total iterations for algorithm
         @param in_num_burn_in   int number of "burn in" iterations
+        @param in_check_counts  int recount the tables against z every
+                                this many iterations, 0 to never check
+        @param in_seed  int seed or numpy.random.Generator, None for fresh entropy
+        @param in_sampler   string z sampler for training sweeps, "exact"
+                            (full K-vector), "sparse" (SparseLDA buckets)
+                            or "alias" (alias tables + Metropolis-Hastings)
+        @param in_mh_steps  int MH proposal pairs per token for "alias"
+        @param in_workers   int processes for training sweeps, more than 1
+                            runs approximate distributed sweeps (AD-LDA)
+        @param in_kernel    int 1 to run training sweeps in the compiled
+                            kernel of the sampler when numba is installed,
+                            0 to always use the Python path
+        @param in_estimate_every    int estimate theta / phi / phi_c every
+                                    this many iterations (and at the last)
+        @param in_estimate_after_burn_in    int 1 to estimate only after
+                                    burn-in; the test sweep and likelihoods
+                                    wait for the first estimate
+        @param in_eval_every    int print the likelihoods every this many
+                                iterations (and at the last), 0 never
+        @param in_eval_train    int 0 to print only the test likelihood
+        @param in_thin  int after burn-in, average every this many
+                        iterations into the posterior mean
+        @param in_checkpoint    string directory to checkpoint to, or None
+        @param in_checkpoint_every  int checkpoint every this many
+                                    iterations (and at the last), 0 never,
+                                    None for every iteration if
+                                    in_checkpoint is set
+        @param in_metrics_jsonl string file to append per iteration metrics
+                                to as JSON lines, or None
+        @param in_metrics_port  int port serving the latest metrics in the
+                                Prometheus text format, 0 for none
+        @param in_converge  string convergence test of the evaluated log
+                            likelihoods (train, or test with in_eval_train
+                            0): "window" or "geweke", None for fixed
+                            burn-in and num_iters
+        @param in_converge_window   int values per window of the test
+        @param in_converge_tol  float threshold of the test, None for the
+                                default of the method (see
+                                ConvergenceMonitor.DEFAULT_TOL)
+        @param in_converge_action   string on convergence "burn-in" ends
+                                    burn-in early, "stop" ends the run,
+                                    "both" ends burn-in first, then the run
+                                    when the series converges again
+        @param in_print_ll  int 0 to only record the likelihoods, not
+                            print them
+        @param in_collection_layout string storage of the per collection
+                            tables: "sparse" (rows for the (collection,
+                            word) pairs in training only), "dense" (rows
+                            for every pair) or "auto" to choose by density
+        @param in_dense_threshold   float fraction of pairs occurring from
+                            which "auto" chooses "dense"
     '''
     def __init__(self, in_train, in_test, in_out, in_k, in_l, in_a,\
-                        in_b, in_num_iters, in_num_burn_in):
+                        in_b, in_num_iters, in_num_burn_in, in_check_counts=0,\
+                        in_seed=None, in_sampler="exact", in_mh_steps=2,\
+                        in_workers=1, in_kernel=1, in_estimate_every=1,\
+                        in_estimate_after_burn_in=0, in_eval_every=1,\
+                        in_eval_train=1, in_thin=1, in_checkpoint=None,\
+                        in_checkpoint_every=None, in_metrics_jsonl=None,\
+                        in_metrics_port=0, in_converge=None,\
+                        in_converge_window=10, in_converge_tol=None,\
+                        in_converge_action="stop", in_print_ll=1,\
+                        in_collection_layout="auto", in_dense_threshold=DENSE_THRESHOLD):
+        if not isinstance(in_train, Corpus):
+            in_train = Corpus.from_lines(in_train)
+            in_train.get_vocab().freeze()
+        if not isinstance(in_test, Corpus):
+            in_test = Corpus.from_lines(in_test, in_train.get_vocab(), in_train.get_labels())
+        if in_test.get_vocab() is not in_train.get_vocab():
+            raise Exception("train and test corpus must share one Vocabulary")
+        # ids of the collections both corpora know must name the same labels
+        labels = [in_train.get_labels().get_tokens(), in_test.get_labels().get_tokens()]
+        num_shared = min(len(labels[0]), len(labels[1]))
+        if labels[0][:num_shared] != labels[1][:num_shared]:
+            raise Exception("train and test corpus must share the collection labels")
         self._train = in_train
         self._test = in_test
+        self._out = in_out
+        # records the likelihoods even without files to write
+        self._writer = OutputWriter(in_out)
         self._K = in_k
         self._l = in_l
         self._a = in_a
@@ -31,215 +122,629 @@ class CollapsedSampler(GibbsSampler):
         self._num_iters = in_num_iters
         self._num_burn_in = in_num_burn_in
 
-        self._c = 2     # TODO assumption: number of collections/corpuses
+        self._check_counts = in_check_counts
+        self._estimate_every = max(in_estimate_every, 1)
+        self._estimate_after_burn_in = bool(in_estimate_after_burn_in)
+        self._eval_every = in_eval_every
+        self._eval_train = bool(in_eval_train)
+        self._thin = max(in_thin, 1)
+        self._checkpoint = in_checkpoint
+        if in_checkpoint_every is None:
+            in_checkpoint_every = 0 if in_checkpoint is None else 1
+        self._checkpoint_every = in_checkpoint_every
+        # checkpoint directory holding this run's corpora, see checkpoint.py
+        self._checkpoint_source = None
+        self._print_ll = bool(in_print_ll)
+        if in_collection_layout not in LAYOUTS:
+            raise Exception("unknown collection layout " + str(in_collection_layout))
+        self._collection_layout = in_collection_layout
+        self._dense_threshold = in_dense_threshold
+        self._metrics_jsonl = in_metrics_jsonl
+        self._metrics_port = in_metrics_port
+        sinks = []
+        if in_metrics_jsonl is not None:
+            sinks.append(JsonLinesSink(in_metrics_jsonl))
+        if in_metrics_port > 0:
+            sinks.append(PrometheusSink(in_metrics_port))
+        self._metrics = Metrics(sinks)
+
+        if in_converge_action not in ["burn-in", "stop", "both"]:
+            raise Exception("unknown convergence action " + str(in_converge_action))
+        self._converge = in_converge
+        self._converge_window = in_converge_window
+        self._converge_tol = in_converge_tol
+        self._converge_action = in_converge_action
+        self._monitor = None
+        if in_converge is not None:
+            self._monitor = ConvergenceMonitor(in_converge, in_converge_window, in_converge_tol)
+        # iterations where convergence ended burn-in / the run, if it did
+        self._burn_in_end = None
+        self._stop_t = None
+        self._sampler = CategoricalSampler(in_seed)
+        self._rng = self._sampler.get_rng()
+        self._sampler_name = in_sampler
+        self._mh_steps = in_mh_steps
+        self._workers = in_workers
+        self._kernel = in_kernel
+        self._use_kernel = bool(in_kernel) and HAVE_KERNEL
+
+        if in_sampler == "exact":
+            self._z_sampler = None
+        elif in_sampler == "sparse":
+            self._z_sampler = SparseZSampler(self._sampler, in_k, in_a, in_b)
+        elif in_sampler == "alias":
+            self._z_sampler = AliasZSampler(self._sampler, in_k, in_a, in_b, in_mh_steps)
+        else:
+            raise Exception("unknown sampler " + str(in_sampler))
+
+        # number of collections/corpuses, ids are 0..C-1; test labels
+        # extend the train labels
+        self._c = max(in_train.get_num_collections(), in_test.get_num_collections(), 1)
 
         self._train_data = None
         self._test_data = None
+        # last completed iteration and whether phi was ever estimated
+        self._t = 0
+        self._estimated = False
+
+    '''
+        @return dict of the optional constructor keywords of this run,
+                minus the seed (the generator state is saved instead)
+    '''
+    def get_options(self):
+        return {"in_check_counts": self._check_counts, "in_sampler": self._sampler_name,
+                "in_mh_steps": self._mh_steps, "in_workers": self._workers,
+                "in_kernel": self._kernel, "in_estimate_every": self._estimate_every,
+                "in_estimate_after_burn_in": int(self._estimate_after_burn_in),
+                "in_eval_every": self._eval_every, "in_eval_train": int(self._eval_train),
+                "in_thin": self._thin, "in_checkpoint": self._checkpoint,
+                "in_checkpoint_every": self._checkpoint_every,
+                "in_metrics_jsonl": self._metrics_jsonl, "in_metrics_port": self._metrics_port,
+                "in_converge": self._converge, "in_converge_window": self._converge_window,
+                "in_converge_tol": self._converge_tol, "in_converge_action": self._converge_action,
+                "in_print_ll": int(self._print_ll),
+                "in_collection_layout": self._collection_layout,
+                "in_dense_threshold": self._dense_threshold}
+
+    '''
+        @return dict of the positional constructor params of this run
+    '''
+    def get_params(self):
+        return {"out": self._out, "k": self._K, "l": self._l, "a": self._a, "b": self._b,
+                "num_iters": self._num_iters, "num_burn_in": self._num_burn_in}
+
+    '''
+        @return OutputWriter of this run, it writes no files without an
+                output path
+    '''
+    def get_writer(self):
+        return self._writer
+
+    '''
+        @return int last completed iteration
+    '''
+    def get_t(self):
+        return self._t
+
+    '''
+        @return bool whether phi has been estimated yet
+    '''
+    def is_estimated(self):
+        return self._estimated
+
+    '''
+        @return CategoricalSampler every draw of this sampler goes through
+    '''
+    def get_categorical_sampler(self):
+        return self._sampler
+
+    '''
+        @return Data object holding the training set, None before
+                initialize_values
+    '''
+    def get_train_data(self):
+        return self._train_data
+
+    '''
+        @return Data object holding the test set, None before
+                initialize_values
+    '''
+    def get_test_data(self):
+        return self._test_data
+
+    '''
+        Puts the sampler back in the state of a checkpoint instead of
+        calling initialize_values
+        @param in_train_data    Data object holding the training set
+        @param in_test_data     Data object holding the test set, sharing
+                                phi and phi_c with in_train_data
+        @param in_t int last completed iteration
+        @param in_estimated bool whether phi has been estimated yet
+        @param in_sums  (theta, phi, phi_c) running sums of the posterior mean
+        @param in_num_samples   int number of estimates in in_sums
+    '''
+    def restore(self, in_train_data, in_test_data, in_t, in_estimated, in_sums, in_num_samples):
+        self._train_data = in_train_data
+        self._test_data = in_test_data
+        self._t = in_t
+        self._estimated = in_estimated
+        self._theta_sum, self._phi_sum, self._phi_c_sum = in_sums
+        self._num_samples = in_num_samples
+
+    '''
+        @return (theta, phi, phi_c) running sums of the posterior mean
+    '''
+    def get_posterior_sums(self):
+        return self._theta_sum, self._phi_sum, self._phi_c_sum
+
+    '''
+        @return dict of table name -> bytes of the posterior mean sums
+    '''
+    def get_posterior_nbytes(self):
+        sums = {"theta_sum": self._theta_sum, "phi_sum": self._phi_sum, "phi_c_sum": self._phi_c_sum}
+        return dict((name, int(table.nbytes)) for name, table in sums.items() if table is not None)
+
+    '''
+        @return dict of the model settings a worker needs to sweep a shard
+    '''
+    def get_settings(self):
+        return {"k": self._K, "l": self._l, "a": self._a, "b": self._b,
+                "c": self._c, "sampler": self._sampler_name,
+                "mh_steps": self._mh_steps, "kernel": self._kernel}
 
     '''
-        Runs the Gibbs Sampling Algorithm
+        Creates a sampler for part of the training set from get_settings()
+        @param in_train Corpus, the shard of the training set
+        @param in_settings  dict from get_settings
+        @param in_seed  int seed
+        @return CollapsedSampler
+    '''
+    @staticmethod
+    def from_settings(in_train, in_settings, in_seed):
+        cs = CollapsedSampler(in_train, in_train.slice(0, 0), None, in_settings["k"], in_settings["l"],
+                              in_settings["a"], in_settings["b"], 0, 0, in_seed=in_seed,
+                              in_sampler=in_settings["sampler"], in_mh_steps=in_settings["mh_steps"],
+                              in_kernel=in_settings["kernel"])
+        # the shard may not contain every collection label
+        cs._c = in_settings["c"]
+        return cs
+
+    '''
+        Runs the Gibbs Sampling Algorithm, continuing after the last
+        completed iteration if the sampler was restored from a checkpoint
     '''
     def algorithm(self):
-        # set all z and x values to random in {0,...,K-1} and {0,1}
-        # one per token
-        #print("initializing values")
-        self.initialize_values()
-
-        # TODO REMOVE
-
-        # for d in range(len(self._train)):
-        #     line = self._train[d]
-        #     c = int(line[0])
-        #     tokens = line[1:]
-        #     for i in range(len(tokens)):
-        #         token = tokens[i]
-        #         w = self._train_data.get_word_idx(token)
-        #         x = self._train_data.get_x_d_i(d, i)
-        #         z = self._train_data.get_z_d_i(d, i)
-
-        #         print(token)
-        #         print(self._train_data.get_n_d_k(d, z))
-        #         print(self._train_data.get_n_d_star(d))
-        #         print(self._train_data.get_n_k_w(z, w))
-        #         print(self._train_data.get_n_k_star(z))
-        #         print(self._train_data.get_n_ck_w(c, z, w))
-        #         print(self._train_data.get_n_ck_star(c, z))
-        #         print("")
-        #         pdb.set_trace()
-        #         sys.exit(0)
+        if self._train_data is None:
+            # set all z and x values to random in {0,...,K-1} and {0,1}
+            # one per token
+            #print("initializing values")
+            self.initialize_values()
+
+        parallel = None
+        if self._workers > 1:
+            parallel = ParallelSweeper(self, self._train_data, self._workers)
 
         #print("iterating")
         # go through T iterations
-        for t in range(1, self._num_iters + 1):
+        for t in range(self._t + 1, self._num_iters + 1):
+            if self._stop_t is not None:
+                break
             #print("iteration " + str(t))
-            # go through all training documents
-            #print("going through training docs")
-            for d in range(len(self._train)):
-                line = self._train[d]
-                c = int(line[0])
-                tokens = line[1:]
-                # go through all tokens
-                #print("doc " + str(d))
-                #print("BEFORE WE LOOP")
-                #print(self._train_data)
-                for i in range(len(tokens)):
-                    token = tokens[i]
-                    # update counts to exclude this token
-                    self._train_data.exclude_token(c, d, i, token) # CORRECT
-                    #print("AFTER EXLUDING")
-                    #print(self._train_data)
-                    # sample z_d_i according to Eq. 3
-                    curr_x_d_i = self._train_data.get_x_d_i(d, i) # CORRECT
-                    zdi_prob = self.calc_z_d_i(self._train_data, c, d, token, curr_x_d_i) # CORRECT
-                    zdi_class = self.sample(zdi_prob) # CORRECT
-                    self._train_data.set_z_d_i(d, i, zdi_class) # CORRECT
-                    # sample x_d_i according to Eq. 4 using above z_d_i
-                    xdi_prob = self.calc_x_d_i(self._train_data, c, d, token, zdi_class) # CORRECT
-                    xdi_val = self.sample(xdi_prob) # CORRECT
-                    #print(xdi_val)
-                    self._train_data.set_x_d_i(d, i, xdi_val) # CORRECT
-                    # update counts to include this token
-                    self._train_data.include_token(c, d, i, token, zdi_class, xdi_val) 
-                    #print("AFTER INCLUDING")
-                    #print(self._train_data)
-
-
-            #print("estimating training")
-            # estimate theta according to Eq. 5
+            self._metrics.begin_iteration(t, self._train_data)
+            self.iteration(t, parallel)
+            self._metrics.end_iteration(self._train_data, self._test_data, self.get_posterior_nbytes())
+            self._t = t
+
+            if self._checkpoint is not None and self._checkpoint_every > 0 \
+                    and (t % self._checkpoint_every == 0 or t == self._num_iters
+                         or self._stop_t is not None):
+                checkpoint.save_checkpoint(self, self._checkpoint)
+
+        if self._stop_t is not None and not self.is_estimate_iteration(self._stop_t):
+            # the run ended early, estimate from its last sample
             self.estimate_theta(self._train_data)
-            # estimate phi according to Eq. 6
             self.estimate_phi(self._train_data)
-            # estimate phi(c) according to Eq. 7
             self.estimate_phi_c(self._train_data)
-            # if burn period is passed
-            if t > self._num_burn_in:
-                # incorporate estimated params into estimate of expected val
-                # TODO
-                pass
-
-
-            #print("going through test")
-            # go through all testing documents
-            for d in range(len(self._test)):
-                line = self._test[d]
-                c = int(line[0])
-                tokens = line[1:]
-                # go through all tokens
-                for i in range(len(tokens)):
-                    token = tokens[i]
-                    # update counts to exclude this token
-                    self._test_data.exclude_token(c, d, i, token)
-                    # sample z_d_i according to Eq. 3
-                    curr_x_d_i = self._test_data.get_x_d_i(d, i)
-                    zdi_prob = self.calc_z_d_i_test(self._test_data, c, d, token, i, curr_x_d_i)
-                    zdi_class = self.sample(zdi_prob)
-                    self._test_data.set_z_d_i(d, i, zdi_class)
-                    # sample x_d_i according to Eq. 4 using above z_d_i
-                    xdi_prob = self.calc_x_d_i_test(self._test_data, c, d, token, i, zdi_class)
-                    xdi_val = self.sample(xdi_prob)
-                    self._test_data.set_x_d_i(d, i, xdi_val)
-                    # update counts to include this token
-                    self._test_data.include_token(c, d, i, token, zdi_class, xdi_val)
-
-            #print ("estimating theta param for test")
+
+        if parallel is not None:
+            parallel.close()
+
+        self._metrics.close()
+
+        # report the averaged parameters rather than the last sample
+        self.apply_posterior_mean()
+
+        if self._out is not None:
+            run = {"iterations": self._t, "burn_in_end": self._burn_in_end,
+                   "stop_iteration": self._stop_t}
+            self._writer.write(self._train_data, dict(self.get_settings(), **run))
+
+        return
+
+    '''
+        One iteration of the algorithm: training sweep, estimates, test
+        sweep and likelihoods
+        @param t    int iteration, from 1
+        @param parallel ParallelSweeper for the training sweep, or None
+    '''
+    def iteration(self, t, parallel=None):
+        # go through all training documents
+        #print("going through training docs")
+        with self._metrics.phase("train_sweep"):
+            if parallel is None:
+                self.sweep_train(self._train_data)
+            else:
+                parallel.sweep()
+
+        if self._check_counts > 0 and t % self._check_counts == 0:
+            self._train_data.check_counts()
+
+        if self.is_estimate_iteration(t):
+            with self._metrics.phase("estimate"):
+                #print("estimating training")
+                # estimate theta according to Eq. 5
+                self.estimate_theta(self._train_data)
+                # estimate phi according to Eq. 6
+                self.estimate_phi(self._train_data)
+                # estimate phi(c) according to Eq. 7
+                self.estimate_phi_c(self._train_data)
+            self._estimated = True
+        if not self._estimated:
+            # no phi yet to sample the test set against
+            return
+
+        # if burn period is passed
+        if self.is_sample_iteration(t):
+            # incorporate estimated params into estimate of expected val
+            self.accumulate_posterior_mean()
+
+
+        #print("going through test")
+        with self._metrics.phase("test_sweep"):
+            self.sweep_test_batched(self._test_data)
+
+        if not self.is_eval_iteration(t):
+            return
+
+        #print ("estimating theta param for test")
+        with self._metrics.phase("estimate"):
             self.estimate_theta(self._test_data)
-            self._test_data.set_phi(self._train_data._phi)
-            self._test_data.set_phi_c(self._train_data._phi_c)
-                    
-            # compute train log-likelihood described in 3.0.1
-            train_log_prob = self.compute_log_likelihood(self._train_data)
-            print(train_log_prob)
-            # compute test log-likelihood described in 3.0.1
+
+        # compute train log-likelihood described in 3.0.1
+        if self._eval_train:
+            with self._metrics.phase("likelihood"):
+                train_log_prob = self.compute_log_likelihood(self._train_data)
+            if self._print_ll:
+                print(train_log_prob)
+            self._writer.add_train_ll(t, train_log_prob)
+        # compute test log-likelihood described in 3.0.1
+        with self._metrics.phase("likelihood"):
             test_log_prob = self.compute_log_likelihood(self._test_data)
+        if self._print_ll:
             print(test_log_prob)
+        self._writer.add_test_ll(t, test_log_prob)
 
-        return
+        self.observe_convergence(t, train_log_prob if self._eval_train else test_log_prob)
+
+    '''
+        Feeds an evaluated log likelihood to the convergence test and ends
+        burn-in or the run once it converged
+        @param t    int iteration, from 1
+        @param in_ll    float log likelihood
+    '''
+    def observe_convergence(self, t, in_ll):
+        if self._monitor is None or self._stop_t is not None:
+            return
+        self._monitor.add(in_ll)
+        if not self._monitor.is_converged():
+            return
+        if self._converge_action != "stop" and self._burn_in_end is None and t < self._num_burn_in:
+            self._num_burn_in = t
+            self._burn_in_end = t
+            self._monitor.reset()
+            sys.stderr.write("burn-in converged at iteration " + str(t) + "\n")
+        elif self._converge_action != "burn-in":
+            self._stop_t = t
+            sys.stderr.write("converged, stopping at iteration " + str(t) + "\n")
+
+    '''
+        @return dict of the convergence state: burn_in_end, stop_iteration
+                (None unless convergence ended them) and the series values
+    '''
+    def get_convergence(self):
+        values = [] if self._monitor is None else list(self._monitor.get_values())
+        return {"burn_in_end": self._burn_in_end, "stop_iteration": self._stop_t, "values": values}
+
+    '''
+        Continues from get_convergence() of an earlier run
+        @param in_state dict from get_convergence
+    '''
+    def set_convergence(self, in_state):
+        self._burn_in_end = in_state["burn_in_end"]
+        self._stop_t = in_state["stop_iteration"]
+        if self._monitor is not None:
+            self._monitor.set_values(in_state["values"])
+
+    '''
+        @return string checkpoint directory last written or loaded, whose
+                corpus files are this run's, or None
+    '''
+    def get_checkpoint_source(self):
+        return self._checkpoint_source
+
+    '''
+        @param in_path  string checkpoint directory holding the corpus
+                        files of this run
+    '''
+    def set_checkpoint_source(self, in_path):
+        self._checkpoint_source = in_path
+
+    '''
+        @return int iteration where convergence ended the run, None if it
+                ran all num_iters
+    '''
+    def get_stop_iteration(self):
+        return self._stop_t
+
+    '''
+        @return int iteration where convergence ended burn-in, None if it
+                did not
+    '''
+    def get_burn_in_end(self):
+        return self._burn_in_end
+
+    '''
+        @param t    int iteration, from 1
+        @return bool whether theta / phi / phi_c are estimated after it
+    '''
+    def is_estimate_iteration(self, t):
+        # the last iteration always estimates, burn-in may cover the run
+        if self.is_sample_iteration(t) or t == self._num_iters:
+            return True
+        if self._estimate_after_burn_in and t <= self._num_burn_in:
+            return False
+        return t % self._estimate_every == 0
+
+    '''
+        @param t    int iteration, from 1
+        @return bool whether the estimates after it join the posterior mean
+    '''
+    def is_sample_iteration(self, t):
+        return t > self._num_burn_in and (t - self._num_burn_in) % self._thin == 0
+
+    '''
+        Clears the running sums of the posterior mean
+    '''
+    def reset_posterior_mean(self):
+        data = self._train_data
+        self._theta_sum = np.zeros_like(data.get_theta())
+        self._phi_sum = np.zeros_like(data.get_phi())
+        self._phi_c_sum = np.zeros_like(data.get_phi_c())
+        self._num_samples = 0
+
+    '''
+        Adds the current training estimates to the running sums
+    '''
+    def accumulate_posterior_mean(self):
+        data = self._train_data
+        self._theta_sum += data.get_theta()
+        self._phi_sum += data.get_phi()
+        self._phi_c_sum += data.get_phi_c()
+        self._num_samples += 1
+
+    '''
+        @return int number of estimates averaged so far
+    '''
+    def get_num_samples(self):
+        return self._num_samples
+
+    '''
+        @return float array (d x k) posterior mean of the training theta,
+                None before the first sample
+    '''
+    def get_theta_mean(self):
+        if self._num_samples == 0:
+            return None
+        return self._theta_sum / self._num_samples
+
+    '''
+        @return float array (k x w+1) posterior mean of phi, None before
+                the first sample
+    '''
+    def get_phi_mean(self):
+        if self._num_samples == 0:
+            return None
+        return self._phi_sum / self._num_samples
+
+    '''
+        @return float array (c x k x w+1) posterior mean of phi_c, None
+                before the first sample
+    '''
+    def get_phi_c_mean(self):
+        if self._num_samples == 0:
+            return None
+        return self._phi_c_sum / self._num_samples
+
+    '''
+        Replaces the training theta, phi and phi_c (shared with the test
+        set) by their posterior means, if any sample was taken
+    '''
+    def apply_posterior_mean(self):
+        if self._num_samples == 0:
+            return
+        data = self._train_data
+        np.divide(self._theta_sum, self._num_samples, out=data.get_theta())
+        np.divide(self._phi_sum, self._num_samples, out=data.get_phi())
+        np.divide(self._phi_c_sum, self._num_samples, out=data.get_phi_c())
+
+    '''
+        @param t    int iteration, from 1
+        @return bool whether the likelihoods are printed after it
+    '''
+    def is_eval_iteration(self, t):
+        if self._eval_every <= 0:
+            return False
+        return t % self._eval_every == 0 or t == self._num_iters
+
+    '''
+        One Gibbs sweep over all training documents
+        @param in_data  Data object holding the training set
+    '''
+    def sweep_train(self, in_data):
+        if self._use_kernel:
+            self.sweep_train_compiled(in_data)
+            return
+
+        z_sampler = self._z_sampler
+        if z_sampler is not None:
+            z_sampler.begin_sweep(in_data, self._c)
+        corpus = in_data.get_corpus()
+        words = corpus.get_words()
+        offsets = corpus.get_offsets()
+        doc_c = corpus.get_doc_c()
+        for d in range(corpus.get_num_docs()):
+            c = int(doc_c[d])
+            start, end = int(offsets[d]), int(offsets[d + 1])
+            self._sampler.prefetch(2 * (end - start))
+            if z_sampler is not None:
+                z_sampler.begin_document(c, d)
+            # go through all tokens
+            for n in range(start, end):
+                word_idx = int(words[n])
+                # update counts to exclude this token
+                old_z_d_i = int(in_data.get_z()[n])
+                in_data.exclude_token(c, d, n) # CORRECT
+                # sample z_d_i according to Eq. 3
+                curr_x_d_i = in_data.get_x()[n] # CORRECT
+                if z_sampler is None:
+                    zdi_prob = self.calc_z_d_i(in_data, c, d, word_idx, curr_x_d_i) # CORRECT
+                    zdi_class = self.sample(zdi_prob) # CORRECT
+                else:
+                    z_sampler.exclude(c, d, word_idx, old_z_d_i)
+                    zdi_class = z_sampler.sample(c, d, word_idx, curr_x_d_i, old_z_d_i)
+                # sample x_d_i according to Eq. 4 using above z_d_i
+                xdi_prob = self.calc_x_d_i(in_data, c, d, word_idx, zdi_class) # CORRECT
+                xdi_val = self._sampler.bernoulli(xdi_prob[0], xdi_prob[1]) # CORRECT
+                # update counts to include this token
+                in_data.include_token(c, d, n, zdi_class, xdi_val)
+                if z_sampler is not None:
+                    z_sampler.include(c, d, word_idx, zdi_class)
+
+    '''
+        One training sweep in the compiled kernel of the z sampler, the
+        same conditionals as the Python path
+        @param in_data  Data object holding the training set
+    '''
+    def sweep_train_compiled(self, in_data):
+        if self._z_sampler is not None:
+            self._z_sampler.sweep_compiled(in_data, self._l, self._rng)
+            return
+        corpus = in_data.get_corpus()
+        uniforms = self._rng.random(2 * corpus.get_num_tokens())
+        sweep_tokens(corpus.get_words(), corpus.get_offsets(), corpus.get_doc_c(), in_data.get_slots(),
+                     in_data.get_z(), in_data.get_x(), in_data._ndk_map, in_data._nckw_map,
+                     in_data._nckw_map_star, in_data._nkw_map, in_data._nkw_map_star,
+                     float(self._l), float(self._a), float(self._b),
+                     float(in_data.get_V() * self._b), uniforms)
+
+    '''
+        One Gibbs sweep over held-out documents, all documents at once
+        Given the fixed phi / phi_c the documents are independent, so
+        step i resamples token i of every document at least i + 1 tokens
+        long with one row per document (Eq. 3 / 4 with phi / phi_c in
+        place of the counts). Each document still visits its tokens in
+        order.
+        @param in_data  Data object holding the held-out set
+    '''
+    def sweep_test_batched(self, in_data):
+        corpus = in_data.get_corpus()
+        words = corpus.get_words()
+        offsets = corpus.get_offsets()
+        z = in_data.get_z()
+        x = in_data.get_x()
+        ndk = in_data.get_ndk_map()
+        phi = in_data.get_phi()
+        phi_c = in_data.get_phi_c()
+        slots = in_data.get_slots()
+
+        # longest documents first, so the active ones are a prefix
+        lengths = np.diff(offsets)
+        order = np.argsort(-lengths, kind="stable")
+        starts = offsets[:-1][order]
+        # number of documents longer than i, for every i
+        num_active = np.searchsorted(-lengths[order], -np.arange(lengths.max(initial=0)), side="left")
+
+        for i in range(len(num_active)):
+            m = num_active[i]
+            docs = order[:m]
+            n = starts[:m] + i
+            w = words[n]
+            s = slots[n]
+            # update counts to exclude these tokens
+            ndk[docs, z[n]] -= 1
+            # sample z according to Eq. 3, global or collection phi by x
+            second_term = np.where((x[n] == 0)[:, None], phi[:, w].T, phi_c[s])
+            new_z = self._sampler.sample_rows((ndk[docs] + self._a) * second_term)
+            # sample x according to Eq. 4 using the new z
+            p0 = (1 - self._l) * phi[new_z, w]
+            p1 = self._l * phi_c[s, new_z]
+            u = self._rng.random(m)
+            x[n] = (u * (p0 + p1) >= p0).astype(np.int32)
+            z[n] = new_z
+            # update counts to include these tokens
+            ndk[docs, new_z] += 1
 
     '''
         Initializes values for x, z, vocab, V, and nwk map
     '''
     def initialize_values(self):
 
-        raw_datas = [self._train, self._test]
+        # the OOV idx of the shared vocab is column V of every w table
+        V = len(self._train.get_vocab())
+
+        # one per collection row for every (collection, word) pair of the
+        # training set (or of the vocab, if dense), plus the unseen row of
+        # every collection
+        slot_map = build_slot_map(self._train.get_token_c(), self._train.get_words(), self._c, V,
+                                  self._collection_layout, self._dense_threshold)
+
+        # create phi, k x w, and phi_c, s x k, shared with the test set
+        phi = np.zeros((self._K, V + 1))
+        phi_c = np.zeros((slot_map.get_num_slots(), self._K))
+
         datas = []
+        for corpus in [self._train, self._test]:
+            words = corpus.get_words()
+            num_docs = corpus.get_num_docs()
 
-        for raw_data in raw_datas:
-            _vocab = set()
-            _vocab_map = {}
-            _vocab_map_idx = 0
-            _x, _z = [], []         # x and z values
-            _nckw_map = []           # c x k x w array for num counts
-            _nckw_map_star = []      # c x k x i array for num counts !!
-            _ndk_map = []           # d x k array for num counts
-
-            # create vocab
-            for line in raw_data:
-                tokens = line[1:]
-                for token in tokens:
-                    if token not in _vocab:
-                        _vocab_map[token] = _vocab_map_idx
-                        _vocab_map_idx += 1
-                        _vocab.add(token)
-
-            # for all corpuses
-            for c in range(self._c):
-                _nckw_map.append([])
-                _nckw_map_star.append([]) # !!
-                # for all topics
-                for k in range(self._K):
-                    _nckw_map[c].append([0 for _ in range(len(_vocab_map))])
-                    _nckw_map_star[c].append(0) # !!
-            
-            # for every line in the raw data
-            i = -1
-            for line in raw_data:
-                i += 1
-                c = int(line[0])
-                tokens = line[1:]
-                doc_x = []
-                doc_z = []
-
-                _ndk_map.append([0 for _ in range(self._K)])
-                for token in tokens:
-                    x_val = random.randint(0, 1)
-                    doc_x.append(x_val)
-                    z = random.randint(0, self._K - 1)
-                    doc_z.append(z)
-
-                    # update ndk map
-                    _ndk_map[i][z] = _ndk_map[i][z] + 1
-
-                    # update nwk map
-                    token_idx = _vocab_map[token]
-                    _nckw_map[c][z][token_idx] = _nckw_map[c][z][token_idx] + 1
-
-                    # update nckw_map_star
-                    _nckw_map_star[c][z] = _nckw_map_star[c][z] + 1 # !!
-
-                _x.append(doc_x)
-                _z.append(doc_z)
+            # x and z values, one per token
+            _x = self._rng.integers(2, size=len(words)).astype(np.int32)
+            _z = self._rng.integers(self._K, size=len(words)).astype(np.int32)
+
+            # d x k counts
+            _ndk_map = np.zeros((num_docs, self._K), dtype=np.int32)
+            np.add.at(_ndk_map, (corpus.get_token_docs(), _z), 1)
 
             # create theta, d x k
-            theta = []
-            for d in range(len(raw_data)):
-                theta.append([0.0 for _ in range(self._K)])
-
-            # create phi, k x w
-            phi = []
-            for k in range(self._K):
-                phi.append([0.0 for _ in range(len(_vocab))])
-
-            # create phi_c, c x k x w
-            phi_c = []
-            for c in range(self._c):
-                phi_c.append([])
-                for k in range(self._K):
-                    phi_c[c].append([0.0 for _ in range(len(_vocab))])
-                
-            _data = Data(raw_data, list(_vocab), _x, _z, _ndk_map, _nckw_map, _nckw_map_star, theta, phi, phi_c, _vocab_map) # !!
-            datas.append(_data)
+            theta = np.zeros((num_docs, self._K))
+
+            if corpus is self._train:
+                # s x k and c x k counts, k x w and k counts are derived in Data
+                _nckw_map = np.zeros((slot_map.get_num_slots(), self._K), dtype=np.int32)
+                np.add.at(_nckw_map, (slot_map.get_slots(corpus.get_token_c(), words), _z), 1)
+                _nckw_map_star = np.zeros((self._c, self._K), dtype=np.int32)
+                slot_map.sum_collections(_nckw_map, _nckw_map_star)
+            else:
+                # held-out documents are sampled against the training phi
+                _nckw_map, _nckw_map_star = None, None
+
+            datas.append(Data(corpus, _x, _z, _ndk_map, _nckw_map, _nckw_map_star, theta, phi, phi_c,
+                              slot_map))
         self._train_data = datas[0]
         self._test_data = datas[1]
+        self._t = 0
+        self._estimated = False
+        self.reset_posterior_mean()
 
         return
 
@@ -249,176 +754,102 @@ class CollapsedSampler(GibbsSampler):
         @param in_data  Data object holding data for that set
         @param in_c     int corpus number
         @param in_d     int document number
-        @param in_token     string token
-        @param in_x_d_i     int whether we use corpus or global counts
-    '''
-    def calc_z_d_i(self, in_data, in_c, in_d, in_token, in_x_d_i):
-        # TODO need to change depending on data (i.e. use phi from train when it's test)
-        
-        prob_z_k = [0 for _ in range(self._K)]
-        word_idx = in_data.get_word_idx(in_token)
-        # USE GLOBAL COUNTS
-        if (in_x_d_i == 0):
-            for k in range(self._K):
-                first_term = float( in_data.get_n_d_k(in_d, k) + self._a ) / float( in_data.get_n_d_star(in_d) + ( self._K * self._a ) )
-                second_term = float( in_data.get_n_k_w(k, word_idx) + self._b ) / float( in_data.get_n_k_star(k) + ( in_data.get_V() * self._b) )
-                prob_z_k[k] = first_term * second_term
-        # USE CORPUS SPECIFIC COUNTS
-        elif (in_x_d_i == 1):
-            for k in range(self._K):
-                first_term = float( in_data.get_n_d_k(in_d, k) + self._a ) / float( in_data.get_n_d_star(in_d) + ( self._K * self._a ) )
-                second_term = float( in_data.get_n_ck_w(in_c, k, word_idx) + self._b ) / float( in_data.get_n_ck_star(in_c, k) + ( in_data.get_V() * self._b) )
-                prob_z_k[k] = first_term * second_term
-
-        return prob_z_k
-
-
-    '''
-        According to Eq. 3 on assignment page EXCEPT WITH PHI REPLACED FOR THE TEST DATA
-        p(z_d_i) prop to (ndk + a / nd* + Ka) * (nkw + b / nk* + Vb)
-        @param in_data  Data object holding data for that set
-        @param in_c     int corpus number
-        @param in_d     int document number
-        @param in_token     string token
-        @param in_i         ith iteration of dth document
+        @param in_w     int word idx
         @param in_x_d_i     int whether we use corpus or global counts
     '''
-    def calc_z_d_i_test(self, in_data, in_c, in_d, in_token, in_i, in_x_d_i):
-        prob_z_k = [0 for _ in range(self._K)]
-        word = in_token
-        word_idx = in_data.get_word_idx(word)
+    def calc_z_d_i(self, in_data, in_c, in_d, in_w, in_x_d_i):
+        word_idx = in_w
+        first_term = ( in_data.get_n_d_k_vec(in_d) + self._a ) / float( in_data.get_n_d_star(in_d) + ( self._K * self._a ) )
         # USE GLOBAL COUNTS
         if (in_x_d_i == 0):
-            for k in range(self._K):
-                first_term = float( in_data.get_n_d_k(in_d, k) + self._a ) / float( in_data.get_n_d_star(in_d) + ( self._K * self._a ) )
-                second_term = in_data.get_phi_k_w(k, word_idx)
-                prob_z_k[k] = first_term * second_term
+            second_term = ( in_data.get_n_k_w_vec(word_idx) + self._b ) / ( in_data.get_n_k_star_vec() + ( in_data.get_V() * self._b) )
         # USE CORPUS SPECIFIC COUNTS
-        elif (in_x_d_i == 1):
-            for k in range(self._K):
-                first_term = float( in_data.get_n_d_k(in_d, k) + self._a ) / float( in_data.get_n_d_star(in_d) + ( self._K * self._a ) )
+        else:
+            second_term = ( in_data.get_n_ck_w_vec(in_c, word_idx) + self._b ) / ( in_data.get_n_ck_star_vec(in_c) + ( in_data.get_V() * self._b) )
 
-                second_term = in_data.get_phi_ck_w(in_c, k, word_idx)
-                prob_z_k[k] = first_term * second_term
+        return first_term * second_term
 
-        return prob_z_k
 
     '''
         According to Eq. 4 on assignment page
         @param data Data object holding data for that set
         @param in_c     int corpus number
         @param in_d     int document number
-        @param in_token     string token
+        @param in_w     int word idx
         @param in_z_d_i int class for ith token of doc d chosen
     '''
-    def calc_x_d_i(self, in_data, in_c, in_d, in_token, in_z_d_i):
-        word_idx = in_data.get_word_idx(in_token)
+    def calc_x_d_i(self, in_data, in_c, in_d, in_w, in_z_d_i):
+        word_idx = in_w
         p0 = float( 1 - self._l ) * float(in_data.get_n_k_w(in_z_d_i, word_idx) + self._b) / float( in_data.get_n_k_star(in_z_d_i) + in_data.get_V() * self._b )
         p1 = float(self._l) * float(in_data.get_n_ck_w(in_c, in_z_d_i, word_idx) + self._b) / float( in_data.get_n_ck_star(in_c, in_z_d_i) + in_data.get_V() * self._b )
         return [p0, p1]
 
 
-    '''
-        According to Eq. 4 on assignment page EXCEPT PHI IS REPLACED FOR THE TEST
-        @param data Data object holding data for that set
-        @param in_c     int corpus number
-        @param in_d     int document number
-        @param in_token     string token
-        @param in_i         ith iteration of dth document
-        @param in_z_d_i int class for ith token of doc d chosen
-    '''
-    def calc_x_d_i_test(self, in_data, in_c, in_d, in_token, in_i, in_z_d_i):
-        word = in_token
-        word_idx = in_data.get_word_idx(word)
-        p0 = float( 1 - self._l ) * in_data.get_phi_k_w(in_z_d_i, word_idx)
-        p1 = float(self._l) * in_data.get_phi_ck_w(in_c, in_z_d_i, word_idx)
-        return [p0, p1]
-
     '''
         Samples from a probability distribution by uniformly
         sampling from the cdf.
-        @param prob_dist    List of probabilities
+        @param prob_dist    List or array of unnormalized probabilities
         @return index
     '''
     def sample(self, prob_dist):
-        '''
-        # TODO maybe sample can be changed
-        prob_sum = sum(prob_dist)
-
-        #if (prob_sum < math.exp(-20)):
-        #    print("Unusually small probability distribution")
-
-        choice = random.uniform(0, prob_sum)
-        running_sum = prob_sum
-        for i in range(len(prob_dist)):
-            if (running_sum <= choice):
-                return i
-
-            running_sum -= prob_dist[i]
-
-        return len(prob_dist) - 1
-        '''
-        prob_sum = sum(prob_dist)
-        if (prob_sum == 0):
-            prob_sum = 1
-        prob_dist_norm = [prob / float(prob_sum) for prob in prob_dist]
-        sampl = np.random.multinomial(1, prob_dist_norm)
-        return np.ndarray.tolist(sampl).index(1)
+        return self._sampler.sample(prob_dist)
 
     '''
         Estimates theta according to Eq 5
         @param in_data  Data object for all data
     '''
     def estimate_theta(self, in_data):
-        for in_d in range(len(in_data.get_raw_data())):
-            for in_k in range(self._K):
-                num = in_data.get_n_d_k(in_d, in_k) + self._a
-                denom = in_data.get_n_d_star(in_d) + (self._K * self._a)
-                theta_d_k = float(num) / float(denom)
-                in_data.set_theta_d_k(in_d, in_k, theta_d_k)
-                if (theta_d_k < 0):
-                    print("negative theta")
-                    sys.exit(1)
-        
+        theta = in_data.get_theta()
+        denom = in_data.get_n_d_star_vec() + (self._K * self._a)
+        np.add(in_data.get_ndk_map(), self._a, out=theta)
+        theta /= denom[:, None]
+
     '''
         Estimates phi according to Eq 6
         @param in_data  Data object for all data
     '''
     def estimate_phi(self, in_data):
-        for in_k in range(self._K):
-            for in_w in range(len(in_data.get_vocab())):
-                num = in_data.get_n_k_w(in_k, in_w) + self._b
-                denom = in_data.get_n_k_star(in_k) + (in_data.get_V() * self._b)
-                in_data.set_phi_k_w(in_k, in_w, float(num)/float(denom))
+        phi = in_data.get_phi()
+        denom = in_data.get_n_k_star_vec() + (in_data.get_V() * self._b)
+        np.add(in_data.get_nkw_map(), self._b, out=phi)
+        phi /= denom[:, None]
 
     '''
         Estimates phi_c according to Eq 7
         @param in_data  Data object for all data
     '''
     def estimate_phi_c(self, in_data):
-        for in_c in range(self._c):
-            for in_k in range(self._K):
-                for in_w in range(len(in_data.get_vocab())):
-                    num = in_data.get_n_ck_w(in_c, in_k, in_w) + self._b
-                    denom = in_data.get_n_ck_star(in_c, in_k) + (in_data.get_V() * self._b)
-                    in_data.set_phi_ck_w(in_c, in_k, in_w, float(num) / float(denom))
+        phi_c = in_data.get_phi_c()
+        denom = in_data.get_nckw_map_star() + (in_data.get_V() * self._b)
+        np.add(in_data.get_nckw_map(), self._b, out=phi_c)
+        # every slot row by the totals of its collection
+        phi_c /= denom[in_data.get_slot_map().get_slot_c()]
 
     '''
         Calculates the log likelihood according to Eq 8
+        Tokens are scored in blocks of LL_BLOCK so the gathered
+        k x block tables stay small.
+        @param in_data  Data object with theta, phi and phi_c estimated
+        @return float log likelihood of every token of in_data
     '''
     def compute_log_likelihood(self, in_data):
-        ret = 0
-        for d in range(len(in_data.get_raw_data())):
-            c = int(in_data.get_raw_data()[d][0])
-            for i in range(1, len(in_data.get_raw_data()[d])):
-                word = in_data.get_raw_data()[d][i]
-                word_idx = in_data.get_word_idx(word)
-                log_term = 0
-                for z in range(self._K):
-                    log_term += in_data.get_theta_d_k(d, z) * ((1 - self._l) * in_data.get_phi_k_w(z, word_idx) + self._l * in_data.get_phi_ck_w(c, z, word_idx))
-                    if (log_term <= 0):
-                        print("negative log term")
-                        sys.exit(1)
-                log_term = math.log(log_term)
-                ret += log_term
-        return ret
+        corpus = in_data.get_corpus()
+        words = corpus.get_words()
+        docs = corpus.get_token_docs()
+        slots = in_data.get_slots()
+        theta = in_data.get_theta()
+        phi = in_data.get_phi()
+        phi_c = in_data.get_phi_c()
+
+        ret = 0.0
+        for start in range(0, len(words), CollapsedSampler.LL_BLOCK):
+            end = start + CollapsedSampler.LL_BLOCK
+            w = words[start:end]
+            mix = phi[:, w].T * (1 - self._l)
+            mix += phi_c[slots[start:end]] * self._l
+            p = np.einsum("nk,nk->n", theta[docs[start:end]], mix)
+            if (p <= 0).any():
+                print("negative log term")
+                sys.exit(1)
+            ret += np.log(p).sum()
+        return float(ret)
@@ -0,0 +1,86 @@
+import numpy as np
+
+'''
+    Convergence test of a log likelihood series
+
+    "window"    the mean of the last window values differs from the mean
+                of the window before by less than tol, relative
+    "geweke"    Geweke's z score of the last 2 x window values, the first
+                10% against the last 50%, is below tol in absolute value
+                (plain sample variances, no spectral correction)
+'''
+class ConvergenceMonitor:
+
+    METHODS = ["window", "geweke"]
+
+    # tol of each method when none is given: a relative change for
+    # "window", a |z| bound (about 95% two-sided) for "geweke"
+    DEFAULT_TOL = {"window": 1e-4, "geweke": 2.0}
+
+    '''
+        @param in_method    string "window" or "geweke"
+        @param in_window    int values per window
+        @param in_tol       float relative change ("window") or z score
+                            ("geweke") below which the series converged,
+                            None for the default of the method
+    '''
+    def __init__(self, in_method="window", in_window=10, in_tol=None):
+        if in_method not in ConvergenceMonitor.METHODS:
+            raise Exception("unknown convergence method " + str(in_method) +
+                            ", expected one of " + ", ".join(ConvergenceMonitor.METHODS))
+        self._method = in_method
+        self._window = max(in_window, 2)
+        self._tol = ConvergenceMonitor.DEFAULT_TOL[in_method] if in_tol is None else in_tol
+        self._values = []
+
+    '''
+        Adds the next value of the series
+        @param in_value float log likelihood
+    '''
+    def add(self, in_value):
+        self._values.append(in_value)
+
+    '''
+        Forgets the series, e.g. once burn-in ended
+    '''
+    def reset(self):
+        self._values = []
+
+    '''
+        @return float statistic compared with tol, None while fewer than
+                2 x window values were added
+    '''
+    def statistic(self):
+        if len(self._values) < 2 * self._window:
+            return None
+        values = np.array(self._values[-2 * self._window:])
+        if self._method == "window":
+            before = values[:self._window].mean()
+            last = values[self._window:].mean()
+            return abs(last - before) / max(abs(before), 1e-300)
+        first = values[:max(len(values) // 10, 2)]
+        second = values[len(values) // 2:]
+        var = first.var(ddof=1) / len(first) + second.var(ddof=1) / len(second)
+        if var == 0:
+            return 0.0
+        return abs(first.mean() - second.mean()) / np.sqrt(var)
+
+    '''
+        @return bool whether the series converged
+    '''
+    def is_converged(self):
+        stat = self.statistic()
+        return stat is not None and stat < self._tol
+
+    '''
+        @return list of float, the series since the last reset
+    '''
+    def get_values(self):
+        return self._values
+
+    '''
+        Continues a series of an earlier monitor
+        @param in_values    list of float
+    '''
+    def set_values(self, in_values):
+        self._values = list(in_values)
@@ -0,0 +1,270 @@
+from array import array
+import hashlib, os
+import numpy as np
+from vocab import Vocabulary
+
+'''
+    Corpus encoded once as flat token arrays
+
+    The tokens of all documents are stored back to back: document d holds
+    tokens offsets[d] .. offsets[d + 1] - 1 of words, and its collection
+    is doc_c[d]. Per token state (z, x) is kept by Data in the same flat
+    layout.
+
+    Collection labels are arbitrary strings ("0", "news", ..) mapped to
+    dense ids 0..C-1 by a Vocabulary of labels, in order of first
+    appearance, the same way words are mapped to word idx. When every
+    label of a new label vocabulary is an integer the ids follow numeric
+    order instead, so label "1" gets id 1 whatever document comes first.
+'''
+class Corpus:
+
+    # bytes read at a time when hashing an input file
+    HASH_BLOCK = 1 << 20
+
+    # version of the cached encoding, part of the cache key
+    CACHE_VERSION = 2
+
+    '''
+        Creates a corpus from already encoded arrays
+        @param in_words     int32 array (# tokens) of word idx
+        @param in_offsets   int64 array (d + 1) of token offsets
+        @param in_doc_c     int32 array (d) collection of each document
+        @param in_vocab     Vocabulary the word idx refer to
+        @param in_labels    Vocabulary of collection labels the doc_c ids
+                            refer to, or None for labels "0".."C-1"
+    '''
+    def __init__(self, in_words, in_offsets, in_doc_c, in_vocab, in_labels=None):
+        self._words = in_words
+        self._offsets = in_offsets
+        self._doc_c = in_doc_c
+        self._vocab = in_vocab
+        if in_labels is None:
+            num = int(in_doc_c.max()) + 1 if len(in_doc_c) else 0
+            in_labels = Vocabulary([str(c) for c in range(num)])
+        self._labels = in_labels
+
+    '''
+        Encodes documents, growing the vocab with every new token unless
+        it is frozen (then unseen tokens get its OOV idx)
+        Word idx go straight into growable typed arrays, so no per token
+        Python object outlives its line.
+        @param in_lines iterable of lists of [classification words],
+                        empty lists are skipped
+        @param in_vocab Vocabulary to encode with, or None for a new one
+        @param in_labels    Vocabulary of collection labels to encode with,
+                            or None for a new one (numbered in numeric
+                            order if every label is an integer); a frozen
+                            one maps unknown labels to id C
+        @return Corpus
+    '''
+    @staticmethod
+    def from_lines(in_lines, in_vocab=None, in_labels=None):
+        vocab = Vocabulary() if in_vocab is None else in_vocab
+        labels = Vocabulary() if in_labels is None else in_labels
+        add = vocab.add
+        words = array("i")
+        offsets = array("q", [0])
+        doc_c = array("i")
+        for line in in_lines:
+            if not line:
+                continue
+            doc_c.append(labels.add(line[0]))
+            words.extend(map(add, line[1:]))
+            offsets.append(len(words))
+        doc_c = np.frombuffer(doc_c, dtype=np.int32).copy()
+        if in_labels is None:
+            labels, doc_c = Corpus._sort_integer_labels(labels, doc_c)
+        return Corpus(np.frombuffer(words, dtype=np.int32).copy(),
+                      np.frombuffer(offsets, dtype=np.int64).copy(), doc_c, vocab, labels)
+
+    '''
+        Renumbers the ids of integer labels in numeric order
+        @param in_labels    Vocabulary of collection labels
+        @param in_doc_c     int32 array (d) collection of each document
+        @return (Vocabulary, int32 array (d)), unchanged if any label is
+                not an integer
+    '''
+    @staticmethod
+    def _sort_integer_labels(in_labels, in_doc_c):
+        tokens = in_labels.get_tokens()
+        try:
+            values = [int(token) for token in tokens]
+        except ValueError:
+            return in_labels, in_doc_c
+        order = sorted(range(len(tokens)), key=lambda c: values[c])
+        new_id = np.empty(len(tokens), dtype=np.int32)
+        new_id[order] = np.arange(len(tokens), dtype=np.int32)
+        labels = Vocabulary([tokens[c] for c in order])
+        if in_labels.is_frozen():
+            labels.freeze()
+        return labels, new_id[in_doc_c]
+
+    '''
+        Encodes a file of "classification words" lines, reading it once
+        line by line
+        @param in_path  string input file
+        @param in_vocab Vocabulary to encode with, or None for a new one
+        @param in_cache_dir string directory caching encoded files by the
+                            hash of their contents (and of in_vocab and
+                            in_labels), or None to always encode
+        @param in_labels    Vocabulary of collection labels, or None for a
+                            new one
+        @return Corpus
+    '''
+    @staticmethod
+    def from_file(in_path, in_vocab=None, in_cache_dir=None, in_labels=None):
+        if in_cache_dir is None:
+            with open(in_path) as f:
+                return Corpus.from_lines((line.split() for line in f), in_vocab, in_labels)
+
+        cache_path = os.path.join(in_cache_dir, Corpus.cache_key(in_path, in_vocab, in_labels) + ".npz")
+        if os.path.exists(cache_path):
+            return Corpus.load_cache(cache_path, in_vocab, in_labels)
+
+        corpus = Corpus.from_file(in_path, in_vocab, None, in_labels)
+        if not os.path.isdir(in_cache_dir):
+            os.makedirs(in_cache_dir)
+        # write under another name first, a partial file is never loaded
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, words=corpus._words, offsets=corpus._offsets, doc_c=corpus._doc_c,
+                     tokens=np.array(corpus._vocab.get_tokens(), dtype=str),
+                     labels=np.array(corpus._labels.get_tokens(), dtype=str))
+        os.replace(tmp_path, cache_path)
+        return corpus
+
+    '''
+        @param in_path  string input file
+        @param in_vocab Vocabulary the file would be encoded with, or None
+        @param in_labels    Vocabulary of collection labels, or None
+        @return string hex digest of the file contents and the vocabs
+    '''
+    @staticmethod
+    def cache_key(in_path, in_vocab=None, in_labels=None):
+        h = hashlib.sha1(("v" + str(Corpus.CACHE_VERSION) + "\n").encode("utf-8"))
+        with open(in_path, "rb") as f:
+            for block in iter(lambda: f.read(Corpus.HASH_BLOCK), b""):
+                h.update(block)
+        if in_vocab is not None:
+            h.update(("\n".join(in_vocab.get_tokens()) + "\n" + str(in_vocab.is_frozen())).encode("utf-8"))
+        if in_labels is not None:
+            h.update(("\nlabels\n" + "\n".join(in_labels.get_tokens()) + "\n" +
+                      str(in_labels.is_frozen())).encode("utf-8"))
+        return h.hexdigest()
+
+    '''
+        Loads a corpus written by from_file
+        @param in_cache_path    string .npz file
+        @param in_vocab Vocabulary the file was encoded with, or None to
+                        rebuild the one it created
+        @param in_labels    Vocabulary of collection labels the file was
+                            encoded with, or None to rebuild its own
+        @return Corpus
+    '''
+    @staticmethod
+    def load_cache(in_cache_path, in_vocab=None, in_labels=None):
+        with np.load(in_cache_path) as cached:
+            vocab = Corpus._grow(in_vocab, cached["tokens"].tolist())
+            labels = Corpus._grow(in_labels, cached["labels"].tolist())
+            return Corpus(cached["words"], cached["offsets"], cached["doc_c"], vocab, labels)
+
+    '''
+        @param in_vocab Vocabulary a cached file was encoded with, or None
+        @param in_tokens    list of strings, the tokens it held afterwards
+        @return Vocabulary holding in_tokens
+    '''
+    @staticmethod
+    def _grow(in_vocab, in_tokens):
+        if in_vocab is None:
+            return Vocabulary(in_tokens)
+        # tokens the file added to an unfrozen vocab
+        for token in in_tokens[len(in_vocab):]:
+            in_vocab.add(token)
+        return in_vocab
+
+    '''
+        @return int number of documents
+    '''
+    def get_num_docs(self):
+        return len(self._doc_c)
+
+    '''
+        @return int number of tokens over all documents
+    '''
+    def get_num_tokens(self):
+        return len(self._words)
+
+    '''
+        @return int32 array (# tokens) of word idx
+    '''
+    def get_words(self):
+        return self._words
+
+    '''
+        @return int64 array (d + 1) of token offsets
+    '''
+    def get_offsets(self):
+        return self._offsets
+
+    '''
+        @return int32 array (d) of collection ids
+    '''
+    def get_doc_c(self):
+        return self._doc_c
+
+    '''
+        @return int number of collections C, ids are 0..C-1
+    '''
+    def get_num_collections(self):
+        return len(self._labels)
+
+    '''
+        @return Vocabulary of collection labels, position = collection id
+    '''
+    def get_labels(self):
+        return self._labels
+
+    '''
+        @param in_d int document number
+        @return int collection of document d
+    '''
+    def get_c(self, in_d):
+        return int(self._doc_c[in_d])
+
+    '''
+        @param in_d int document number
+        @return int32 array word idx of the tokens of document d
+    '''
+    def get_doc_words(self, in_d):
+        return self._words[self._offsets[in_d]:self._offsets[in_d + 1]]
+
+    '''
+        @return int32 array (# tokens) document of every token
+    '''
+    def get_token_docs(self):
+        return np.repeat(np.arange(len(self._doc_c), dtype=np.int32), np.diff(self._offsets))
+
+    '''
+        @return int32 array (# tokens) collection of every token
+    '''
+    def get_token_c(self):
+        return np.repeat(self._doc_c, np.diff(self._offsets))
+
+    '''
+        @return Vocabulary the word idx refer to
+    '''
+    def get_vocab(self):
+        return self._vocab
+
+    '''
+        Documents start .. end - 1 as a corpus sharing these arrays
+        @param in_start int first document
+        @param in_end   int one past the last document
+        @return Corpus
+    '''
+    def slice(self, in_start, in_end):
+        first = self._offsets[in_start]
+        return Corpus(self._words[first:self._offsets[in_end]],
+                      self._offsets[in_start:in_end + 1] - first,
+                      self._doc_c[in_start:in_end], self._vocab, self._labels)
@@ -1,75 +1,94 @@
-import pdb
-import numpy
+import numpy as np
 import sys
 
 class Data:
     '''
         Creates a new Data instance
-        @param in_raw_data list of strings, raw training data
-        @param in_vocab list of unique strings
-        @param in_x 2d arr of dimension (d x # tokens in d)
-        @param in_z 2d arr of dimension (d x # tokens in d)
-        @param in_ndk_map   (d x k) list
-        @param in_nckw_map   list (dim c) of list (dim K) of hashmaps (token -> freq)
-        @param in_nckw_map_star (c x K x # total tokens in K)
-        @param in_theta list of lists (d x k)
-        @param in_phi   list of lists (k x w)
-        @param in_phi_c list of lists (k x w)
-    '''
-    def __init__(self, in_raw_data, in_vocab, in_x, in_z, in_ndk_map, in_nckw_map, in_nckw_map_star, in_theta, in_phi, in_phi_c, in_vocab_map):
-        self._raw_data = in_raw_data
-        self._vocab = in_vocab  
-        self._V = len(in_vocab)
+        @param in_corpus    Corpus, the encoded training/testing data
+        @param in_x int32 array (# tokens), flat like the corpus tokens
+        @param in_z int32 array (# tokens), flat like the corpus tokens
+        @param in_ndk_map   int32 array (d x k)
+        @param in_nckw_map  int32 array (s x k), one row per slot of
+                            in_slot_map, None for held-out data that is
+                            sampled against a fixed phi
+        @param in_nckw_map_star int32 array (c x k), None for held-out data
+        @param in_theta float array (d x k)
+        @param in_phi   float array (k x w+1)
+        @param in_phi_c float array (s x k)
+        @param in_slot_map  SlotMap of the (collection, word) pairs the
+                            per collection tables have rows for
+        Column w of the (x w+1) tables is the OOV word of the vocabulary.
+    '''
+    def __init__(self, in_corpus, in_x, in_z, in_ndk_map, in_nckw_map, in_nckw_map_star, in_theta, in_phi, in_phi_c,
+                 in_slot_map):
+        self._corpus = in_corpus
+        self._vocab = in_corpus.get_vocab()
+        self._V = len(self._vocab)      # OOV idx not included
+        self._words = in_corpus.get_words()
+        self._offsets = in_corpus.get_offsets()
+        self._slot_map = in_slot_map
+        # slot of every token, the unseen slot of its collection for pairs
+        # without training tokens
+        self._slots = in_slot_map.get_slots(in_corpus.get_token_c(), self._words)
         self._x = in_x
         self._z = in_z
         self._ndk_map = in_ndk_map
         self._nckw_map = in_nckw_map
         self._nckw_map_star = in_nckw_map_star
 
+        # global counts summed over collections, kept in step with the
+        # per collection counts by exclude_token / include_token
+        self._nkw_map = None
+        self._nkw_map_star = None
+        if self._nckw_map is not None:
+            self._nkw_map = np.zeros((self._nckw_map.shape[1], self._V + 1), dtype=np.int32)
+            in_slot_map.sum_words(self._nckw_map, self._nkw_map)
+            self._nkw_map_star = self._nckw_map_star.sum(axis=0).astype(np.int32)
+
         self._theta = in_theta
         self._phi = in_phi
         self._phi_c = in_phi_c
 
-        self._vocab_map = in_vocab_map
+    '''
+        Gets the encoded training/testing data
+        @return Corpus
+    '''
+    def get_corpus(self):
+        return self._corpus
 
     '''
-        Gets the raw training/testing data
-        @return list of lists
+        @return int number of documents
     '''
-    def get_raw_data(self):
-        return self._raw_data
+    def get_num_docs(self):
+        return len(self._offsets) - 1
 
     '''
-        Returns the word in the raw data
+        Returns the word of a token
         @param in_d The document number
         @param in_i The index number (not accounting for first c field)
         @return string
     '''
     def get_word(self, in_d, in_i):
-        return self._raw_data[in_d][in_i+1]
+        return self._vocab.get_token(self._words[self._offsets[in_d] + in_i])
 
     '''
-        @return list of unique strings
+        @return Vocabulary
     '''
     def get_vocab(self):
         return self._vocab
 
     '''
-        @return 2d array
+        @return int32 array (# tokens)
     '''
     def get_x(self):
         return self._x
 
     '''
         @param d    int document number
-        @return list
+        @return int32 array view of the x values of doc d
     '''
     def get_x_d(self, d):
-
-        if type(d) is not int:
-            raise Exception("d is not of type int")
-
-        return self._x[d]
+        return self._x[self._offsets[d]:self._offsets[d + 1]]
 
     '''
         @param d    int document number
@@ -77,14 +96,7 @@ class Data:
         @return int
     '''
     def get_x_d_i(self, d, i):
-
-        if type(d) is not int:
-            raise Exception("d is not of type int")
-
-        if type(i) is not int:
-            raise Exception("i is not of type int")
-
-        return self._x[d][i]
+        return self._x[self._offsets[d] + i]
 
     '''
         @param d    int document number
@@ -92,34 +104,20 @@ class Data:
         @param val  int 0 or 1
     '''
     def set_x_d_i(self, d, i, val):
-
-        if type(d) is not int:
-            raise Exception("d is not of type int")
-
-        if type(i) is not int:
-            raise Exception("i is not of type int")
-
-        if type(val) is not int:
-            raise Exception("Val not of type int")
-
-        self._x[d][i] = val
+        self._x[self._offsets[d] + i] = val
 
     '''
-        @return 2d array
+        @return int32 array (# tokens)
     '''
     def get_z(self):
         return self._z
 
     '''
         @param d    int document number
-        @return list
+        @return int32 array view of the z values of doc d
     '''
     def get_z_d(self, d):
-
-        if type(d) is not int:
-            raise Exception("d is not of type int")
-
-        return self._z[d]
+        return self._z[self._offsets[d]:self._offsets[d + 1]]
 
     '''
         @param d    int document number
@@ -127,39 +125,41 @@ class Data:
         @return int
     '''
     def get_z_d_i(self, d, i):
-
-        if type(d) is not int:
-            raise Exception("d is not of type int")
-
-        if type(i) is not int:
-            raise Exception("i is not of type int")
-
-        return self._z[d][i]
+        return self._z[self._offsets[d] + i]
 
     '''
         @param d    int document number
         @param i    int token number
-        @param val  int 0 or 1
+        @param val  int class
     '''
     def set_z_d_i(self, d, i, val):
+        self._z[self._offsets[d] + i] = val
 
-        if type(d) is not int:
-            raise Exception("d is not of type int")
-
-        if type(i) is not int:
-            raise Exception("i is not of type int")
-
-        if type(val) is not int:
-            raise Exception("Val not of type int")
-
-        self._z[d][i] = val
+    '''
+        @return bool whether this data keeps no topic-word counts of its
+                own and is sampled against a fixed phi / phi_c
+    '''
+    def is_held_out(self):
+        return self._nckw_map is None
 
     '''
-        @return int
+        @return int number of vocab words, the OOV idx not included
     '''
     def get_V(self):
         return self._V
 
+    '''
+        @return SlotMap of the per collection tables
+    '''
+    def get_slot_map(self):
+        return self._slot_map
+
+    '''
+        @return int64 array (# tokens) slot of every token
+    '''
+    def get_slots(self):
+        return self._slots
+
     '''
         Gets number of tokens in doc d assigned to class k
         @return int number of times tokens in d are assigned k
@@ -167,14 +167,15 @@ class Data:
         @param k    int class
     '''
     def get_n_d_k(self, d, k):
+        return self._ndk_map[d, k]
 
-        if type(d) is not int:
-            raise Exception("d not of type int")
-
-        if type(k) is not int:
-            raise Exception("k not of type int")
-
-        return self._ndk_map[d][k]
+    '''
+        Gets the counts of doc d for every class
+        @param in_d    int document number
+        @return     int32 array (k)
+    '''
+    def get_n_d_k_vec(self, in_d):
+        return self._ndk_map[in_d]
 
     '''
         Gets number of tokens in doc d assigned to any class
@@ -182,12 +183,7 @@ class Data:
         @return     int count of the number
     '''
     def get_n_d_star(self, in_d):
-
-        if type(in_d) is not int:
-            raise Exception("d not of type int")
-
-        count = len(self._z[in_d])
-        return count
+        return self._offsets[in_d + 1] - self._offsets[in_d]
 
     '''
         Get the number of tokens of type w assigned to k
@@ -195,24 +191,29 @@ class Data:
         @param in_w_idx int word of the token we're matching
     '''
     def get_n_k_w(self, in_k, in_w_idx):
+        return self._nkw_map[in_k, in_w_idx]
 
-        num = 0
-        for c in range(len(self._nckw_map)):
-            num += self.get_n_ck_w(c, in_k, in_w_idx)
-
-        return num
+    '''
+        Get the number of tokens of type w assigned to every class
+        @param in_w_idx int word of the token we're matching
+        @return int32 array (k)
+    '''
+    def get_n_k_w_vec(self, in_w_idx):
+        return self._nkw_map[:, in_w_idx]
 
     '''
         Get the number of tokens of all types assigned to k
         @param in_k int class of the token we're matching
     '''
     def get_n_k_star(self, in_k):
+        return self._nkw_map_star[in_k]
 
-        num = 0
-        for c in range(len(self._nckw_map)):
-            num += self.get_n_ck_star(c, in_k)
-        
-        return num
+    '''
+        Get the number of tokens of all types assigned to every class
+        @return int32 array (k)
+    '''
+    def get_n_k_star_vec(self):
+        return self._nkw_map_star
 
     '''
         Get the number of tokens of type w assigned to k
@@ -221,18 +222,22 @@ class Data:
         @param in_w_idx index of the word of the token we're matching
     '''
     def get_n_ck_w(self, in_c, in_k, in_w_idx):
-        if (in_c >= len(self._nckw_map)):
-            pdb.set_trace()
+        if (in_c >= self._nckw_map_star.shape[0]):
             raise Exception("incorrect index c: " + str(in_c))
 
-        if (in_k >= len(self._nckw_map[in_c])):
+        if (in_k >= self._nckw_map.shape[1]):
             raise Exception("incorrect index k: " + str(in_k))
 
-        if (in_w_idx >= len(self._nckw_map[in_c][in_k])):
-            # should this happen?
-            return 0
+        return self._nckw_map[self._slot_map.get_slot(in_c, in_w_idx), in_k]
 
-        return self._nckw_map[in_c][in_k][in_w_idx]
+    '''
+        Get the number of tokens of type w in corpus c assigned to every class
+        @param in_c int corpus to check
+        @param in_w_idx index of the word of the token we're matching
+        @return int32 array (k)
+    '''
+    def get_n_ck_w_vec(self, in_c, in_w_idx):
+        return self._nckw_map[self._slot_map.get_slot(in_c, in_w_idx)]
 
 
     '''
@@ -242,13 +247,21 @@ class Data:
     '''
     def get_n_ck_star(self, in_c, in_k):
 
-        if (in_c >= len(self._nckw_map)):
+        if (in_c >= self._nckw_map_star.shape[0]):
             raise Exception("incorrect index c: " + str(in_c))
-        
-        if (in_k >= len(self._nckw_map[in_c])):
+
+        if (in_k >= self._nckw_map_star.shape[1]):
             raise Exception("incorrect index k: " + str(in_k))
 
-        return self._nckw_map_star[in_c][in_k]
+        return self._nckw_map_star[in_c, in_k]
+
+    '''
+        Get the number of tokens of all types in corpus c assigned to every class
+        @param in_c int corpus to check
+        @return int32 array (k)
+    '''
+    def get_n_ck_star_vec(self, in_c):
+        return self._nckw_map_star[in_c]
 
     '''
         Sets the theta
@@ -259,7 +272,7 @@ class Data:
     def set_theta_d_k(self, in_d, in_k, in_theta):
         #TODO check d
         #TODO check k
-        self._theta[in_d][in_k] = in_theta
+        self._theta[in_d, in_k] = in_theta
 
     '''
         Gets the theta
@@ -268,7 +281,7 @@ class Data:
         @return         float theta val
     '''
     def get_theta_d_k(self, in_d, in_k):
-        return self._theta[in_d][in_k]
+        return self._theta[in_d, in_k]
 
     '''
         Sets the Phi
@@ -279,7 +292,7 @@ class Data:
     def set_phi_k_w(self, in_k, in_w, in_phi):
         #TODO check k
         #TODO check w
-        self._phi[in_k][in_w] = in_phi
+        self._phi[in_k, in_w] = in_phi
 
     '''
         Gets the Phi
@@ -290,7 +303,15 @@ class Data:
     def get_phi_k_w(self, in_k, in_w):
         #TODO check k
         #TODO check w
-        return self._phi[in_k][in_w]
+        return self._phi[in_k, in_w]
+
+    '''
+        Gets the Phi of word w for every class
+        @param in_w     int word idx
+        @return         float array (k)
+    '''
+    def get_phi_w_vec(self, in_w):
+        return self._phi[:, in_w]
 
     '''
         Sets the Phi(c)
@@ -303,7 +324,7 @@ class Data:
         #TODO check c
         #TODO check k
         #TODO check w
-        self._phi_c[in_c][in_k][in_w] = in_phi
+        self._phi_c[self._slot_map.get_slot(in_c, in_w), in_k] = in_phi
 
     '''
         Gets the Phi(c)
@@ -316,7 +337,64 @@ class Data:
         #TODO check c
         #TODO check k
         #TODO check w
-        return self._phi_c[in_c][in_k][in_w]
+        return self._phi_c[self._slot_map.get_slot(in_c, in_w), in_k]
+
+    '''
+        Gets the Phi(c) of word w for every class
+        @param in_c     int corpus
+        @param in_w     int word idx
+        @return         float array (k)
+    '''
+    def get_phi_c_w_vec(self, in_c, in_w):
+        return self._phi_c[self._slot_map.get_slot(in_c, in_w)]
+
+    '''
+        @return float array (d x k), estimated in place
+    '''
+    def get_theta(self):
+        return self._theta
+
+    '''
+        @return float array (k x w+1), estimated in place
+    '''
+    def get_phi(self):
+        return self._phi
+
+    '''
+        @return float array (s x k), estimated in place
+    '''
+    def get_phi_c(self):
+        return self._phi_c
+
+    '''
+        @return int32 array (d x k) document-topic counts
+    '''
+    def get_ndk_map(self):
+        return self._ndk_map
+
+    '''
+        @return int64 array (d) number of tokens of every document
+    '''
+    def get_n_d_star_vec(self):
+        return np.diff(self._offsets)
+
+    '''
+        @return int32 array (k x w+1) global topic-word counts
+    '''
+    def get_nkw_map(self):
+        return self._nkw_map
+
+    '''
+        @return int32 array (s x k) per collection topic-word counts
+    '''
+    def get_nckw_map(self):
+        return self._nckw_map
+
+    '''
+        @return int32 array (c x k) per collection topic totals
+    '''
+    def get_nckw_map_star(self):
+        return self._nckw_map_star
 
     def set_theta(self, in_theta):
         self._theta = in_theta
@@ -327,50 +405,157 @@ class Data:
     def set_phi_c(self, in_phi_c):
         self._phi_c = in_phi_c
 
-    def exclude_token(self, in_c, in_d, in_i, in_token):
-        in_z = self._z[in_d][in_i]
-        in_x = self._x[in_d][in_i]
+    '''
+        Removes token n from the counts
+        @param in_c     int corpus number
+        @param in_d     int document number
+        @param in_n     int flat token position (offset of d + i)
+    '''
+    def exclude_token(self, in_c, in_d, in_n):
+        in_z = self._z[in_n]
+        token_idx = self._words[in_n]
+
+        if (self._ndk_map[in_d, in_z] < 1):
+            raise Exception("negative count for doc " + str(in_d) + " class " + str(in_z))
+
+        self._ndk_map[in_d, in_z] -= 1
+        if self._nckw_map is None:
+            return
+        self._nckw_map[self._slots[in_n], in_z] -= 1
+        self._nckw_map_star[in_c, in_z] -= 1
+        self._nkw_map[in_z, token_idx] -= 1
+        self._nkw_map_star[in_z] -= 1
+
+    '''
+        Stores the new z / x of token n and adds it back to the counts
+        @param in_c     int corpus number
+        @param in_d     int document number
+        @param in_n     int flat token position (offset of d + i)
+        @param in_z     int class
+        @param in_x     int 0 or 1
+    '''
+    def include_token(self, in_c, in_d, in_n, in_z, in_x):
+        token_idx = self._words[in_n]
+        self._z[in_n] = in_z
+        self._x[in_n] = in_x
 
-        token_idx = self._vocab_map[in_token]
+        self._ndk_map[in_d, in_z] += 1
+        if self._nckw_map is None:
+            return
+        self._nckw_map[self._slots[in_n], in_z] += 1
+        self._nckw_map_star[in_c, in_z] += 1
+        self._nkw_map[in_z, token_idx] += 1
+        self._nkw_map_star[in_z] += 1
+
+    '''
+        Replaces the z and x arrays, e.g. with arrays living in shared memory
+        @param in_z int32 array (# tokens)
+        @param in_x int32 array (# tokens)
+    '''
+    def set_assignments(self, in_z, in_x):
+        self._z = in_z
+        self._x = in_x
+
+    '''
+        Replaces the count tables, e.g. with arrays living in shared memory
+        @param in_ndk_map   int32 array (d x k)
+        @param in_nckw_map  int32 array (s x k)
+        @param in_nckw_map_star int32 array (c x k)
+    '''
+    def set_count_tables(self, in_ndk_map, in_nckw_map, in_nckw_map_star):
+        self._ndk_map = in_ndk_map
+        self._nckw_map = in_nckw_map
+        self._nckw_map_star = in_nckw_map_star
+        self._nkw_map = np.zeros((self._nckw_map.shape[1], self._V + 1), dtype=np.int32)
+        self._slot_map.sum_words(self._nckw_map, self._nkw_map)
+        self._nkw_map_star = self._nckw_map_star.sum(axis=0).astype(np.int32)
 
-        if (self._ndk_map[in_d][in_z] - 1 < 0):
-            pdb.set_trace()
+    '''
+        Recomputes nckw_star, nkw and nkw_star in place from nckw
+    '''
+    def refresh_totals(self):
+        self._slot_map.sum_collections(self._nckw_map, self._nckw_map_star)
+        self._slot_map.sum_words(self._nckw_map, self._nkw_map)
+        np.sum(self._nckw_map_star, axis=0, out=self._nkw_map_star)
 
-        self._ndk_map[in_d][in_z] = self._ndk_map[in_d][in_z] - 1
-        self._nckw_map[in_c][in_z][token_idx] = self._nckw_map[in_c][in_z][token_idx] - 1
-        self._nckw_map_star[in_c][in_z] = self._nckw_map_star[in_c][in_z] - 1
+    '''
+        Overwrites the topic-word counts with a snapshot, in place
+        @param in_nckw_map  int32 array (s x k)
+    '''
+    def load_topic_word_counts(self, in_nckw_map):
+        np.copyto(self._nckw_map, in_nckw_map)
+        self.refresh_totals()
 
-    def include_token(self, in_c, in_d, in_i, in_token, in_z, in_x):
+    '''
+        Recounts every table from the z assignments and the corpus
+        @return tuple (ndk, nckw, nckw_star, nkw, nkw_star) of fresh arrays,
+                only ndk for held-out data
+    '''
+    def rebuild_counts(self):
+        docs = self._corpus.get_token_docs()
+        ndk = np.zeros_like(self._ndk_map)
+        np.add.at(ndk, (docs, self._z), 1)
+        if self._nckw_map is None:
+            return ndk, None, None, None, None
+        nckw = np.zeros_like(self._nckw_map)
+        np.add.at(nckw, (self._slots, self._z), 1)
+        nckw_star = np.zeros_like(self._nckw_map_star)
+        self._slot_map.sum_collections(nckw, nckw_star)
+        nkw = np.zeros_like(self._nkw_map)
+        self._slot_map.sum_words(nckw, nkw)
+        nkw_star = nckw_star.sum(axis=0).astype(np.int32)
+        return ndk, nckw, nckw_star, nkw, nkw_star
 
-        token_idx = self._vocab_map[in_token]
+    '''
+        @return dict of table name -> bytes, tables this Data holds only;
+                phi and phi_c are shared with the held-out set and counted
+                for the training set
+    '''
+    def get_nbytes(self):
+        tables = {"z": self._z, "x": self._x, "slots": self._slots, "ndk": self._ndk_map, "nckw": self._nckw_map,
+                  "nckw_star": self._nckw_map_star, "nkw": self._nkw_map,
+                  "nkw_star": self._nkw_map_star, "theta": self._theta}
+        if not self.is_held_out():
+            tables["phi"] = self._phi
+            tables["phi_c"] = self._phi_c
+        return dict((name, int(table.nbytes)) for name, table in tables.items() if table is not None)
 
-        self._ndk_map[in_d][in_z] = self._ndk_map[in_d][in_z] + 1
-        self._nckw_map[in_c][in_z][token_idx] = self._nckw_map[in_c][in_z][token_idx] + 1
-        self._nckw_map_star[in_c][in_z] = self._nckw_map_star[in_c][in_z] + 1
+    '''
+        Checks the incrementally kept tables against a full recount
+        Raises an Exception naming the first table that disagrees
+    '''
+    def check_counts(self):
+        names = ["ndk", "nckw", "nckw_star", "nkw", "nkw_star"]
+        kept = [self._ndk_map, self._nckw_map, self._nckw_map_star, self._nkw_map, self._nkw_map_star]
+        for name, table, fresh in zip(names, kept, self.rebuild_counts()):
+            if table is not None and not np.array_equal(table, fresh):
+                raise Exception("count table " + name + " out of sync with z assignments")
 
     '''
         @param word     string
         @return int index of vocab word
     '''
     def get_word_idx(self, in_word):
-        return self._vocab_map[in_word]
+        return self._vocab.get_idx(in_word)
 
     def __str__(self):
         string = "\n"
-        string += "\nRAW DATA:\n" + str(self._raw_data)
-        string += "\nVOCAB:\n" + str(self._vocab)
+        string += "\nWORDS:\n" + str(self._words)
+        string += "\nOFFSETS:\n" + str(self._offsets)
+        string += "\nVOCAB:\n" + str(self._vocab.get_tokens())
         string += "\nV:\n" + str(self._V)
         string += "\nX:\n" + str(self._x)
         string += "\nZ:\n" + str(self._z)
         string += "\nNDK MAP:\n" + str(self._ndk_map)
         string += "\nNCKW MAP:\n" + str(self._nckw_map)
         string += "\nNCKW MAP STAR\n" + str(self._nckw_map_star)
+        string += "\nNKW MAP:\n" + str(self._nkw_map)
+        string += "\nNKW MAP STAR\n" + str(self._nkw_map_star)
 
         string += "\nTHETA:\n" + str(self._theta)
         string += "\nPHI:\n" + str(self._phi)
         string += "\nPHI_C\n" + str(self._phi_c)
 
-        string += "\nVOCAB MAP:\n" + str(self._vocab_map)
         return string
 
     def __repr__(self):
@@ -1,17 +1,73 @@
 import sys
 from collapsed import CollapsedSampler
+from corpus import Corpus
+from checkpoint import load_checkpoint
+from chains import CHAIN_OPTIONS, run_chains
+from data import Data
+from flags import read_flags
+from output import OutputWriter
 
 '''
     Main program
+    Either the 9 positional params below, or --resume <checkpoint dir>,
+    each followed by optional flags
 '''
 def main():
-    train_lines, test_lines, output_file_path, \
-        k, l, a, b, num_iters, num_burn_in = read_input()
-    cs = CollapsedSampler(train_lines, test_lines, output_file_path, \
-        k, l, a, b, num_iters, num_burn_in)
+    if len(sys.argv) > 2 and sys.argv[1] == "--resume":
+        options = read_flags(sys.argv[3:], OPTIONS)
+        options.pop("in_cache_dir", None)
+        # a checkpoint holds one chain
+        for name in ["in_chains", "in_chains_combine"]:
+            if name in options:
+                raise Exception(flag_of(name) + " cannot be used with --resume, "
+                                "a checkpoint continues a single chain")
+        cs = load_checkpoint(sys.argv[2], options)
+        cs.algorithm()
+        return
+
+    options = read_flags(sys.argv[10:], OPTIONS)
+    # the loader and chain flags are not CollapsedSampler keywords
+    cache_dir = options.pop("in_cache_dir", None)
+    num_chains = options.pop("in_chains", 1)
+    combine = options.pop("in_chains_combine", "best")
+    if num_chains > 1:
+        # every chain is a serial in-memory run, see chains.CHAIN_OPTIONS
+        for name in sorted(CHAIN_OPTIONS):
+            if name in options:
+                raise Exception(flag_of(name) + " cannot be used with --chains, "
+                                "each chain runs serially without checkpoints, metrics or printing")
+    train_corpus, test_corpus, output_file_path, \
+        k, l, a, b, num_iters, num_burn_in = read_input(cache_dir)
+    if num_chains > 1:
+        params = {"k": k, "l": l, "a": a, "b": b, "num_iters": num_iters, "num_burn_in": num_burn_in}
+        main_chains(train_corpus, test_corpus, output_file_path, params, options, num_chains, combine)
+        return
+    cs = CollapsedSampler(train_corpus, test_corpus, output_file_path, \
+        k, l, a, b, num_iters, num_burn_in, **options)
     cs.algorithm()
 
 
+'''
+    Runs independent chains, prints split-R-hat and writes the output of
+    the best chain or the combined one
+'''
+def main_chains(in_train, in_test, in_out, in_params, in_options, in_num_chains, in_combine):
+    result = run_chains(in_train, in_test, in_params, in_options, in_num_chains,
+                        in_options.get("in_seed"), in_combine)
+    print("split-R-hat " + str(result["rhat"]) + " over " + str(in_num_chains) +
+          " chains, best chain " + str(result["best"]))
+
+    writer = OutputWriter(in_out)
+    best = result["best"]
+    writer.set_log_likelihoods(result["trainll"][best], result["testll"][best])
+    slot_map = result["slot_map"]
+    data = Data(in_train, None, None, None, None, None, result["theta"], result["phi"], result["phi_c"],
+                slot_map)
+    settings = dict(in_params, c=slot_map.get_num_collections(), chains=in_num_chains, combine=in_combine,
+                    rhat=result["rhat"], best=best, seeds=result["seeds"])
+    writer.write(data, settings)
+
+
 '''
     Reads in the input
     1 input train file
@@ -23,8 +79,10 @@ def main():
     7 value of beta
     8 number of total iterations
     9 number of samples to use as burn-in
+    @param in_cache_dir string directory caching the encoded input files,
+                        or None
 '''
-def read_input():
+def read_input(in_cache_dir=None):
 
     if (len(sys.argv) < 10):
         raise Exception("Not enough params. Correct usage: ./collapsed-sampler input-train.txt input-test.txt output.txt 10 0.5 0.1 0.01 1100 1000")
@@ -39,17 +97,58 @@ def read_input():
     num_iters = int(sys.argv[8])
     num_burn_in = int(sys.argv[9])
 
-    f = open(train_file_path)
-    train_lines = []
-    for line in f.readlines(): 
-        train_lines.append(line.strip().split())
+    train_corpus = Corpus.from_file(train_file_path, None, in_cache_dir)
+
+    # test words unseen in training get the OOV idx of the shared vocab;
+    # collections only in the test file get new ids after the train ones
+    train_corpus.get_vocab().freeze()
+    test_corpus = Corpus.from_file(test_file_path, train_corpus.get_vocab(), in_cache_dir,
+                                   train_corpus.get_labels())
 
-    f = open(test_file_path)
-    test_lines = []
-    for line in f.readlines():
-        test_lines.append(line.strip().split())
+    return train_corpus, test_corpus, output_file_path, k, l, a, b, num_iters, num_burn_in
 
-    return train_lines, test_lines, output_file_path, k, l, a, b, num_iters, num_burn_in
+
+'''
+    Optional flags given after the 9 positional params, as --flag value
+    flag -> (CollapsedSampler keyword, type)
+'''
+OPTIONS = {
+    "--check-counts": ("in_check_counts", int),
+    "--seed": ("in_seed", int),
+    "--sampler": ("in_sampler", str),
+    "--mh-steps": ("in_mh_steps", int),
+    "--workers": ("in_workers", int),
+    "--kernel": ("in_kernel", int),
+    "--estimate-every": ("in_estimate_every", int),
+    "--estimate-after-burn-in": ("in_estimate_after_burn_in", int),
+    "--eval-every": ("in_eval_every", int),
+    "--eval-train": ("in_eval_train", int),
+    "--thin": ("in_thin", int),
+    "--checkpoint": ("in_checkpoint", str),
+    "--checkpoint-every": ("in_checkpoint_every", int),
+    "--metrics-jsonl": ("in_metrics_jsonl", str),
+    "--metrics-port": ("in_metrics_port", int),
+    "--converge": ("in_converge", str),
+    "--converge-window": ("in_converge_window", int),
+    "--converge-tol": ("in_converge_tol", float),
+    "--converge-action": ("in_converge_action", str),
+    "--print-ll": ("in_print_ll", int),
+    "--collection-layout": ("in_collection_layout", str),
+    "--dense-threshold": ("in_dense_threshold", float),
+    "--cache-dir": ("in_cache_dir", str),
+    "--chains": ("in_chains", int),
+    "--chains-combine": ("in_chains_combine", str),
+}
+
+'''
+    @param in_name  string CollapsedSampler keyword of an option
+    @return string the flag that sets it
+'''
+def flag_of(in_name):
+    for flag, (name, cast) in OPTIONS.items():
+        if name == in_name:
+            return flag
+    return in_name
 
 
 if __name__ == "__main__":    
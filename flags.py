@@ -0,0 +1,39 @@
+'''
+    Command line flags given as --flag value pairs
+
+    Every script describes its flags with a dict flag -> (name, type) or
+    flag -> (name, type, default). type is any callable taking the string,
+    e.g. int, or ints / strs below for comma separated lists. Flags with a
+    default are always in the result, flags without one only when given.
+'''
+
+'''
+    @param in_value string comma separated ints
+    @return list of int
+'''
+def ints(in_value):
+    return [int(value) for value in in_value.split(",")]
+
+'''
+    @param in_value string comma separated strings, "" for none
+    @return list of string
+'''
+def strs(in_value):
+    return in_value.split(",") if in_value else []
+
+'''
+    Reads --flag value pairs
+    @param in_args  list of string arguments
+    @param in_options   dict flag -> (name, type[, default])
+    @return dict of name -> value
+'''
+def read_flags(in_args, in_options):
+    options = dict((spec[0], spec[2]) for spec in in_options.values() if len(spec) > 2)
+    if (len(in_args) % 2 != 0):
+        raise Exception("Optional flags come in pairs: --flag value")
+    for i in range(0, len(in_args), 2):
+        if in_args[i] not in in_options:
+            raise Exception("Unknown flag " + in_args[i] + ", expected one of " + ", ".join(sorted(in_options)))
+        spec = in_options[in_args[i]]
+        options[spec[0]] = spec[1](in_args[i + 1])
+    return options
@@ -0,0 +1,275 @@
+from concurrent.futures import ProcessPoolExecutor
+import json
+import numpy as np
+from collapsed import CollapsedSampler
+from corpus import Corpus
+from data import Data
+from shared import attach, release, share_array
+from slots import slot_map_from_arrays
+from vocab import Vocabulary
+
+'''
+    Fold-in inference for new documents against a trained model
+
+    phi and phi_c stay fixed; only z / x of the new documents are sampled
+    (Eq. 3 / 4 with the held-out conditionals, every document of a batch
+    at once, see CollapsedSampler.sweep_test_batched) for a number of
+    sweeps, then theta is estimated by Eq. 5. Nothing of the training
+    corpus is needed.
+'''
+class Inferencer:
+
+    # sweeps over the new documents per call
+    NUM_SWEEPS = 20
+
+    '''
+        Creates an inferencer
+        @param in_phi   float array (k x w+1)
+        @param in_phi_c float array (s x k)
+        @param in_slot_map  SlotMap of the rows of in_phi_c
+        @param in_vocab Vocabulary phi was estimated over, is frozen
+        @param in_labels    Vocabulary of the collection labels, is frozen
+        @param in_settings  dict of the model settings, needs k, l, a, b
+        @param in_num_sweeps    int default sweeps per call
+        @param in_seed  int seed or numpy.random.Generator, None for fresh entropy
+    '''
+    def __init__(self, in_phi, in_phi_c, in_slot_map, in_vocab, in_labels, in_settings,
+                 in_num_sweeps=NUM_SWEEPS, in_seed=None):
+        in_vocab.freeze()
+        in_labels.freeze()
+        self._phi = in_phi
+        self._phi_c = in_phi_c
+        self._slot_map = in_slot_map
+        self._vocab = in_vocab
+        self._labels = in_labels
+        self._settings = in_settings
+        self._K = in_settings["k"]
+        self._num_sweeps = in_num_sweeps
+
+        # a sampler over no documents, used for its test side sweep
+        empty = Corpus(np.zeros(0, dtype=np.int32), np.zeros(1, dtype=np.int64),
+                       np.zeros(0, dtype=np.int32), in_vocab, in_labels)
+        self._cs = CollapsedSampler(empty, empty, None, self._K, in_settings["l"],
+                                    in_settings["a"], in_settings["b"], 0, 0, in_seed=in_seed,
+                                    in_kernel=0)
+        self._rng = self._cs.get_categorical_sampler().get_rng()
+
+    '''
+        Loads the model written by OutputWriter for an output path
+        @param in_path  string output path given to driver.py
+        @param in_num_sweeps    int default sweeps per call
+        @param in_seed  int seed, None for fresh entropy
+        @return Inferencer
+    '''
+    @staticmethod
+    def load(in_path, in_num_sweeps=NUM_SWEEPS, in_seed=None):
+        with open(in_path + "-settings.json") as f:
+            settings = json.load(f)
+        with open(in_path + "-vocab") as f:
+            vocab = Vocabulary(f.read().split("\n")[:-1])
+        with open(in_path + "-collections") as f:
+            labels = Vocabulary(f.read().split("\n")[:-1])
+        phi = np.load(in_path + "-phi.npy")
+        phi_c = np.load(in_path + "-phi_c.npy")
+        with np.load(in_path + "-slots.npz") as arrays:
+            slot_map = slot_map_from_arrays(arrays)
+        return Inferencer(phi, phi_c, slot_map, vocab, labels, settings, in_num_sweeps, in_seed)
+
+    '''
+        Restarts the random stream of the sweeps
+        @param in_seed  int seed or numpy.random.SeedSequence
+    '''
+    def reseed(self, in_seed):
+        state = np.random.default_rng(in_seed).bit_generator.state
+        self._cs.get_categorical_sampler().set_state(state, [])
+
+    '''
+        @return int number of topics
+    '''
+    def get_num_topics(self):
+        return self._K
+
+    '''
+        @return int default sweeps per call
+    '''
+    def get_num_sweeps(self):
+        return self._num_sweeps
+
+    '''
+        @return int number of collections of the model
+    '''
+    def get_num_collections(self):
+        return self._slot_map.get_num_collections()
+
+    '''
+        @return Vocabulary of the collection labels of the model
+    '''
+    def get_labels(self):
+        return self._labels
+
+    '''
+        @return SlotMap of the rows of phi_c
+    '''
+    def get_slot_map(self):
+        return self._slot_map
+
+    '''
+        @return Vocabulary of the model
+    '''
+    def get_vocab(self):
+        return self._vocab
+
+    '''
+        @return dict of the model settings
+    '''
+    def get_settings(self):
+        return self._settings
+
+    '''
+        @return float array (k x w+1) phi of the model
+    '''
+    def get_phi(self):
+        return self._phi
+
+    '''
+        @return float array (s x k) phi_c of the model
+    '''
+    def get_phi_c(self):
+        return self._phi_c
+
+    '''
+        Encodes new documents with the model vocabulary and collection
+        labels, unseen words get the OOV idx
+        @param in_docs  Corpus, or list of "classification words" strings
+                        or lists of [classification words]
+        @return Corpus
+    '''
+    def encode(self, in_docs):
+        if isinstance(in_docs, Corpus):
+            corpus = in_docs
+        else:
+            corpus = Corpus.from_lines((doc.split() if isinstance(doc, str) else doc
+                                        for doc in in_docs), self._vocab, self._labels)
+        # the frozen labels map unknown labels to id C
+        unknown = np.flatnonzero(corpus.get_doc_c() >= self.get_num_collections())
+        if len(unknown) > 0:
+            raise Exception("document " + str(int(unknown[0])) + " has a collection that is not in the model, " +
+                            "it has " + ", ".join(self._labels.get_tokens()))
+        return corpus
+
+    '''
+        Creates the held-out state of new documents: random z / x and
+        their document-topic counts
+        @param in_corpus    Corpus of the new documents
+        @return Data object sampled against the model phi / phi_c
+    '''
+    def new_data(self, in_corpus):
+        num_tokens = in_corpus.get_num_tokens()
+        x = self._rng.integers(2, size=num_tokens).astype(np.int32)
+        z = self._rng.integers(self._K, size=num_tokens).astype(np.int32)
+        ndk = np.zeros((in_corpus.get_num_docs(), self._K), dtype=np.int32)
+        np.add.at(ndk, (in_corpus.get_token_docs(), z), 1)
+        theta = np.zeros((in_corpus.get_num_docs(), self._K))
+        return Data(in_corpus, x, z, ndk, None, None, theta, self._phi, self._phi_c, self._slot_map)
+
+    '''
+        Folds in a batch of new documents
+        @param in_docs  Corpus, or list of "classification words" strings
+                        or lists of [classification words]
+        @param in_num_sweeps    int sweeps, None for the default
+        @return float array (d x k) theta of every document, in order
+    '''
+    def infer(self, in_docs, in_num_sweeps=None):
+        num_sweeps = self._num_sweeps if in_num_sweeps is None else in_num_sweeps
+        data = self.new_data(self.encode(in_docs))
+        for s in range(num_sweeps):
+            self._cs.sweep_test_batched(data)
+        self._cs.estimate_theta(data)
+        return data.get_theta()
+
+
+'''
+    Fold-in inference split over a pool of worker processes
+
+    phi and phi_c are copied once into shared memory that every worker
+    maps; documents are encoded in the calling process and sent to the
+    workers as batches of flat arrays. Every batch carries its own child
+    of the pool seed, so results do not depend on which worker runs it.
+'''
+class PoolInferencer:
+
+    # documents per task
+    BATCH_SIZE = 1000
+
+    '''
+        Starts the pool
+        @param in_inferencer    Inferencer holding the model
+        @param in_workers   int number of worker processes
+        @param in_seed  int seed, None for fresh entropy
+    '''
+    def __init__(self, in_inferencer, in_workers, in_seed=None):
+        self._inferencer = in_inferencer
+        self._shms = []
+        specs = []
+        for arr in [in_inferencer.get_phi(), in_inferencer.get_phi_c()]:
+            shm, _, spec = share_array(arr)
+            self._shms.append(shm)
+            specs.append(spec)
+        # batch seeds are spawned in submission order
+        self._seeds = np.random.SeedSequence(in_seed)
+        self._pool = ProcessPoolExecutor(max_workers=in_workers, initializer=_init_worker,
+                                         initargs=(specs, in_inferencer.get_slot_map(),
+                                                   in_inferencer.get_vocab(), in_inferencer.get_labels(),
+                                                   in_inferencer.get_settings()))
+
+    '''
+        Folds in documents, in batches spread over the workers
+        @param in_docs  Corpus, or list of "classification words" strings
+                        or lists of [classification words]
+        @param in_num_sweeps    int sweeps, None for the default
+        @param in_batch_size    int documents per task
+        @return float array (d x k) theta of every document, in order
+    '''
+    def infer(self, in_docs, in_num_sweeps=None, in_batch_size=BATCH_SIZE):
+        corpus = self._inferencer.encode(in_docs)
+        num_sweeps = self._inferencer.get_num_sweeps() if in_num_sweeps is None else in_num_sweeps
+        futures = []
+        for start in range(0, corpus.get_num_docs(), in_batch_size):
+            batch = corpus.slice(start, min(start + in_batch_size, corpus.get_num_docs()))
+            futures.append(self._pool.submit(_infer_batch, batch.get_words(), batch.get_offsets(),
+                                             batch.get_doc_c(), num_sweeps, self._seeds.spawn(1)[0]))
+        if not futures:
+            return np.zeros((0, self._inferencer.get_num_topics()))
+        return np.concatenate([future.result() for future in futures])
+
+    '''
+        Stops the workers and frees the shared memory
+    '''
+    def close(self):
+        self._pool.shutdown()
+        release(self._shms, True)
+        self._shms = []
+
+
+# per worker state, set by _init_worker
+_worker = {}
+
+'''
+    Pool initializer: maps the shared phi / phi_c and builds an Inferencer
+'''
+def _init_worker(in_specs, in_slot_map, in_vocab, in_labels, in_settings):
+    shms, (phi, phi_c) = attach(in_specs)
+    _worker["shms"] = shms
+    # reseeded by every batch
+    _worker["inferencer"] = Inferencer(phi, phi_c, in_slot_map, in_vocab, in_labels, in_settings)
+
+'''
+    Pool task: folds in one batch of encoded documents
+    @param in_seed  numpy.random.SeedSequence of this batch
+    @return float array (d x k) theta
+'''
+def _infer_batch(in_words, in_offsets, in_doc_c, in_num_sweeps, in_seed):
+    inferencer = _worker["inferencer"]
+    inferencer.reseed(in_seed)
+    corpus = Corpus(in_words, in_offsets, in_doc_c, inferencer.get_vocab(), inferencer.get_labels())
+    return inferencer.infer(corpus, in_num_sweeps)
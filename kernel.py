@@ -0,0 +1,461 @@
+import numpy as np
+
+'''
+    Compiled token sweeps
+
+    sweep_tokens runs the whole per token body of a training sweep
+    (exclude, draw z by Eq. 3, draw x by Eq. 4, include) over the flat
+    arrays of a Corpus and the flat z / x of its Data.
+    sweep_tokens_sparse and sweep_tokens_alias do the same drawing z from
+    the SparseLDA buckets of sparse.py and the LightLDA proposals of
+    alias.py. They are compiled with numba when numba is installed;
+    without it HAVE_KERNEL is False and callers keep the pure Python
+    path, since the same loops interpreted would be far slower than that
+    path.
+'''
+try:
+    import numba
+    HAVE_KERNEL = True
+except ImportError:
+    numba = None
+    HAVE_KERNEL = False
+
+
+'''
+    One sweep over every token
+    @param words    int32 array (n) word idx
+    @param offsets  int64 array (d + 1) token offsets of the documents
+    @param doc_c    int32 array (d) collection of each document
+    @param slots    int64 array (n) nckw row of every token
+    @param z, x     int32 arrays (n) current assignments, updated in place
+    @param ndk, nckw, nckw_star, nkw, nkw_star  int32 count tables,
+                    nckw with one row per slot, updated in place
+    @param l, a, b  float lambda, alpha, beta
+    @param vb       float V * beta
+    @param uniforms float array (2n) of uniforms in [0, 1)
+'''
+def _sweep_tokens(words, offsets, doc_c, slots, z, x, ndk, nckw, nckw_star, nkw, nkw_star,
+                  l, a, b, vb, uniforms):
+    K = ndk.shape[1]
+    cdf = np.empty(K)
+    for d in range(doc_c.shape[0]):
+        c = doc_c[d]
+        for n in range(offsets[d], offsets[d + 1]):
+            w = words[n]
+            s = slots[n]
+            k = z[n]
+
+            # exclude
+            ndk[d, k] -= 1
+            nckw[s, k] -= 1
+            nckw_star[c, k] -= 1
+            nkw[k, w] -= 1
+            nkw_star[k] -= 1
+
+            # z by Eq. 3, the doc denominator is the same for every k
+            total = 0.0
+            if x[n] == 0:
+                for j in range(K):
+                    total += (ndk[d, j] + a) * (nkw[j, w] + b) / (nkw_star[j] + vb)
+                    cdf[j] = total
+            else:
+                for j in range(K):
+                    total += (ndk[d, j] + a) * (nckw[s, j] + b) / (nckw_star[c, j] + vb)
+                    cdf[j] = total
+            u = uniforms[2 * n] * total
+            k = K - 1
+            for j in range(K):
+                if cdf[j] > u:
+                    k = j
+                    break
+            z[n] = k
+
+            # x by Eq. 4
+            p0 = (1.0 - l) * (nkw[k, w] + b) / (nkw_star[k] + vb)
+            p1 = l * (nckw[s, k] + b) / (nckw_star[c, k] + vb)
+            if uniforms[2 * n + 1] * (p0 + p1) < p0:
+                x[n] = 0
+            else:
+                x[n] = 1
+
+            # include
+            ndk[d, k] += 1
+            nckw[s, k] += 1
+            nckw_star[c, k] += 1
+            nkw[k, w] += 1
+            nkw_star[k] += 1
+
+
+'''
+    Fills the nonzero topic list of every row of a count table
+    @param counts   int32 array (rows x k)
+    @param ptr      int64 array (rows + 1) first list entry of every row
+    @param topics   int32 array (ptr[-1]) topic lists, overwritten
+    @param lens     int64 array (rows) list lengths, overwritten
+'''
+def _fill_topic_lists(counts, ptr, topics, lens):
+    for r in range(counts.shape[0]):
+        n = 0
+        for k in range(counts.shape[1]):
+            if counts[r, k] > 0:
+                topics[ptr[r] + n] = k
+                n += 1
+        lens[r] = n
+
+'''
+    Removes topic k from the list at topics[start:start + length]
+    @return int new length
+'''
+def _remove_topic(topics, start, length, k):
+    for i in range(start, start + length):
+        if topics[i] == k:
+            topics[i] = topics[start + length - 1]
+            break
+    return length - 1
+
+'''
+    Draws z from the s / r / q buckets of one branch (see sparse.py)
+    @param u        float uniform in [0, 1)
+    @param ndk_d    int32 array (k) topic counts of the document
+    @param cnt      int32 array (k) topic counts of the word in the branch
+    @param inv      float array (k) 1 / (nk* + Vb) of the branch
+    @param topics, start, length    nonzero topics of cnt
+    @param d_topics, d_len  nonzero topics of ndk_d
+    @param s        float smoothing mass of the branch
+    @param terms    float array (k) scratch
+    @return int topic
+'''
+def _draw_buckets(u, ndk_d, cnt, inv, topics, start, length, d_topics, d_len, s, a, b, terms):
+    q = 0.0
+    for i in range(length):
+        k = topics[start + i]
+        terms[i] = (ndk_d[k] + a) * cnt[k] * inv[k]
+        q += terms[i]
+    r = 0.0
+    for i in range(d_len):
+        k = d_topics[i]
+        r += b * ndk_d[k] * inv[k]
+    u = u * (s + r + q)
+    if u < q:
+        for i in range(length):
+            u -= terms[i]
+            if u < 0.0:
+                return topics[start + i]
+        return topics[start + length - 1]
+    u -= q
+    if u < r:
+        for i in range(d_len):
+            k = d_topics[i]
+            u -= b * ndk_d[k] * inv[k]
+            if u < 0.0:
+                return k
+        return d_topics[d_len - 1]
+    u -= r
+    K = inv.shape[0]
+    for k in range(K):
+        u -= a * b * inv[k]
+        if u < 0.0:
+            return k
+    return K - 1
+
+'''
+    One sweep over every token drawing z from SparseLDA buckets, the same
+    conditional as sweep_tokens; arguments as there, plus
+    @param g_ptr, g_topics, g_lens  nonzero topic lists of the nkw
+                    columns (one row per word idx) from _fill_topic_lists,
+                    kept up to date
+    @param c_ptr, c_topics, c_lens  the same for the nckw rows
+    Every list has room for min(k, row total) topics; a sweep moves
+    tokens between the topics of a row, never between rows, so no list
+    outgrows it.
+'''
+def _sweep_tokens_sparse(words, offsets, doc_c, slots, z, x, ndk, nckw, nckw_star, nkw, nkw_star,
+                         l, a, b, vb, uniforms, g_ptr, g_topics, g_lens, c_ptr, c_topics, c_lens):
+    K = ndk.shape[1]
+    C = nckw_star.shape[0]
+    # 1 / (nk* + Vb) and the smoothing mass of every branch: 0 global,
+    # 1 + c collection c
+    inv = np.empty((C + 1, K))
+    smooth = np.zeros(C + 1)
+    for k in range(K):
+        inv[0, k] = 1.0 / (nkw_star[k] + vb)
+        for c in range(C):
+            inv[1 + c, k] = 1.0 / (nckw_star[c, k] + vb)
+    for br in range(C + 1):
+        for k in range(K):
+            smooth[br] += a * b * inv[br, k]
+    d_topics = np.empty(K, dtype=np.int32)
+    terms = np.empty(K)
+    for d in range(doc_c.shape[0]):
+        c = doc_c[d]
+        d_len = 0
+        for k in range(K):
+            if ndk[d, k] > 0:
+                d_topics[d_len] = k
+                d_len += 1
+        for n in range(offsets[d], offsets[d + 1]):
+            w = words[n]
+            s = slots[n]
+            k = z[n]
+
+            # exclude
+            ndk[d, k] -= 1
+            nckw[s, k] -= 1
+            nckw_star[c, k] -= 1
+            nkw[k, w] -= 1
+            nkw_star[k] -= 1
+            _set_inv(inv, smooth, 0, k, 1.0 / (nkw_star[k] + vb), a * b)
+            _set_inv(inv, smooth, 1 + c, k, 1.0 / (nckw_star[c, k] + vb), a * b)
+            if ndk[d, k] == 0:
+                d_len = _remove_topic(d_topics, 0, d_len, k)
+            if nkw[k, w] == 0:
+                g_lens[w] = _remove_topic(g_topics, g_ptr[w], g_lens[w], k)
+            if nckw[s, k] == 0:
+                c_lens[s] = _remove_topic(c_topics, c_ptr[s], c_lens[s], k)
+
+            # z by Eq. 3 from the buckets of the branch x selects
+            if x[n] == 0:
+                k = _draw_buckets(uniforms[2 * n], ndk[d], nkw[:, w], inv[0], g_topics, g_ptr[w],
+                                  g_lens[w], d_topics, d_len, smooth[0], a, b, terms)
+            else:
+                k = _draw_buckets(uniforms[2 * n], ndk[d], nckw[s], inv[1 + c], c_topics, c_ptr[s],
+                                  c_lens[s], d_topics, d_len, smooth[1 + c], a, b, terms)
+            z[n] = k
+
+            # x by Eq. 4
+            p0 = (1.0 - l) * (nkw[k, w] + b) * inv[0, k]
+            p1 = l * (nckw[s, k] + b) * inv[1 + c, k]
+            if uniforms[2 * n + 1] * (p0 + p1) < p0:
+                x[n] = 0
+            else:
+                x[n] = 1
+
+            # include
+            if ndk[d, k] == 0:
+                d_topics[d_len] = k
+                d_len += 1
+            if nkw[k, w] == 0:
+                g_topics[g_ptr[w] + g_lens[w]] = k
+                g_lens[w] += 1
+            if nckw[s, k] == 0:
+                c_topics[c_ptr[s] + c_lens[s]] = k
+                c_lens[s] += 1
+            ndk[d, k] += 1
+            nckw[s, k] += 1
+            nckw_star[c, k] += 1
+            nkw[k, w] += 1
+            nkw_star[k] += 1
+            _set_inv(inv, smooth, 0, k, 1.0 / (nkw_star[k] + vb), a * b)
+            _set_inv(inv, smooth, 1 + c, k, 1.0 / (nckw_star[c, k] + vb), a * b)
+
+'''
+    Replaces 1 / (nk* + Vb) of topic k in a branch, patching its
+    smoothing mass
+'''
+def _set_inv(inv, smooth, br, k, value, ab):
+    smooth[br] += ab * (value - inv[br, k])
+    inv[br, k] = value
+
+'''
+    Fills a Walker alias table with Vose's method
+    @param scaled   float array (k) probabilities times k, overwritten
+    @param prob     float array (k) threshold of every column, overwritten
+    @param alias    int array (k) alias of every column, overwritten
+    @param small, large int64 arrays (k) scratch
+'''
+def _fill_alias(scaled, prob, alias, small, large):
+    K = scaled.shape[0]
+    num_small = 0
+    num_large = 0
+    for k in range(K):
+        # whatever is never paired is 1 up to rounding
+        prob[k] = 1.0
+        alias[k] = k
+        if scaled[k] < 1.0:
+            small[num_small] = k
+            num_small += 1
+        else:
+            large[num_large] = k
+            num_large += 1
+    while num_small > 0 and num_large > 0:
+        num_small -= 1
+        s = small[num_small]
+        num_large -= 1
+        g = large[num_large]
+        prob[s] = scaled[s]
+        alias[s] = g
+        scaled[g] = (scaled[g] + scaled[s]) - 1.0
+        if scaled[g] < 1.0:
+            small[num_small] = g
+            num_small += 1
+        else:
+            large[num_large] = g
+            num_large += 1
+
+'''
+    Table of a word row for sweep_tokens_alias: its pool slot, rebuilt
+    once it has served k draws (LightLDA amortizes the O(k) build over k
+    draws), or for a row without one the last slot, rebuilt every time
+    @param row      int row id
+    @param cnt      int32 array (k) topic counts of the row
+    @param tot      int32 array (k) topic totals of its branch
+    @return int pool slot
+'''
+def _alias_slot(row, cnt, tot, b, vb, row_slot, draws, thr, alias, probs, scaled, small, large):
+    K = cnt.shape[0]
+    p = row_slot[row]
+    if p < 0:
+        p = draws.shape[0] - 1
+    elif draws[p] < K:
+        return p
+    total = 0.0
+    for k in range(K):
+        scaled[k] = (cnt[k] + b) / (tot[k] + vb)
+        total += scaled[k]
+    for k in range(K):
+        probs[p, k] = scaled[k] / total
+        scaled[k] = scaled[k] * K / total
+    _fill_alias(scaled, thr[p], alias[p], small, large)
+    draws[p] = 0
+    return p
+
+'''
+    One sweep over every token drawing z by LightLDA Metropolis-Hastings
+    (see alias.py); arguments as sweep_tokens, plus
+    @param uniforms float array (n (5 mh_steps + 1)) of uniforms
+    @param mh_steps int word + doc proposal pairs per token
+    @param row_slot int32 array (w + 1 + s) pool slot of every word row,
+                    -1 for none: rows 0 .. w are the nkw columns, w + 1 +
+                    s the nckw row of slot s
+    @param draws    int64 array (p + 1) draws served by every slot, k to
+                    build it at its first use
+    @param thr, alias, probs    arrays (p + 1 x k) alias thresholds,
+                    aliases and normalized probabilities of the slots, the
+                    last one for rows without a slot
+    The pool persists between sweeps, so tables are stale across them;
+    the acceptance uses the probabilities a table draws with.
+'''
+def _sweep_tokens_alias(words, offsets, doc_c, slots, z, x, ndk, nckw, nckw_star, nkw, nkw_star,
+                        l, a, b, vb, uniforms, mh_steps, row_slot, draws, thr, alias, probs):
+    K = ndk.shape[1]
+    V1 = nkw.shape[1]
+    per = 5 * mh_steps + 1
+    scaled = np.empty(K)
+    small = np.empty(K, dtype=np.int64)
+    large = np.empty(K, dtype=np.int64)
+    for d in range(doc_c.shape[0]):
+        c = doc_c[d]
+        start = offsets[d]
+        L = offsets[d + 1] - start
+        # the doc proposal picks among the other L - 1 tokens
+        doc_mass = (L - 1) / (L - 1 + K * a)
+        for n in range(start, offsets[d + 1]):
+            w = words[n]
+            s = slots[n]
+            old = z[n]
+
+            # exclude
+            ndk[d, old] -= 1
+            nckw[s, old] -= 1
+            nckw_star[c, old] -= 1
+            nkw[old, w] -= 1
+            nkw_star[old] -= 1
+
+            # z by MH steps from the previous class
+            if x[n] == 0:
+                cnt = nkw[:, w]
+                tot = nkw_star
+                row = w
+            else:
+                cnt = nckw[s]
+                tot = nckw_star[c]
+                row = V1 + s
+            p = _alias_slot(row, cnt, tot, b, vb, row_slot, draws, thr, alias, probs, scaled, small, large)
+            u = n * per
+            k = old
+            p_k = (ndk[d, k] + a) * (cnt[k] + b) / (tot[k] + vb)
+            for step in range(mh_steps):
+                # word proposal from the table
+                col = min(int(uniforms[u] * K), K - 1)
+                if uniforms[u] * K - col < thr[p, col]:
+                    t = col
+                else:
+                    t = alias[p, col]
+                draws[p] += 1
+                if t != k:
+                    p_t = (ndk[d, t] + a) * (cnt[t] + b) / (tot[t] + vb)
+                    accept = (p_t * probs[p, k]) / (p_k * probs[p, t])
+                    if accept >= 1.0 or uniforms[u + 1] < accept:
+                        k = t
+                        p_k = p_t
+
+                # doc proposal, q(k) prop to ndk + a: the z of another
+                # token of d, or a uniform topic
+                if uniforms[u + 2] < doc_mass:
+                    j = start + min(int(uniforms[u + 3] * (L - 1)), L - 2)
+                    if j >= n:
+                        j += 1
+                    t = z[j]
+                else:
+                    t = min(int(uniforms[u + 3] * K), K - 1)
+                if t != k:
+                    p_t = (ndk[d, t] + a) * (cnt[t] + b) / (tot[t] + vb)
+                    accept = (p_t * (ndk[d, k] + a)) / (p_k * (ndk[d, t] + a))
+                    if accept >= 1.0 or uniforms[u + 4] < accept:
+                        k = t
+                        p_k = p_t
+                u += 5
+            z[n] = k
+
+            # x by Eq. 4
+            p0 = (1.0 - l) * (nkw[k, w] + b) / (nkw_star[k] + vb)
+            p1 = l * (nckw[s, k] + b) / (nckw_star[c, k] + vb)
+            if uniforms[u] * (p0 + p1) < p0:
+                x[n] = 0
+            else:
+                x[n] = 1
+
+            # include
+            ndk[d, k] += 1
+            nckw[s, k] += 1
+            nckw_star[c, k] += 1
+            nkw[k, w] += 1
+            nkw_star[k] += 1
+
+
+'''
+    Nonzero topic lists of the rows of a count table, for
+    sweep_tokens_sparse
+    @param in_counts    int32 array (rows x k)
+    @return (int64 array (rows + 1) ptr, int32 array topics, int64 array
+            (rows) lens)
+'''
+def build_topic_lists(in_counts):
+    cap = np.minimum(in_counts.sum(axis=1), in_counts.shape[1])
+    ptr = np.zeros(in_counts.shape[0] + 1, dtype=np.int64)
+    np.cumsum(cap, out=ptr[1:])
+    topics = np.empty(ptr[-1], dtype=np.int32)
+    lens = np.zeros(in_counts.shape[0], dtype=np.int64)
+    fill_topic_lists(in_counts, ptr, topics, lens)
+    return ptr, topics, lens
+
+
+if HAVE_KERNEL:
+    _jit = numba.njit(cache=True, nogil=True)
+    # helpers first, the sweeps resolve them when they compile
+    _remove_topic = _jit(_remove_topic)
+    _draw_buckets = _jit(_draw_buckets)
+    _set_inv = _jit(_set_inv)
+    _fill_alias = _jit(_fill_alias)
+    _alias_slot = _jit(_alias_slot)
+    sweep_tokens = _jit(_sweep_tokens)
+    sweep_tokens_sparse = _jit(_sweep_tokens_sparse)
+    sweep_tokens_alias = _jit(_sweep_tokens_alias)
+    fill_topic_lists = _jit(_fill_topic_lists)
+else:
+    sweep_tokens = _sweep_tokens
+    sweep_tokens_sparse = _sweep_tokens_sparse
+    sweep_tokens_alias = _sweep_tokens_alias
+    fill_topic_lists = _fill_topic_lists
+# Vose's method for alias.AliasTable, compiled when numba is installed
+fill_alias = _fill_alias
@@ -0,0 +1,98 @@
+import asyncio, json, random, sys, time
+import numpy as np
+from flags import read_flags
+
+'''
+    Load test of a running server.py
+
+    python loadtest.py <docs file> [--flag value ...]
+        sends documents drawn from <docs file> (input file format) from
+        concurrent keep-alive connections and reports request latency
+        percentiles and throughput
+'''
+
+'''
+    flag -> (setting, type, default)
+'''
+OPTIONS = {
+    "--host": ("host", str, "127.0.0.1"),
+    "--port": ("port", int, 8080),
+    "--concurrency": ("concurrency", int, 16),
+    "--requests": ("requests", int, 1000),
+    "--docs-per-request": ("docs_per_request", int, 1),
+    "--seed": ("seed", int, 0),
+}
+
+'''
+    Sends one POST /infer and reads the reply
+    @return dict parsed reply
+'''
+async def post(in_reader, in_writer, in_host, in_body):
+    payload = in_body.encode("utf-8")
+    in_writer.write(("POST /infer HTTP/1.1\r\nHost: " + in_host + "\r\nContent-Length: " +
+                     str(len(payload)) + "\r\n\r\n").encode("latin-1") + payload)
+    await in_writer.drain()
+    status = (await in_reader.readline()).decode("latin-1")
+    length = 0
+    while True:
+        line = await in_reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    reply = json.loads(await in_reader.readexactly(length))
+    if not status.split()[1].startswith("2"):
+        raise Exception("server replied " + status.strip() + ": " + str(reply))
+    return reply
+
+'''
+    One client connection sending requests until none are left
+    @param in_remaining list, one entry per request still to send
+    @param in_latencies list the request latencies are appended to
+'''
+async def client(in_options, in_lines, in_remaining, in_latencies, in_rng):
+    reader, writer = await asyncio.open_connection(in_options["host"], in_options["port"])
+    try:
+        while in_remaining:
+            in_remaining.pop()
+            body = "\n".join(in_rng.choice(in_lines) for i in range(in_options["docs_per_request"]))
+            start = time.perf_counter()
+            await post(reader, writer, in_options["host"], body)
+            in_latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+'''
+    Runs the load and prints the summary
+'''
+async def run(in_options, in_lines):
+    rng = random.Random(in_options["seed"])
+    remaining = [None] * in_options["requests"]
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(in_options, in_lines, remaining, latencies, rng)
+                           for i in range(in_options["concurrency"])])
+    elapsed = time.perf_counter() - start
+
+    ms = np.array(latencies) * 1000.0
+    print("requests     " + str(len(latencies)) + " x " + str(in_options["docs_per_request"]) + " docs, concurrency " +
+          str(in_options["concurrency"]))
+    print("p50 latency  %.2f ms" % np.percentile(ms, 50))
+    print("p99 latency  %.2f ms" % np.percentile(ms, 99))
+    print("max latency  %.2f ms" % ms.max())
+    print("throughput   %.1f req/s, %.1f docs/s" % (len(latencies) / elapsed,
+                                                    len(latencies) * in_options["docs_per_request"] / elapsed))
+
+
+def main():
+    if len(sys.argv) < 2:
+        raise Exception("Correct usage: python loadtest.py input-test.txt [--port 8080] [--concurrency 16] [--requests 1000]")
+    options = read_flags(sys.argv[2:], OPTIONS)
+    with open(sys.argv[1]) as f:
+        lines = [line.strip() for line in f if line.strip()]
+    asyncio.run(run(options, lines))
+
+
+if __name__ == "__main__":
+    main()
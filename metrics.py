@@ -0,0 +1,203 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json, resource, threading, time
+
+'''
+    Per iteration metrics of a CollapsedSampler
+
+    Every iteration records the seconds spent in each phase (train sweep,
+    estimators, test sweep, likelihood), training tokens per second of the
+    train sweep, the fraction of training tokens whose z or x changed, the
+    bytes of every Data table and the peak RSS, and hands the record to
+    its sinks. Without sinks nothing is recorded: phases get a shared
+    no-op timer and no z / x snapshot is taken.
+'''
+class Metrics:
+
+    '''
+        @param in_sinks list of sinks with emit(record) and close(), or
+                        None for disabled metrics
+    '''
+    def __init__(self, in_sinks=None):
+        self._sinks = [] if in_sinks is None else list(in_sinks)
+        self._record = None
+        self._z = None
+        self._x = None
+
+    '''
+        @return bool whether anything is recorded
+    '''
+    def is_enabled(self):
+        return len(self._sinks) > 0
+
+    '''
+        Starts the record of an iteration
+        @param t    int iteration, from 1
+        @param in_data  Data object holding the training set
+    '''
+    def begin_iteration(self, t, in_data):
+        if not self._sinks:
+            return
+        self._record = {"t": t, "phase_seconds": {}}
+        self._z = in_data.get_z().copy()
+        self._x = in_data.get_x().copy()
+        self._start = time.perf_counter()
+
+    '''
+        Times one phase of the iteration
+        @param in_name  string phase name
+        @return context manager
+    '''
+    def phase(self, in_name):
+        if not self._sinks:
+            return NULL_PHASE
+        return _Phase(self._record["phase_seconds"], in_name)
+
+    '''
+        Completes the record of an iteration and emits it
+        @param in_train Data object holding the training set
+        @param in_test  Data object holding the test set
+        @param in_train_extra   dict of table name -> bytes of tables kept
+                                for the training set outside it, or None
+    '''
+    def end_iteration(self, in_train, in_test, in_train_extra=None):
+        if not self._sinks:
+            return
+        record = self._record
+        record["seconds"] = time.perf_counter() - self._start
+        num_tokens = len(self._z)
+        sweep = record["phase_seconds"].get("train_sweep", 0.0)
+        record["tokens_per_sec"] = num_tokens / sweep if sweep > 0 else 0.0
+        if num_tokens > 0:
+            record["z_changed"] = float((self._z != in_train.get_z()).mean())
+            record["x_changed"] = float((self._x != in_train.get_x()).mean())
+        train_bytes = in_train.get_nbytes()
+        if in_train_extra:
+            train_bytes.update(in_train_extra)
+        record["table_bytes"] = {"train": train_bytes, "test": in_test.get_nbytes()}
+        # ru_maxrss is in KB on Linux
+        record["max_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        for sink in self._sinks:
+            sink.emit(record)
+        self._z = None
+        self._x = None
+
+    '''
+        Closes every sink
+    '''
+    def close(self):
+        for sink in self._sinks:
+            sink.close()
+
+
+'''
+    Adds the seconds spent in a with block to a dict entry
+'''
+class _Phase:
+
+    def __init__(self, in_seconds, in_name):
+        self._seconds = in_seconds
+        self._name = in_name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, in_type, in_value, in_traceback):
+        elapsed = time.perf_counter() - self._start
+        self._seconds[self._name] = self._seconds.get(self._name, 0.0) + elapsed
+        return False
+
+
+'''
+    Phase timer of disabled metrics
+'''
+class _NullPhase:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, in_type, in_value, in_traceback):
+        return False
+
+
+NULL_PHASE = _NullPhase()
+
+
+'''
+    Appends every record as one JSON line to a file
+'''
+class JsonLinesSink:
+
+    '''
+        @param in_path  string file, appended to
+    '''
+    def __init__(self, in_path):
+        self._file = open(in_path, "a")
+
+    def emit(self, in_record):
+        self._file.write(json.dumps(in_record) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+'''
+    Serves the latest record in the Prometheus text format on
+    http://<host>:<port>/metrics from a background thread
+'''
+class PrometheusSink:
+
+    PREFIX = "ccl_"
+
+    '''
+        @param in_port  int port
+        @param in_host  string interface to listen on
+    '''
+    def __init__(self, in_port, in_host="127.0.0.1"):
+        self._text = ""
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = sink._text.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *in_args):
+                pass
+
+        self._server = ThreadingHTTPServer((in_host, in_port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    '''
+        @param in_record    dict of one iteration
+        @return string Prometheus text of the record
+    '''
+    @staticmethod
+    def format(in_record):
+        p = PrometheusSink.PREFIX
+        lines = []
+        for name in ["t", "seconds", "tokens_per_sec", "z_changed", "x_changed", "max_rss_bytes"]:
+            if name in in_record:
+                lines.append(p + name + " " + repr(float(in_record[name])))
+        for phase, secs in sorted(in_record["phase_seconds"].items()):
+            lines.append(p + 'phase_seconds{phase="' + phase + '"} ' + repr(secs))
+        for data, tables in sorted(in_record["table_bytes"].items()):
+            for table, nbytes in sorted(tables.items()):
+                lines.append(p + 'table_bytes{data="' + data + '",table="' + table + '"} ' + str(nbytes))
+        return "\n".join(lines) + "\n"
+
+    def emit(self, in_record):
+        self._text = PrometheusSink.format(in_record)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,142 @@
+import io
+import json
+import numpy as np
+
+'''
+    Writes the results of a run next to the output path given to driver.py
+
+    <out>-theta     one line per training document, its K theta values
+    <out>-phi       one line per word, "word v1 .. vK"
+    <out>-phi<c>    the same for phi_c of the collection with id c, the
+                    c-th line of <out>-collections; integer labels get
+                    ids in numeric order, so "-phi1" is label "1" when
+                    the labels are 0..C-1, other labels in order of first
+                    appearance
+    <out>-trainll   one line per evaluated iteration, "t loglik"
+    <out>-testll    the same for the test set
+    <out>-vocab     the words, one per line in word idx order
+    <out>-collections   the collection labels, one per line in id order
+    <out>-settings.json the model settings (k, lambda, alpha, beta, ..)
+
+    theta, phi and phi_c also get binary .npy sidecars holding the tables
+    exactly as sampled, including the OOV column that the text files
+    leave out; phi_c is kept one row per slot, <out>-slots.npz holds the
+    SlotMap that expands it. Likelihoods are buffered and written with
+    the tables.
+'''
+class OutputWriter:
+
+    # format of every probability in the text files
+    FMT = "%.10g"
+
+    # write buffer of the text files
+    BUFFER = 1 << 20
+
+    # words formatted at a time in the word tables
+    BLOCK_ROWS = 4096
+
+    '''
+        Creates a writer
+        @param in_path  string output path, the files get suffixes, or
+                        None to only record likelihoods
+    '''
+    def __init__(self, in_path):
+        self._path = in_path
+        self._train_ll = []
+        self._test_ll = []
+
+    '''
+        @return string output path
+    '''
+    def get_path(self):
+        return self._path
+
+    '''
+        Records the training log likelihood of an iteration
+        @param t    int iteration, from 1
+        @param in_ll    float log likelihood
+    '''
+    def add_train_ll(self, t, in_ll):
+        self._train_ll.append((t, in_ll))
+
+    '''
+        Records the test log likelihood of an iteration
+        @param t    int iteration, from 1
+        @param in_ll    float log likelihood
+    '''
+    def add_test_ll(self, t, in_ll):
+        self._test_ll.append((t, in_ll))
+
+    '''
+        @return (train, test) float arrays (n x 2) of [t, loglik] rows
+    '''
+    def get_log_likelihoods(self):
+        return self._as_rows(self._train_ll), self._as_rows(self._test_ll)
+
+    '''
+        Continues from get_log_likelihoods() of an earlier writer
+        @param in_train float array (n x 2) of [t, loglik] rows
+        @param in_test  float array (n x 2) of [t, loglik] rows
+    '''
+    def set_log_likelihoods(self, in_train, in_test):
+        self._train_ll = [(int(t), float(ll)) for t, ll in in_train]
+        self._test_ll = [(int(t), float(ll)) for t, ll in in_test]
+
+    def _as_rows(self, in_lls):
+        return np.array(in_lls, dtype=float).reshape(-1, 2)
+
+    '''
+        Writes every output file
+        @param in_data  Data object holding the training set with theta,
+                        phi and phi_c estimated
+        @param in_settings  dict of the model settings, or None
+    '''
+    def write(self, in_data, in_settings=None):
+        tokens = in_data.get_vocab().get_tokens()
+        V = len(tokens)
+
+        theta = in_data.get_theta()
+        phi = in_data.get_phi()
+        phi_c = in_data.get_phi_c()
+        np.save(self._path + "-theta.npy", theta)
+        np.save(self._path + "-phi.npy", phi)
+        np.save(self._path + "-phi_c.npy", phi_c)
+        slot_map = in_data.get_slot_map()
+        np.savez(self._path + "-slots.npz", **slot_map.to_arrays())
+        labels = in_data.get_corpus().get_labels().get_tokens()
+
+        with open(self._path + "-theta", "w", buffering=OutputWriter.BUFFER) as f:
+            np.savetxt(f, theta, fmt=OutputWriter.FMT)
+        self._write_word_table(self._path + "-phi", tokens, phi[:, :V])
+        for c in range(slot_map.get_num_collections()):
+            table = slot_map.collection_table(phi_c, c)
+            # named by id, labels may not be valid in a path
+            self._write_word_table(self._path + "-phi" + str(c), tokens, table[:, :V])
+
+        self._write_ll(self._path + "-trainll", self._train_ll)
+        self._write_ll(self._path + "-testll", self._test_ll)
+        with open(self._path + "-vocab", "w", buffering=OutputWriter.BUFFER) as f:
+            f.write("".join(token + "\n" for token in tokens))
+        with open(self._path + "-collections", "w") as f:
+            f.write("".join(label + "\n" for label in labels))
+        if in_settings is not None:
+            with open(self._path + "-settings.json", "w") as f:
+                json.dump(in_settings, f)
+
+    '''
+        Writes a k x w table transposed, one "word v1 .. vK" line per word,
+        formatting BLOCK_ROWS words at a time
+    '''
+    def _write_word_table(self, in_path, in_tokens, in_table):
+        rows = in_table.T
+        with open(in_path, "w", buffering=OutputWriter.BUFFER) as f:
+            for lo in range(0, len(in_tokens), OutputWriter.BLOCK_ROWS):
+                hi = min(lo + OutputWriter.BLOCK_ROWS, len(in_tokens))
+                block = io.StringIO()
+                np.savetxt(block, rows[lo:hi], fmt=OutputWriter.FMT)
+                lines = block.getvalue().splitlines()
+                f.write("".join(token + " " + line + "\n" for token, line in zip(in_tokens[lo:hi], lines)))
+
+    def _write_ll(self, in_path, in_lls):
+        with open(in_path, "w", buffering=OutputWriter.BUFFER) as f:
+            np.savetxt(f, self._as_rows(in_lls), fmt="%d %.10f")
@@ -0,0 +1,122 @@
+import multiprocessing as mp
+import numpy as np
+from data import Data
+from shared import attach, release, share_array
+
+'''
+    Approximate distributed Gibbs sweeps (AD-LDA, Newman et al. 2009)
+
+    Training documents are split into one contiguous shard per worker
+    process. Each sweep a worker copies the topic-word counts from shared
+    memory, runs an ordinary sweep over its shard against that snapshot
+    and sends back only the cells it changed. The master adds every
+    worker's changes to the shared counts once all workers are done.
+    Document-topic rows and the z / x of a shard are owned by one worker
+    and live in shared memory, so they are never copied.
+'''
+class ParallelSweeper:
+
+    '''
+        Starts the workers, moving the tables of in_data into shared memory
+        @param in_cs    CollapsedSampler whose settings the workers copy
+        @param in_data  Data object holding the training set
+        @param in_workers   int number of worker processes
+    '''
+    def __init__(self, in_cs, in_data, in_workers):
+        self._data = in_data
+        self._shms = []
+
+        specs = []
+        views = []
+        for arr in [in_data._ndk_map, in_data._nckw_map, in_data.get_z(), in_data.get_x()]:
+            shm, view, spec = share_array(arr)
+            self._shms.append(shm)
+            views.append(view)
+            specs.append(spec)
+        ndk, nckw, z, x = views
+        in_data.set_count_tables(ndk, nckw, in_data._nckw_map_star.copy())
+        in_data.set_assignments(z, x)
+
+        corpus = in_data.get_corpus()
+        bounds = np.linspace(0, corpus.get_num_docs(), in_workers + 1).astype(int)
+        settings = in_cs.get_settings()
+        seeds = in_cs._rng.integers(2 ** 63, size=in_workers)
+
+        self._conns = []
+        self._procs = []
+        for i in range(in_workers):
+            start, end = int(bounds[i]), int(bounds[i + 1])
+            if start == end:
+                continue
+            parent, child = mp.Pipe()
+            proc = mp.Process(target=_worker_main, args=(child, specs, start, end,
+                int(corpus.get_offsets()[start]), corpus.slice(start, end), in_data.get_slot_map(),
+                settings, int(seeds[i])))
+            proc.daemon = True
+            proc.start()
+            child.close()
+            self._conns.append(parent)
+            self._procs.append(proc)
+
+    '''
+        One sweep over all training documents, sharded over the workers
+    '''
+    def sweep(self):
+        for conn in self._conns:
+            conn.send("sweep")
+        # workers diff against the shared counts, so they must all be done
+        # before any delta is applied
+        deltas = [conn.recv() for conn in self._conns]
+        flat = self._data._nckw_map.reshape(-1)
+        for idx, delta in deltas:
+            np.add.at(flat, idx, delta)
+        self._data.refresh_totals()
+
+    '''
+        Stops the workers and moves the tables back into private memory
+    '''
+    def close(self):
+        for conn in self._conns:
+            conn.send("stop")
+        for proc in self._procs:
+            proc.join()
+        data = self._data
+        data.set_count_tables(data._ndk_map.copy(), data._nckw_map.copy(), data._nckw_map_star)
+        data.set_assignments(data.get_z().copy(), data.get_x().copy())
+        release(self._shms, True)
+        self._shms = []
+
+
+'''
+    Worker loop: sweeps documents start .. end - 1 (tokens from first on)
+    on request against a snapshot of the shared topic-word counts and
+    replies with the changed cells
+'''
+def _worker_main(in_conn, in_specs, in_start, in_end, in_first, in_corpus, in_slot_map, in_settings,
+                 in_seed):
+    # imported here, collapsed imports this module
+    from collapsed import CollapsedSampler
+
+    shms, (ndk, nckw, z, x) = attach(in_specs)
+    last = in_first + in_corpus.get_num_tokens()
+
+    cs = CollapsedSampler.from_settings(in_corpus, in_settings, in_seed)
+    local_nckw = nckw.copy()
+    local_nckw_star = np.zeros((in_slot_map.get_num_collections(), nckw.shape[1]), dtype=np.int32)
+    in_slot_map.sum_collections(local_nckw, local_nckw_star)
+    data = Data(in_corpus, x[in_first:last], z[in_first:last],
+                ndk[in_start:in_end], local_nckw, local_nckw_star,
+                None, None, None, in_slot_map)
+
+    while True:
+        msg = in_conn.recv()
+        if msg != "sweep":
+            break
+        data.load_topic_word_counts(nckw)
+        cs.sweep_train(data)
+        delta = (data._nckw_map - nckw).reshape(-1)
+        idx = np.flatnonzero(delta)
+        in_conn.send((idx, delta[idx]))
+
+    del data, ndk, nckw, z, x
+    release(shms)
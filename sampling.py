@@ -0,0 +1,95 @@
+import numpy as np
+
+'''
+    Draws from unnormalized discrete distributions
+    Each draw costs one cumulative sum and one uniform, uniforms can be
+    prefetched in blocks (e.g. one block per document)
+'''
+class CategoricalSampler:
+
+    '''
+        Creates a sampler
+        @param in_rng   numpy.random.Generator, or an int seed / None
+                        to create one
+    '''
+    def __init__(self, in_rng=None):
+        if not isinstance(in_rng, np.random.Generator):
+            in_rng = np.random.default_rng(in_rng)
+        self._rng = in_rng
+        self._uniforms = np.empty(0)
+        self._pos = 0
+
+    '''
+        @return numpy.random.Generator used for every draw
+    '''
+    def get_rng(self):
+        return self._rng
+
+    '''
+        @return (dict generator state, float array of the prefetched
+                uniforms not used yet)
+    '''
+    def get_state(self):
+        return self._rng.bit_generator.state, self._uniforms[self._pos:]
+
+    '''
+        Continues from a get_state() of an earlier sampler
+        @param in_rng_state dict generator state
+        @param in_uniforms  float array of prefetched uniforms to use first
+    '''
+    def set_state(self, in_rng_state, in_uniforms):
+        self._rng.bit_generator.state = in_rng_state
+        self._uniforms = np.array(in_uniforms, dtype=float)
+        self._pos = 0
+
+    '''
+        Draws a block of uniforms that the next draws consume first
+        @param in_n     int number of uniforms, e.g. 2 x tokens in a document
+    '''
+    def prefetch(self, in_n):
+        self._uniforms = self._rng.random(in_n)
+        self._pos = 0
+
+    '''
+        @return float uniform in [0, 1), from the prefetched block if any left
+    '''
+    def uniform(self):
+        if self._pos < len(self._uniforms):
+            u = self._uniforms[self._pos]
+            self._pos += 1
+            return u
+        return self._rng.random()
+
+    '''
+        Samples an index proportional to the given weights
+        @param prob_dist    array or list of nonnegative weights
+        @return int index
+    '''
+    def sample(self, prob_dist):
+        cdf = np.cumsum(prob_dist)
+        u = self.uniform() * cdf[-1]
+        idx = int(np.searchsorted(cdf, u, side="right"))
+        # u == total can only happen through rounding or an all-zero row
+        return min(idx, len(cdf) - 1)
+
+    '''
+        Samples one index per row of a weight matrix in a single pass
+        @param prob_dists   2d array (n x k) of nonnegative weights
+        @return int array (n)
+    '''
+    def sample_rows(self, prob_dists):
+        cdf = np.cumsum(prob_dists, axis=1)
+        u = self._rng.random(cdf.shape[0]) * cdf[:, -1]
+        idx = (cdf <= u[:, None]).sum(axis=1)
+        return np.minimum(idx, cdf.shape[1] - 1)
+
+    '''
+        Two-way draw without building a distribution
+        @param p0   float weight of 0
+        @param p1   float weight of 1
+        @return int 0 or 1
+    '''
+    def bernoulli(self, p0, p1):
+        if self.uniform() * (p0 + p1) < p0:
+            return 0
+        return 1
@@ -0,0 +1,207 @@
+import asyncio, json, sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from flags import read_flags
+from inference import Inferencer
+
+'''
+    Inference server for a trained model
+
+    python server.py <output path> [--flag value ...]
+        loads the model written for <output path> once and serves
+        POST /infer     body: one document per line in the input file
+                        format, "classification words"
+                        reply: {"theta": [[..K..], ..],
+                                "top_topics": [[k, ..], ..]}
+        GET /health     reply: {"status": "ok"}
+    over HTTP/1.1 with keep-alive. Documents of requests arriving close
+    together are folded in as one batch (see MicroBatcher).
+'''
+
+'''
+    Gathers the documents of concurrent requests into batches for the
+    vectorized fold-in. A batch is run as soon as it holds max_batch
+    documents or max_wait seconds passed since its first request.
+'''
+class MicroBatcher:
+
+    '''
+        @param in_inferencer    Inferencer holding the model
+        @param in_max_batch     int documents per batch at most
+        @param in_max_wait      float seconds the first request of a batch
+                                waits for others
+        @param in_num_sweeps    int sweeps per batch, None for the default
+    '''
+    def __init__(self, in_inferencer, in_max_batch, in_max_wait, in_num_sweeps=None):
+        self._inferencer = in_inferencer
+        self._max_batch = in_max_batch
+        self._max_wait = in_max_wait
+        self._num_sweeps = in_num_sweeps
+        self._queue = asyncio.Queue()
+        # one thread: batches run in order, the event loop keeps accepting
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._task = None
+
+    '''
+        Starts the batching loop on the running event loop
+    '''
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    '''
+        Folds in the documents of one request
+        @param in_docs  list of lists of [classification words]
+        @return float array (d x k) theta
+    '''
+    async def infer(self, in_docs):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((in_docs, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self._queue.get()]
+            size = len(pending[0][0])
+            deadline = loop.time() + self._max_wait
+            while size < self._max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                pending.append(item)
+                size += len(item[0])
+
+            docs = [doc for request_docs, _ in pending for doc in request_docs]
+            try:
+                theta = await loop.run_in_executor(self._executor, self._inferencer.infer,
+                                                   docs, self._num_sweeps)
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            start = 0
+            for request_docs, future in pending:
+                future.set_result(theta[start:start + len(request_docs)])
+                start += len(request_docs)
+
+
+'''
+    HTTP front end of a MicroBatcher
+'''
+class InferenceServer:
+
+    '''
+        @param in_batcher   MicroBatcher
+        @param in_labels    Vocabulary of the collection labels accepted
+        @param in_top   int topics listed per document
+    '''
+    def __init__(self, in_batcher, in_labels, in_top):
+        self._batcher = in_batcher
+        self._labels = in_labels
+        self._top = in_top
+
+    '''
+        Serves until cancelled
+    '''
+    async def serve(self, in_host, in_port):
+        self._batcher.start()
+        server = await asyncio.start_server(self._handle, in_host, in_port)
+        print("serving on " + in_host + ":" + str(in_port))
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, in_reader, in_writer):
+        try:
+            while True:
+                request_line = await in_reader.readline()
+                if not request_line:
+                    break
+                method, path = request_line.decode("latin-1").split()[:2]
+                headers = {}
+                while True:
+                    line = await in_reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await in_reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, reply = await self._route(method, path, body)
+                payload = json.dumps(reply).encode("utf-8")
+                in_writer.write(("HTTP/1.1 " + status + "\r\nContent-Type: application/json\r\n"
+                                 "Content-Length: " + str(len(payload)) + "\r\n\r\n").encode("latin-1")
+                                + payload)
+                await in_writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            in_writer.close()
+
+    async def _route(self, in_method, in_path, in_body):
+        if in_method == "GET" and in_path == "/health":
+            return "200 OK", {"status": "ok"}
+        if in_method != "POST" or in_path != "/infer":
+            return "404 Not Found", {"error": "unknown endpoint " + in_method + " " + in_path}
+
+        docs = [line.split() for line in in_body.decode("utf-8").splitlines()]
+        docs = [doc for doc in docs if doc]
+        error = self.check(docs)
+        if error is not None:
+            return "400 Bad Request", {"error": error}
+        try:
+            theta = await self._batcher.infer(docs)
+        except Exception as e:
+            return "500 Internal Server Error", {"error": str(e)}
+        top = np.argsort(-theta, axis=1)[:, :self._top]
+        return "200 OK", {"theta": theta.tolist(), "top_topics": top.tolist()}
+
+    '''
+        Validates the collection labels of a request, so one bad request
+        cannot fail the batch it would share
+        @param in_docs  list of lists of [classification words]
+        @return string error, None if every document is valid
+    '''
+    def check(self, in_docs):
+        num_collections = len(self._labels)
+        for doc in in_docs:
+            if self._labels.get_idx(doc[0]) >= num_collections:
+                return "collection " + doc[0] + " is not in the model, it has " + \
+                       ", ".join(self._labels.get_tokens())
+        return None
+
+
+'''
+    flag -> (setting, type, default)
+'''
+OPTIONS = {
+    "--host": ("host", str, "127.0.0.1"),
+    "--port": ("port", int, 8080),
+    "--max-batch": ("max_batch", int, 256),
+    "--max-wait-ms": ("max_wait_ms", float, 5.0),
+    "--sweeps": ("sweeps", int, Inferencer.NUM_SWEEPS),
+    "--top": ("top", int, 3),
+    "--seed": ("seed", int, None),
+}
+
+
+def main():
+    if len(sys.argv) < 2:
+        raise Exception("Correct usage: python server.py output.txt [--port 8080] [--max-batch 256] [--max-wait-ms 5]")
+    options = read_flags(sys.argv[2:], OPTIONS)
+    inferencer = Inferencer.load(sys.argv[1], options["sweeps"], options["seed"])
+    batcher = MicroBatcher(inferencer, options["max_batch"], options["max_wait_ms"] / 1000.0)
+    server = InferenceServer(batcher, inferencer.get_labels(), options["top"])
+    try:
+        asyncio.run(server.serve(options["host"], options["port"]))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+from multiprocessing import shared_memory
+import numpy as np
+
+'''
+    Arrays in shared memory blocks, for the worker processes of parallel,
+    chains and inference
+
+    The owner copies an array into a new block with share_array and hands
+    its spec (name, shape, dtype) to the workers, which map it back with
+    attach. Both sides close their blocks with release once no array
+    views them any more; only the owner unlinks.
+'''
+
+'''
+    Copies an array into a new shared memory block
+    @param in_arr   array
+    @return (SharedMemory, array view on the block, (name, shape, dtype)
+            spec a worker maps it back with)
+'''
+def share_array(in_arr):
+    shm = shared_memory.SharedMemory(create=True, size=max(in_arr.nbytes, 1))
+    arr = np.ndarray(in_arr.shape, dtype=in_arr.dtype, buffer=shm.buf)
+    np.copyto(arr, in_arr)
+    return shm, arr, (shm.name, arr.shape, arr.dtype.str)
+
+'''
+    Maps shared blocks back to arrays
+    @param in_specs list of (name, shape, dtype) from share_array
+    @return (list of SharedMemory, list of array views), in spec order
+'''
+def attach(in_specs):
+    shms = [shared_memory.SharedMemory(name=name) for name, _, _ in in_specs]
+    arrays = [np.ndarray(shape, dtype=dtype, buffer=shm.buf) for shm, (_, shape, dtype) in zip(shms, in_specs)]
+    return shms, arrays
+
+'''
+    Closes shared blocks, every view on them must be gone
+    @param in_shms  list of SharedMemory
+    @param in_unlink    bool whether to free the blocks too (the owner)
+'''
+def release(in_shms, in_unlink=False):
+    for shm in in_shms:
+        shm.close()
+        if in_unlink:
+            shm.unlink()
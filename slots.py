@@ -0,0 +1,260 @@
+import numpy as np
+
+'''
+    Compact layout of the per collection topic-word tables
+
+    Instead of a dense c x k x w+1 block, every (collection, word) pair
+    that occurs in the training set gets one slot, and the per collection
+    tables (nckw, phi_c) hold one k row per slot. Slots are sorted by
+    collection, then word, so collection c owns slots indptr[c] ..
+    indptr[c + 1] - 1 (CSR style). The last slot of every collection is
+    its unseen slot: its counts stay 0, so its phi_c row is the value
+    b / (nck* + Vb) of every word the collection never had in training,
+    including the OOV word. Memory scales with the pairs that occur, not
+    with c x w.
+
+    Two layouts share this interface. SlotMap (sparse) keeps only the
+    pairs that occur and finds a slot by binary search. DenseSlotMap
+    keeps a slot for every pair, c x (w + 2) rows, and computes a slot
+    with one multiply-add. build_slot_map picks one by the fraction of
+    pairs that occur.
+'''
+LAYOUTS = ["auto", "dense", "sparse"]
+
+# fraction of (collection, word) pairs occurring from which "auto" picks
+# the dense layout: at most twice the rows of the sparse one, no searches
+DENSE_THRESHOLD = 0.5
+
+'''
+    Creates the slot map of a training set
+    @param in_token_c   int array (# tokens) collection of every token
+    @param in_words     int array (# tokens) word idx of every token
+    @param in_C int number of collections
+    @param in_V int number of vocab words
+    @param in_layout    string "dense", "sparse" or "auto" to choose by
+                        density
+    @param in_threshold float density from which "auto" is dense
+    @return SlotMap or DenseSlotMap
+'''
+def build_slot_map(in_token_c, in_words, in_C, in_V, in_layout="auto", in_threshold=DENSE_THRESHOLD):
+    if in_layout not in LAYOUTS:
+        raise Exception("unknown collection layout " + str(in_layout) + ", expected one of " + ", ".join(LAYOUTS))
+    if in_layout == "dense":
+        return DenseSlotMap(in_C, in_V)
+    sparse = SlotMap.from_tokens(in_token_c, in_words, in_C, in_V)
+    if in_layout == "auto" and sparse.get_density() >= in_threshold:
+        return DenseSlotMap(in_C, in_V)
+    return sparse
+
+'''
+    Recreates a slot map of either layout from to_arrays
+    @param in_arrays    dict from to_arrays
+    @return SlotMap or DenseSlotMap
+'''
+def slot_map_from_arrays(in_arrays):
+    V = int(in_arrays["V"])
+    if "dense" in in_arrays and int(in_arrays["dense"]):
+        return DenseSlotMap(len(in_arrays["indptr"]) - 1, V)
+    return SlotMap(np.asarray(in_arrays["slot_w"]), np.asarray(in_arrays["indptr"]), V)
+
+
+class SlotMap:
+
+    '''
+        Creates a slot map
+        @param in_slot_w    int32 array (s) word of every slot, w + 1 for
+                            unseen slots
+        @param in_indptr    int64 array (c + 1) first slot of every
+                            collection
+        @param in_V int number of vocab words, the OOV idx not included
+    '''
+    def __init__(self, in_slot_w, in_indptr, in_V):
+        self._slot_w = in_slot_w
+        self._indptr = in_indptr
+        self._V = in_V
+        C = len(in_indptr) - 1
+        self._slot_c = np.repeat(np.arange(C, dtype=np.int32), np.diff(in_indptr))
+        # slots are sorted by key, lookups are binary searches
+        self._keys = self._slot_c.astype(np.int64) * (in_V + 2) + in_slot_w
+        # word column of every slot in the w + 1 wide global tables, the
+        # OOV column for unseen slots (they never hold counts)
+        self._slot_col = np.minimum(in_slot_w, in_V)
+
+    '''
+        Slots of the (collection, word) pairs of training tokens
+        @param in_token_c   int array (# tokens) collection of every token
+        @param in_words     int array (# tokens) word idx of every token
+        @param in_C int number of collections
+        @param in_V int number of vocab words
+        @return SlotMap
+    '''
+    @staticmethod
+    def from_tokens(in_token_c, in_words, in_C, in_V):
+        stride = in_V + 2
+        keys = np.asarray(in_token_c, dtype=np.int64) * stride + in_words
+        unseen = np.arange(in_C, dtype=np.int64) * stride + in_V + 1
+        keys = np.union1d(keys, unseen)
+        indptr = np.searchsorted(keys // stride, np.arange(in_C + 1)).astype(np.int64)
+        return SlotMap((keys % stride).astype(np.int32), indptr, in_V)
+
+    '''
+        @return int number of slots
+    '''
+    def get_num_slots(self):
+        return len(self._slot_w)
+
+    '''
+        @return float fraction of the c x (w + 1) pairs with a slot, the
+                unseen slots not counted
+    '''
+    def get_density(self):
+        C = self.get_num_collections()
+        return (self.get_num_slots() - C) / float(max(C * (self._V + 1), 1))
+
+    '''
+        @return string "sparse" or "dense"
+    '''
+    def get_layout(self):
+        return "sparse"
+
+    '''
+        @return int number of collections
+    '''
+    def get_num_collections(self):
+        return len(self._indptr) - 1
+
+    '''
+        @return int number of vocab words, the OOV idx not included
+    '''
+    def get_V(self):
+        return self._V
+
+    '''
+        @return int32 array (s) word of every slot, w + 1 for unseen slots
+    '''
+    def get_slot_w(self):
+        return self._slot_w
+
+    '''
+        @return int32 array (s) collection of every slot
+    '''
+    def get_slot_c(self):
+        return self._slot_c
+
+    '''
+        @return int32 array (s) column of every slot in a w + 1 wide table
+    '''
+    def get_slot_col(self):
+        return self._slot_col
+
+    '''
+        @return int64 array (c + 1) first slot of every collection
+    '''
+    def get_indptr(self):
+        return self._indptr
+
+    '''
+        @return int64 array (c) unseen slot of every collection
+    '''
+    def get_unseen_slots(self):
+        return self._indptr[1:] - 1
+
+    '''
+        @param in_c int array collections
+        @param in_w int array word idx, the same shape
+        @return int64 array slot of every pair, the unseen slot of its
+                collection if the pair has none
+    '''
+    def get_slots(self, in_c, in_w):
+        keys = np.asarray(in_c, dtype=np.int64) * (self._V + 2) + in_w
+        pos = np.minimum(np.searchsorted(self._keys, keys), len(self._keys) - 1)
+        return np.where(self._keys[pos] == keys, pos, self._indptr[np.asarray(in_c) + 1] - 1)
+
+    '''
+        @param in_c int collection
+        @param in_w int word idx
+        @return int slot of the pair, the unseen slot of c if it has none
+    '''
+    def get_slot(self, in_c, in_w):
+        key = in_c * (self._V + 2) + in_w
+        pos = int(np.searchsorted(self._keys, key))
+        if pos < len(self._keys) and self._keys[pos] == key:
+            return pos
+        return int(self._indptr[in_c + 1]) - 1
+
+    '''
+        Expands the rows of one collection to a dense table
+        @param in_table array (s x k), e.g. phi_c
+        @param in_c int collection
+        @return array (k x w+1), words without a slot get the unseen row
+    '''
+    def collection_table(self, in_table, in_c):
+        lo, hi = int(self._indptr[in_c]), int(self._indptr[in_c + 1]) - 1
+        dense = np.repeat(in_table[hi][:, None], self._V + 1, axis=1)
+        dense[:, self._slot_w[lo:hi]] = in_table[lo:hi].T
+        return dense
+
+    '''
+        Sums slot rows into a w + 1 wide table, in place
+        @param in_table array (s x k)
+        @param out  array (k x w+1), overwritten
+    '''
+    def sum_words(self, in_table, out):
+        out[...] = 0
+        np.add.at(out.T, self._slot_col, in_table)
+
+    '''
+        Sums slot rows per collection, in place
+        @param in_table array (s x k)
+        @param out  array (c x k), overwritten
+    '''
+    def sum_collections(self, in_table, out):
+        # every collection owns at least its unseen slot, no empty range
+        np.add.reduceat(in_table, self._indptr[:-1], axis=0, out=out)
+
+    '''
+        @return dict of the arrays that recreate this map with
+                slot_map_from_arrays
+    '''
+    def to_arrays(self):
+        return {"slot_w": self._slot_w, "indptr": self._indptr, "V": np.array(self._V),
+                "dense": np.array(0)}
+
+
+'''
+    Dense layout: collection c owns slots c (w + 2) .. c (w + 2) + w + 1,
+    one per word idx (the OOV idx included) and the unseen slot last.
+    Slots are computed, not searched.
+'''
+class DenseSlotMap(SlotMap):
+
+    '''
+        @param in_C int number of collections
+        @param in_V int number of vocab words, the OOV idx not included
+    '''
+    def __init__(self, in_C, in_V):
+        stride = in_V + 2
+        SlotMap.__init__(self, np.tile(np.arange(stride, dtype=np.int32), in_C),
+                         np.arange(in_C + 1, dtype=np.int64) * stride, in_V)
+        # lookups need no keys
+        self._keys = None
+
+    '''
+        @return string "dense"
+    '''
+    def get_layout(self):
+        return "dense"
+
+    def get_slots(self, in_c, in_w):
+        return np.asarray(in_c, dtype=np.int64) * (self._V + 2) + in_w
+
+    def get_slot(self, in_c, in_w):
+        return in_c * (self._V + 2) + in_w
+
+    '''
+        @return dict of the arrays that recreate this map with
+                slot_map_from_arrays, the slots themselves are implied
+    '''
+    def to_arrays(self):
+        return {"slot_w": np.zeros(0, dtype=np.int32), "indptr": self._indptr, "V": np.array(self._V),
+                "dense": np.array(1)}
@@ -0,0 +1,224 @@
+import numpy as np
+from kernel import build_topic_lists, sweep_tokens_sparse
+
+'''
+    SparseLDA style sampler for z_d_i (Yao, Mimno & McCallum 2009)
+
+    With the document denominator dropped (it is constant in k)
+        p(z = k) prop to (ndk + a) (nkw + b) / (nk* + Vb)
+    splits into three buckets
+        s = sum_k a b / (nk* + Vb)            smoothing, changes rarely
+        r = sum_k ndk b / (nk* + Vb)          nonzero only for topics in d
+        q = sum_k (ndk + a) nkw / (nk* + Vb)  nonzero only for topics of w
+    s and the per topic factors are cached and patched on every count
+    change, so a draw only touches the topics present in d or w.
+
+    Counts come in branches: branch 0 uses the global nkw / nk* counts
+    (x_d_i = 0), branch 1 + c the counts of collection c (x_d_i = 1).
+
+    sweep_compiled runs a whole sweep in kernel.sweep_tokens_sparse, with
+    the topics of every word and slot row kept as flat arrays. Against
+    the compiled "exact" sweep it pays off from about K = 150 on.
+'''
+class SparseZSampler:
+
+    '''
+        Creates a sparse z sampler
+        @param in_sampler   CategoricalSampler providing the uniforms
+        @param in_k int number of topics
+        @param in_a float alpha
+        @param in_b float beta
+    '''
+    def __init__(self, in_sampler, in_k, in_a, in_b):
+        self._sampler = in_sampler
+        self._K = in_k
+        self._a = in_a
+        self._b = in_b
+
+        self._data = None
+        self._vb = 0.0
+        self._inv = []          # per branch, k array of 1 / (nk* + Vb)
+        self._s = []            # per branch, float smoothing mass
+        self._word_topics = []  # per branch, dict w -> set of k with nkw > 0
+
+        self._d = -1
+        self._doc_topics = set()
+        self._r = {}            # branch -> float doc mass
+        self._coef = {}         # branch -> k array of (ndk + a) / (nk* + Vb)
+
+    '''
+        @param in_branch    int 0 for global counts, 1 + c for collection c
+        @return int32 array (k) of topic totals for the branch
+    '''
+    def _topic_totals(self, in_branch):
+        if in_branch == 0:
+            return self._data.get_n_k_star_vec()
+        return self._data.get_n_ck_star_vec(in_branch - 1)
+
+    '''
+        @param in_branch    int 0 for global counts, 1 + c for collection c
+        @param in_w int word idx
+        @return int32 array (k) of word counts for the branch
+    '''
+    def _word_counts(self, in_branch, in_w):
+        if in_branch == 0:
+            return self._data.get_n_k_w_vec(in_w)
+        return self._data.get_n_ck_w_vec(in_branch - 1, in_w)
+
+    '''
+        Rebuilds every cache from the counts, once per sweep
+        (also removes any drift of the incrementally kept sums)
+        @param in_data  Data object being sampled
+        @param in_c     int number of collections
+    '''
+    def begin_sweep(self, in_data, in_c):
+        self._data = in_data
+        self._vb = in_data.get_V() * self._b
+        self._inv, self._s, self._word_topics = [], [], []
+        for branch in range(in_c + 1):
+            inv = 1.0 / (self._topic_totals(branch) + self._vb)
+            self._inv.append(inv)
+            self._s.append(self._a * self._b * inv.sum())
+            if branch == 0:
+                ks, ws = np.nonzero(in_data._nkw_map)
+            else:
+                # the slot rows of the collection, one per word it uses
+                slot_map = in_data.get_slot_map()
+                lo, hi = slot_map.get_indptr()[branch - 1:branch + 1]
+                rows, ks = np.nonzero(in_data._nckw_map[lo:hi])
+                ws = slot_map.get_slot_w()[lo + rows]
+            word_topics = {}
+            for k, w in zip(ks.tolist(), ws.tolist()):
+                word_topics.setdefault(w, set()).add(k)
+            self._word_topics.append(word_topics)
+        self._d = -1
+
+    '''
+        One training sweep in the compiled kernel
+        @param in_data  Data object being sampled
+        @param in_l     float lambda
+        @param in_rng   numpy.random.Generator for the uniforms
+    '''
+    def sweep_compiled(self, in_data, in_l, in_rng):
+        corpus = in_data.get_corpus()
+        g_ptr, g_topics, g_lens = build_topic_lists(in_data._nkw_map.T)
+        c_ptr, c_topics, c_lens = build_topic_lists(in_data._nckw_map)
+        uniforms = in_rng.random(2 * corpus.get_num_tokens())
+        sweep_tokens_sparse(corpus.get_words(), corpus.get_offsets(), corpus.get_doc_c(), in_data.get_slots(),
+                            in_data.get_z(), in_data.get_x(), in_data._ndk_map, in_data._nckw_map,
+                            in_data._nckw_map_star, in_data._nkw_map, in_data._nkw_map_star,
+                            float(in_l), float(self._a), float(self._b), float(in_data.get_V() * self._b),
+                            uniforms, g_ptr, g_topics, g_lens, c_ptr, c_topics, c_lens)
+
+    '''
+        Sets up the document buckets for doc d
+        @param in_c     int corpus number
+        @param in_d     int document number
+    '''
+    def begin_document(self, in_c, in_d):
+        self._d = in_d
+        ndk = self._data.get_n_d_k_vec(in_d)
+        self._doc_topics = set(np.flatnonzero(ndk).tolist())
+        self._r, self._coef = {}, {}
+        for branch in (0, 1 + in_c):
+            inv = self._inv[branch]
+            self._r[branch] = self._b * float(np.dot(ndk, inv))
+            self._coef[branch] = (ndk + self._a) * inv
+
+    '''
+        Patches the caches after the count of topic k changed by delta
+        for word w in doc d of collection c
+    '''
+    def _update(self, in_c, in_d, in_w, in_k, in_delta):
+        ndk = int(self._data.get_n_d_k(in_d, in_k))
+        old_ndk = ndk - in_delta
+        if ndk == 0:
+            self._doc_topics.discard(in_k)
+        else:
+            self._doc_topics.add(in_k)
+        for branch in (0, 1 + in_c):
+            inv = self._inv[branch]
+            old_inv = inv[in_k]
+            new_inv = 1.0 / (self._topic_totals(branch)[in_k] + self._vb)
+            inv[in_k] = new_inv
+            self._s[branch] += self._a * self._b * (new_inv - old_inv)
+            self._r[branch] += self._b * (ndk * new_inv - old_ndk * old_inv)
+            self._coef[branch][in_k] = (ndk + self._a) * new_inv
+
+            nkw = self._word_counts(branch, in_w)[in_k]
+            topics = self._word_topics[branch]
+            if nkw == 0:
+                topics[in_w].discard(in_k)
+            elif nkw == 1 and in_delta > 0:
+                topics.setdefault(in_w, set()).add(in_k)
+
+    '''
+        To be called after Data.exclude_token removed the token
+        @param in_c     int corpus number
+        @param in_d     int document number
+        @param in_w     int word idx
+        @param in_z     int class the token had
+    '''
+    def exclude(self, in_c, in_d, in_w, in_z):
+        self._update(in_c, in_d, in_w, in_z, -1)
+
+    '''
+        To be called after Data.include_token added the token back
+        @param in_c     int corpus number
+        @param in_d     int document number
+        @param in_w     int word idx
+        @param in_z     int class the token now has
+    '''
+    def include(self, in_c, in_d, in_w, in_z):
+        self._update(in_c, in_d, in_w, in_z, 1)
+
+    '''
+        Draws z_d_i from the same conditional as calc_z_d_i
+        @param in_c     int corpus number
+        @param in_d     int document number
+        @param in_w     int word idx
+        @param in_x_d_i int whether we use corpus or global counts
+        @param in_z     int class the token had before this draw (unused,
+                        the draw is exact)
+        @return int class
+    '''
+    def sample(self, in_c, in_d, in_w, in_x_d_i, in_z):
+        branch = 0 if in_x_d_i == 0 else 1 + in_c
+
+        # the buckets hold few topics, plain loops beat building arrays
+        word_topics = self._word_topics[branch].get(in_w)
+        q_topics, q_terms, q = [], [], 0.0
+        if word_topics:
+            coef = self._coef[branch]
+            counts = self._word_counts(branch, in_w)
+            q_topics = list(word_topics)
+            q_terms = [float(coef[k] * counts[k]) for k in q_topics]
+            q = sum(q_terms)
+        r = self._r[branch]
+        s = self._s[branch]
+
+        u = self._sampler.uniform() * (s + r + q)
+        if u < q:
+            return q_topics[self._walk(q_terms, u)]
+        u -= q
+        if u < r and self._doc_topics:
+            ndk = self._data.get_n_d_k_vec(in_d)
+            inv = self._inv[branch]
+            r_topics = list(self._doc_topics)
+            r_terms = [self._b * float(ndk[k] * inv[k]) for k in r_topics]
+            return r_topics[self._walk(r_terms, u)]
+        u -= r
+        s_terms = self._a * self._b * self._inv[branch]
+        return min(int(np.searchsorted(np.cumsum(s_terms), u, side="right")), self._K - 1)
+
+    '''
+        @param in_terms  list of bucket weights
+        @param in_u      float position inside the bucket mass
+        @return int index into in_terms
+    '''
+    def _walk(self, in_terms, in_u):
+        for i, term in enumerate(in_terms):
+            in_u -= term
+            if in_u < 0.0:
+                return i
+        return len(in_terms) - 1
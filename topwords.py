@@ -1,29 +1,124 @@
-import sys
-from operator import itemgetter
-
-if len(sys.argv) != 2:
-	print 'usage: python topwords.py <phi_file>'
-	exit()
-
-phi = []
-
-with open(sys.argv[1], 'r') as f:
-	Z = len(f.readline().split()) - 1  # number of topics
-	for z in range(0, Z): phi.append({})
-	f.seek(0)
-
-	for line in f:
-		tokens = line.split()
-		word = tokens.pop(0)
-		for z in range(0, Z):
-			phi[z][word] = float(tokens[z])
-
-for z in range(0, Z):
-	print 'Topic', z
-	words = sorted(phi[z].items(), key=itemgetter(1), reverse=True)
-	w = 0
-	for word, p in words:
-		print word, p
-		w += 1
-		if w == 20: break
-	print ''
+import os, sys
+import numpy as np
+from slots import slot_map_from_arrays
+
+'''
+    Prints the top words of every topic
+
+    python topwords.py <phi file> [num words]
+        <phi file> is either the text <out>-phi ("word v1 .. vK" lines,
+        phi_c read from <out>-phi0, <out>-phi1, .., labelled by
+        <out>-collections) or the sidecar <out>-phi.npy (words read from
+        <out>-vocab, phi_c from <out>-phi_c.npy and <out>-slots.npz). Per
+        collection top words follow the global ones.
+'''
+
+NUM_WORDS = 20
+
+'''
+    Loads a text "word v1 .. vK" table
+    @return (string array (w) words, float array (k x w))
+'''
+def load_text(in_path):
+    with open(in_path) as f:
+        num_topics = len(f.readline().split()) - 1
+    words = np.loadtxt(in_path, dtype=str, usecols=0, comments=None, ndmin=1)
+    table = np.loadtxt(in_path, usecols=range(1, num_topics + 1), comments=None, ndmin=2)
+    return words, table.T
+
+'''
+    Loads phi and every phi_c of an output path
+    @param in_path  string <out>-phi or <out>-phi.npy
+    @return (string array (w) words, float array (k x w) phi,
+            iterator of (string label, float array (k x w) phi_c)); the
+            collections are loaded one at a time as it is consumed
+'''
+def load_phi(in_path):
+    if in_path.endswith(".npy"):
+        prefix = in_path[:-len("-phi.npy")]
+        with open(prefix + "-vocab") as f:
+            words = np.array(f.read().split("\n")[:-1])
+        # the sidecars keep the OOV column, it has no word
+        V = len(words)
+        phi = np.load(in_path, mmap_mode="r")[:, :V]
+        if not os.path.exists(prefix + "-phi_c.npy"):
+            return words, phi, iter([])
+        return words, phi, _npy_tables(prefix, V)
+
+    words, phi = load_text(in_path)
+    return words, phi, _text_tables(in_path)
+
+'''
+    Expands the phi_c slot rows of the sidecars, one collection at a time
+    @return iterator of (string label, float array (k x w))
+'''
+def _npy_tables(in_prefix, in_V):
+    table = np.load(in_prefix + "-phi_c.npy", mmap_mode="r")
+    with np.load(in_prefix + "-slots.npz") as arrays:
+        slot_map = slot_map_from_arrays(arrays)
+    labels = load_labels(in_prefix, slot_map.get_num_collections())
+    for c in range(slot_map.get_num_collections()):
+        yield labels[c], slot_map.collection_table(table, c)[:, :in_V]
+
+'''
+    Reads the text tables <out>-phi0, <out>-phi1, .., one at a time
+    @return iterator of (string label, float array (k x w))
+'''
+def _text_tables(in_path):
+    num = 0
+    while os.path.exists(in_path + str(num)):
+        num += 1
+    labels = load_labels(in_path[:-len("-phi")], num)
+    for c in range(num):
+        yield labels[c], load_text(in_path + str(c))[1]
+
+'''
+    @param in_prefix    string output path
+    @param in_num   int number of collections
+    @return list of string collection labels from <out>-collections, the
+            ids "0", "1", .. if there is none
+'''
+def load_labels(in_prefix, in_num):
+    if os.path.exists(in_prefix + "-collections"):
+        with open(in_prefix + "-collections") as f:
+            return f.read().split("\n")[:-1]
+    return [str(c) for c in range(in_num)]
+
+'''
+    Finds the n largest entries of every row without sorting whole rows
+    @param in_table float array (k x w)
+    @param in_n int number of entries
+    @return int array (k x n) column idx, largest first
+'''
+def top_n(in_table, in_n):
+    n = min(in_n, in_table.shape[1])
+    top = np.argpartition(-in_table, n - 1, axis=1)[:, :n]
+    values = np.take_along_axis(in_table, top, axis=1)
+    return np.take_along_axis(top, np.argsort(-values, axis=1), axis=1)
+
+'''
+    Prints the top words of every row of a table
+'''
+def print_topics(in_title, in_words, in_table, in_n):
+    top = top_n(in_table, in_n)
+    for z in range(in_table.shape[0]):
+        print(in_title + " " + str(z))
+        for w in top[z]:
+            print(in_words[w] + " " + str(in_table[z, w]))
+        print("")
+
+
+def main():
+    if len(sys.argv) not in (2, 3):
+        print("usage: python topwords.py <phi_file> [num words]")
+        sys.exit(1)
+    n = int(sys.argv[2]) if len(sys.argv) == 3 else NUM_WORDS
+
+    words, phi, phi_c = load_phi(sys.argv[1])
+    print_topics("Topic", words, phi, n)
+    for label, table in phi_c:
+        print_topics("Collection " + label + " topic", words, table, n)
+
+
+if __name__ == "__main__":
+    main()
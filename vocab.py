@@ -0,0 +1,80 @@
+'''
+    Vocabulary shared by the training and testing data
+
+    Word idx 0..V-1 are the training words in order of first appearance.
+    Once frozen, unseen tokens map to the out-of-vocabulary idx V, which
+    every phi / phi_c table reserves as its last column.
+'''
+class Vocabulary:
+
+    OOV_TOKEN = "<oov>"
+
+    '''
+        Creates a vocabulary
+        @param in_tokens    list of unique strings to start from, or None
+    '''
+    def __init__(self, in_tokens=None):
+        self._tokens = [] if in_tokens is None else list(in_tokens)
+        self._map = dict((token, idx) for idx, token in enumerate(self._tokens))
+        self._frozen = False
+
+    '''
+        Gets the idx of a token, adding it unless the vocabulary is frozen
+        @param in_token string
+        @return int word idx, the OOV idx for unseen tokens once frozen
+    '''
+    def add(self, in_token):
+        idx = self._map.get(in_token)
+        if idx is None:
+            if self._frozen:
+                return len(self._tokens)
+            idx = len(self._tokens)
+            self._map[in_token] = idx
+            self._tokens.append(in_token)
+        return idx
+
+    '''
+        Stops the vocabulary from growing, later tokens map to the OOV idx
+    '''
+    def freeze(self):
+        self._frozen = True
+
+    '''
+        @return bool whether new tokens map to the OOV idx
+    '''
+    def is_frozen(self):
+        return self._frozen
+
+    '''
+        @param in_token string
+        @return int word idx, the OOV idx if the token is unknown
+    '''
+    def get_idx(self, in_token):
+        return self._map.get(in_token, len(self._tokens))
+
+    '''
+        @param in_idx   int word idx
+        @return string token, OOV_TOKEN for the OOV idx
+    '''
+    def get_token(self, in_idx):
+        if in_idx == len(self._tokens):
+            return Vocabulary.OOV_TOKEN
+        return self._tokens[in_idx]
+
+    '''
+        @return list of unique strings, position = word idx
+    '''
+    def get_tokens(self):
+        return self._tokens
+
+    '''
+        @return int idx reserved for unseen tokens (= V)
+    '''
+    def get_oov_idx(self):
+        return len(self._tokens)
+
+    '''
+        @return int V, number of known tokens (the OOV idx not included)
+    '''
+    def __len__(self):
+        return len(self._tokens)